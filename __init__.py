@@ -22,8 +22,11 @@ import bpy
 
 # Python modules:
 import os
+import re
 import sys
-import asyncio
+import base64
+import random
+import shutil
 import tempfile
 import importlib
 import subprocess
@@ -33,6 +36,10 @@ import subprocess
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
 from .src import helpers
+from .src import job_queue
+from .src import model_store
+from .src import job_trace
+from .src import image_handoff
 
 # Refresh Locals for development:
 if "bpy" in locals():
@@ -53,15 +60,44 @@ class CAT_PGT_Input_Properties(bpy.types.PropertyGroup):
 
     texture_prompt: bpy.props.StringProperty(name="Texture Prompt")
 
+    seed: bpy.props.IntProperty(
+        name="Seed",
+        description="Seed for the Stable Diffusion noise, the same prompt and seed create the same texture. -1 picks a "
+                    "random seed",
+        default=-1,
+        min=-1,
+    )
+
+    use_cache: bpy.props.BoolProperty(
+        name="Use Texture Cache",
+        description="Return the cached texture when the same prompt, seed and settings were generated before. Disable "
+                    "to always run Stable Diffusion",
+        default=True,
+    )
+
     texture_format: bpy.props.EnumProperty(
         name="Texture Format",
         description="Select texture file format",
         items=[
             ('.png', '.png', 'Export texture as .png'),
             ('.jpg', '.jpg', 'Export texture as .jpg'),
+            ('.webp', '.webp', 'Export texture as .webp, smaller than .png and .jpg at the same quality'),
+            ('.tga', '.tga', 'Export texture as uncompressed .tga, the fastest to write and read'),
+            ('.exr', '.exr', 'Export texture as uncompressed linear half float .exr'),
         ]
     )
 
+    compression: bpy.props.EnumProperty(
+        name="Compression",
+        description="Trade the time it takes to save a texture for its file size",
+        items=[
+            ('fast', 'Fast', 'Save quickly, larger files. JPEG and TGA have no faster setting and save as Default'),
+            ('default', 'Default', 'The usual settings of the format'),
+            ('small', 'Small', 'Smallest files, slowest to save'),
+        ],
+        default='default',
+    )
+
     save_path: bpy.props.StringProperty(
         name="Save Path",
         description="Save path for NFT files",
@@ -79,6 +115,90 @@ class CAT_PGT_Input_Properties(bpy.types.PropertyGroup):
         ]
     )
 
+    variations: bpy.props.IntProperty(
+        name="Variations",
+        description="Render the prompt with this many consecutive seeds in one batch to pick a texture from. The "
+                    "prompt is only encoded once for all of them",
+        default=1,
+        min=1,
+        max=16,
+    )
+
+    draft: bpy.props.BoolProperty(
+        name="Draft",
+        description="Render a quick preview with fewer steps. Refine a draft you like from the job list to render it "
+                    "at full quality from the same seed",
+        default=False,
+    )
+
+    handoff: bpy.props.BoolProperty(
+        name="Direct Transfer",
+        description="Send the texture's pixels straight into Blender through shared memory instead of loading the "
+                    "saved file",
+        default=True,
+    )
+
+    save_to_disk: bpy.props.BoolProperty(
+        name="Save to Disk",
+        description="Also save the texture to the Save Path. With Direct Transfer it is saved in the background "
+                    "after it was loaded, without it always",
+        default=True,
+    )
+
+    preview_every: bpy.props.IntProperty(
+        name="Preview Every",
+        description="Show a rough preview of the texture every this many denoising steps while it generates. 0 "
+                    "disables previews",
+        default=5,
+        min=0,
+    )
+
+    cpu_mode: bpy.props.EnumProperty(
+        name="CPU Mode",
+        description="How Stable Diffusion runs when rendering with the CPU",
+        items=[
+            ('default', 'Default', 'Same settings as on the GPU'),
+            ('optimized', 'Optimized', 'One thread per physical core, channels-last layout and bfloat16 on CPUs that '
+                                       'support it'),
+            ('optimized_int8', 'Optimized (int8)', 'Optimized, with the text encoder and UNet quantized to int8. '
+                                                   'Fastest, textures differ slightly from the other modes'),
+        ]
+    )
+
+    memory_mode: bpy.props.EnumProperty(
+        name="Memory Mode",
+        description="Lean trades some speed for a lower peak memory, textures differ slightly from normal mode",
+        items=[
+            ('normal', 'Normal', 'Keep the whole pipeline on the render device'),
+            ('lean', 'Lean', 'Slice attention and the VAE, load with low memory use and offload to the CPU on Cuda'),
+        ]
+    )
+
+    memory_budget: bpy.props.FloatProperty(
+        name="Memory Budget (GB)",
+        description="Peak memory a texture should stay under, jobs over budget are flagged in the job list. 0 "
+                    "disables the check",
+        default=0.0,
+        min=0.0,
+    )
+
+    library_search: bpy.props.StringProperty(
+        name="Search Library",
+        description="Search the textures generated into the Save Path by name or prompt",
+        default="",
+        update=lambda self, context: helpers.search_library(texture_save_path(self), self.library_search),
+    )
+
+
+def texture_save_path(input_tool):
+    """
+    Absolute folder textures are saved to, the temp folder if no Save Path was set.
+    """
+    save_path = os.path.abspath(bpy.path.abspath(input_tool.save_path))
+    if not input_tool.save_path or input_tool.save_path == "/tmp\\":
+        return tempfile.gettempdir()
+    return save_path
+
 
 class CAT_PGT_Input_Properties_Pre(bpy.types.PropertyGroup):
     # Install Dependencies panel:
@@ -89,6 +209,16 @@ class CAT_PGT_Input_Properties_Pre(bpy.types.PropertyGroup):
                         " old Environment Path. Regardless of the method, always initiate your Environment.",
             default=f"{helpers.current_drive}",
             maxlen=1024,
+            subtype="DIR_PATH",
+            update=lambda self, context: helpers.environment_state.invalidate(self.venv_path),
+    )
+
+    wheelhouse_path: bpy.props.StringProperty(
+            name="Offline Wheelhouse",
+            description="Optional folder of pre-downloaded Python wheels. When set, dependencies are installed from "
+                        "this folder without network access",
+            default="",
+            maxlen=1024,
             subtype="DIR_PATH"
     )
 
@@ -105,37 +235,370 @@ class CreateTextures(bpy.types.Operator):
     bl_description = 'Creates textures with Stable Diffusion by using the Texture Description as text input.'
     bl_options = {"REGISTER", "UNDO"}
 
+    @classmethod
+    def poll(cls, context):
+        # Cached, see helpers.environment_state. Greyed out until the Venv and the weights are installed:
+        return helpers.environment_state.installed(bpy.context.scene.input_tool_pre.venv_path)
+
     def invoke(self, context, event):
         return context.window_manager.invoke_confirm(self, event)
 
     def execute(self, context):
         environment_path = os.path.join(bpy.context.scene.input_tool_pre.venv_path, "Cozy-Auto-Texture-Files")
         venv_path = os.path.join(environment_path, "venv")
-        sd_path = os.path.join(environment_path, helpers.sd_version)
+        sd_path = helpers.get_model_path(environment_path)
 
-        subprocess.run(["pip", "-V"], check=True)
+        # Random seeds are picked here rather than in the worker, so a draft can be refined from the same seed:
+        seed = bpy.context.scene.input_tool.seed
+        if seed < 0:
+            seed = random.randrange(2 ** 31)
 
         user_input = {
             "texture_name": bpy.context.scene.input_tool.texture_name,
             "texture_prompt": bpy.context.scene.input_tool.texture_prompt,
-            "save_path": os.path.abspath(bpy.path.abspath(bpy.context.scene.input_tool.save_path)),
+            "save_path": texture_save_path(bpy.context.scene.input_tool),
             "texture_format": bpy.context.scene.input_tool.texture_format,
+            "compression": bpy.context.scene.input_tool.compression,
             "model_path": sd_path,
             "device": bpy.context.scene.input_tool.device,
+            "seed": seed,
+            "draft": bpy.context.scene.input_tool.draft,
+            "preview_every": bpy.context.scene.input_tool.preview_every,
+            "handoff": bpy.context.scene.input_tool.handoff,
+            "save": bpy.context.scene.input_tool.save_to_disk or not bpy.context.scene.input_tool.handoff,
+            "cache_dir": os.path.join(environment_path, "cache", "results"),
+            "use_cache": bpy.context.scene.input_tool.use_cache,
+            "step_timings": helpers.trace_step_timings,
+            "memory_mode": bpy.context.scene.input_tool.memory_mode,
+            "cpu_mode": bpy.context.scene.input_tool.cpu_mode,
+            "memory_budget": bpy.context.scene.input_tool.memory_budget * 1e+9,
         }
 
-        if not user_input["save_path"]:
-            user_input["save_path"] = tempfile.gettempdir()
-        if user_input["save_path"] == "/tmp\\":
-            user_input["save_path"] = tempfile.gettempdir()
+        command = "text2img"
+        variations = bpy.context.scene.input_tool.variations
+        if variations > 1:
+            # "text2img_sweep" batches every seed through one pipeline call per batch, it has no previews:
+            command = "text2img_sweep"
+            for key in ("seed", "preview_every", "step_timings", "memory_budget", "handoff", "save"):
+                user_input.pop(key)
+            user_input["seeds"] = [(seed + i) % 2 ** 31 for i in range(variations)]  # Fits the Refine seed IntProperty
+
+        # "text2img" - name of function inside sd_interface.py file, run in the background by the persistent worker.
+        # Finished textures are loaded into Blender by 'process_jobs', their stage timings are written to 'traces':
+        helpers.job_queue.trace_dir = os.path.join(environment_path, "traces")
+        helpers.job_queue.submit(
+                label=user_input["texture_name"] or user_input["texture_prompt"],
+                venv_path=venv_path,
+                command=command,
+                **user_input
+        )
+
+        self.report({'INFO'}, f"Texture queued.")
+        return {"FINISHED"}
+
+
+def object_prompt(obj):
+    """
+    Prompt for texturing 'obj': its prompt property, the prompt property of its active material or the name of its
+    active material, None if it has neither.
+    """
+    material = obj.active_material
+    for owner in (obj, material):
+        if owner is not None and owner.get(helpers.object_prompt_property):
+            return str(owner[helpers.object_prompt_property])
+    return material.name if material is not None else None
+
+
+class CAT_OT_Texture_Selected(bpy.types.Operator):
+    bl_idname = 'cat.texture_selected'
+    bl_label = 'Texture Selected Objects'
+    bl_description = ('Creates a texture for every selected object from its prompt property or material name, and '
+                      'assigns it as a new material. Objects sharing a prompt share a texture.')
+    bl_options = {"REGISTER", "UNDO"}
+
+    @classmethod
+    def poll(cls, context):
+        return bool(context.selected_objects) and CreateTextures.poll(context)
+
+    def execute(self, context):
+        environment_path = os.path.join(bpy.context.scene.input_tool_pre.venv_path, "Cozy-Auto-Texture-Files")
+        venv_path = os.path.join(environment_path, "venv")
+        input_tool = bpy.context.scene.input_tool
+
+        # {prompt: [object name, ...]}, in selection order:
+        objects_by_prompt = {}
+        skipped = []
+        for obj in context.selected_objects:
+            prompt = object_prompt(obj) if hasattr(obj.data, "materials") else None
+            if prompt:
+                objects_by_prompt.setdefault(prompt, []).append(obj.name)
+            else:
+                skipped.append(obj.name)
+
+        if not objects_by_prompt:
+            self.report({"ERROR"}, f"None of the selected objects has a '{helpers.object_prompt_property}' property "
+                                   f"or a material to take a prompt from.")
+            return {"CANCELLED"}
+
+        records = [
+                {
+                        "name": re.sub(r'[\\/:*?"<>|]', "_", prompt).strip()[:64],
+                        "prompt": prompt,
+                        "seed": input_tool.seed if input_tool.seed >= 0 else random.randrange(2 ** 31),
+                }
+                for prompt in objects_by_prompt
+        ]
+
+        # One "text2img_batch" job loads the model once for the whole selection, materials are created by
+        # 'process_jobs' when it finishes:
+        helpers.job_queue.trace_dir = os.path.join(environment_path, "traces")
+        job = helpers.job_queue.submit(
+                label=f"{len(context.selected_objects) - len(skipped)} selected objects",
+                venv_path=venv_path,
+                command="text2img_batch",
+                records=records,
+                save_path=texture_save_path(input_tool),
+                texture_format=input_tool.texture_format,
+                compression=input_tool.compression,
+                model_path=helpers.get_model_path(environment_path),
+                device=input_tool.device,
+                cache_dir=os.path.join(environment_path, "cache", "results"),
+                use_cache=input_tool.use_cache,
+                memory_mode=input_tool.memory_mode,
+                cpu_mode=input_tool.cpu_mode,
+        )
+        helpers.pending_materials[job.id] = list(objects_by_prompt.values())
+
+        message = f"{len(records)} textures queued for {len(context.selected_objects) - len(skipped)} objects."
+        if skipped:
+            message += f" Skipped {len(skipped)} without a prompt: {', '.join(skipped)}"
+        self.report({'INFO'}, message)
+        return {"FINISHED"}
+
+
+class CAT_OT_Cancel_Job(bpy.types.Operator):
+    bl_idname = 'cat.cancel_job'
+    bl_label = 'Cancel Job'
+    bl_description = 'Cancels a queued or running texture generation job.'
+    bl_options = {"REGISTER", "INTERNAL"}
+
+    job_id: bpy.props.IntProperty()
+
+    def execute(self, context):
+        helpers.job_queue.cancel(self.job_id)
+        return {"FINISHED"}
+
+
+class CAT_OT_Refine_Job(bpy.types.Operator):
+    bl_idname = 'cat.refine_job'
+    bl_label = 'Refine Draft'
+    bl_description = 'Renders a draft again at full quality from the same prompt and seed.'
+    bl_options = {"REGISTER", "INTERNAL"}
+
+    job_id: bpy.props.IntProperty()
+    seed: bpy.props.IntProperty(default=-1)  # The variation to refine of a "text2img_sweep" draft
+
+    def execute(self, context):
+        job = helpers.job_queue.get(self.job_id)
+        if job is None:
+            self.report({"ERROR"}, "The draft is no longer in the job list.")
+            return {"CANCELLED"}
+
+        kwargs = {**job.kwargs, "draft": False}
+        label = f"{job.label} (refined)"
+        if job.command == "text2img_sweep":
+            # A sweep takes the arguments of 'text2img' apart from the seeds, batched and single images from the same
+            # seed start from the same noise:
+            kwargs.pop("seeds")
+            kwargs["seed"] = self.seed
+            label = f"{job.label} {self.seed} (refined)"
+
+        helpers.job_queue.submit(
+                label=label,
+                venv_path=job.venv_path,
+                command="text2img",
+                **kwargs
+        )
+
+        self.report({'INFO'}, f"Refinement queued.")
+        return {"FINISHED"}
+
 
-        # "text2img" - name of function inside sd_interface.py file
-        helpers.execution_handler(venv_path=venv_path, operation_function="text2img", user_input=user_input)
+class CAT_OT_Load_Library_Texture(bpy.types.Operator):
+    bl_idname = 'cat.load_library_texture'
+    bl_label = 'Load Texture'
+    bl_description = 'Loads a texture from the library into Blender.'
+    bl_options = {"REGISTER", "INTERNAL"}
+
+    path: bpy.props.StringProperty()
 
-        self.report({'INFO'}, f"Texture(s) Created!")
+    def execute(self, context):
+        try:
+            bpy.data.images.load(self.path, check_existing=True)
+        except RuntimeError as err:
+            self.report({"ERROR"}, str(err))
+            return {"CANCELLED"}
         return {"FINISHED"}
 
 
+class CAT_OT_Clear_Jobs(bpy.types.Operator):
+    bl_idname = 'cat.clear_jobs'
+    bl_label = 'Clear Finished Jobs'
+    bl_description = 'Removes finished, failed and cancelled jobs from the job list.'
+    bl_options = {"REGISTER", "INTERNAL"}
+
+    def execute(self, context):
+        helpers.job_queue.clear_finished()
+        return {"FINISHED"}
+
+
+# ======== Environment State ======== #
+def refresh_environment_state():
+    """
+    bpy.app.timers callback, re-checks the cached environment state in a background thread so that panel poll() and
+    draw() never wait on the file system.
+    """
+    helpers.environment_state.refresh_in_background()
+    return helpers.environment_state_interval
+
+
+# ======== Job Handling ======== #
+preview_image_name = "Cozy Auto Texture Preview"
+
+
+def show_preview(preview: dict):
+    """
+    Writes a latent preview sent by the worker into the preview image, creating it if needed. The image can be watched
+    in any Image Editor while the texture generates.
+    """
+    width, height = preview["width"], preview["height"]
+
+    image = bpy.data.images.get(preview_image_name)
+    if image is not None and tuple(image.size) != (width, height):
+        bpy.data.images.remove(image)
+        image = None
+    if image is None:
+        image = bpy.data.images.new(preview_image_name, width=width, height=height, alpha=True)
+
+    # The preview is top row first, Blender stores pixels bottom row first:
+    rgba = base64.b64decode(preview["rgba"])
+    row_size = width * 4
+    rows = [rgba[row * row_size:(row + 1) * row_size] for row in reversed(range(height))]
+    image.pixels.foreach_set([value / 255 for value in b"".join(rows)])
+    image.update()
+
+    image.preview_ensure()
+    image.preview.reload()
+
+
+def load_handoff(job: job_queue.Job):
+    """
+    Creates an image from the pixels a 'text2img' job handed over through shared memory. It is named and pointed at
+    its file like a loaded texture when the worker saves it too, the file is written in the background and the image
+    switched to it by 'finish_saved_handoffs'.
+    """
+    result = job.result
+    handoff = result["handoff"]
+    name = os.path.basename(result["image_path"]) if result["image_path"] else result["name"]
+
+    image = bpy.data.images.new(name, width=handoff["width"], height=handoff["height"], alpha=True)
+    with image_handoff.read(handoff) as pixels:
+        image.pixels.foreach_set(pixels)
+    if result["image_path"]:
+        image.filepath_raw = result["image_path"]
+        helpers.pending_saves[result["image_path"]] = job
+    image.update()
+    return image
+
+
+def finish_saved_handoffs():
+    """
+    Switches handed over images to their files once the worker saved them. Until then they are generated images that
+    only hold pixels in memory, a .blend saved without packing them would reopen with blank textures. The encode time
+    and size of the save are added to the trace of the job.
+    """
+    for image_path, job in list(helpers.pending_saves.items()):
+        record = helpers.saved_texture(image_path)
+        if record is None:
+            continue
+        del helpers.pending_saves[image_path]
+
+        seconds = record["timings"].get("encode", 0.0)
+        size = record["timings"].get("encode_bytes", 0)
+        print(f"Cozy Auto Texture saved '{image_path}': encoded in {seconds:.2f}s, {size / 1e6:.2f}MB")
+        helpers.job_queue.add_stage(job, "encode", seconds, bytes=size)
+
+        for image in bpy.data.images:
+            if image.source == 'GENERATED' and image.filepath_raw == image_path:
+                image.source = 'FILE'
+                image.filepath = image_path
+                image.reload()
+
+
+def assign_texture_material(record: dict, object_names: list):
+    """
+    Creates a material with the texture of a 'text2img_batch' record as its base colour and makes it the active
+    material of the objects in 'object_names'. The material keeps the prompt, so texturing the objects again reuses it.
+    """
+    image = bpy.data.images.load(record["image_path"], check_existing=True)
+
+    material = bpy.data.materials.new(name=f"CAT {record['name']}")
+    material[helpers.object_prompt_property] = record["prompt"]
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    shader = next(node for node in nodes if node.type == 'BSDF_PRINCIPLED')
+
+    texture = nodes.new("ShaderNodeTexImage")
+    texture.image = image
+    texture.location = (shader.location.x - 300, shader.location.y)
+    material.node_tree.links.new(texture.outputs["Color"], shader.inputs["Base Color"])
+
+    for name in object_names:
+        obj = bpy.data.objects.get(name)
+        if obj is None:
+            continue  # Deleted while the job ran
+        if obj.material_slots:
+            obj.active_material = material
+        else:
+            obj.data.materials.append(material)
+
+
+def process_jobs():
+    """
+    bpy.app.timers callback, loads the textures of finished jobs into Blender, shows the latest preview of running jobs
+    and keeps the job list in the UI up to date while jobs run in the background.
+    """
+    for job in helpers.job_queue.jobs:
+        if job.preview_updated:
+            job.preview_updated = False
+            show_preview(job.preview)
+
+    finish_saved_handoffs()
+
+    for job in helpers.job_queue.pop_finished():
+        pending_materials = helpers.pending_materials.pop(job.id, None)
+        if job.status == job_queue.FINISHED:
+            if isinstance(job.result, dict) and "handoff" in job.result:
+                load_handoff(job)
+            for image_path in job.image_paths():
+                bpy.data.images.load(image_path, check_existing=True)
+            if pending_materials is not None:
+                for record, object_names in zip(job.result, pending_materials):
+                    if record.get("image_path"):
+                        assign_texture_material(record, object_names)
+            print(f"Cozy Auto Texture job '{job.label}' finished: {job.result}")
+
+            input_tool = bpy.context.scene.input_tool
+            helpers.search_library(texture_save_path(input_tool), input_tool.library_search)
+
+    if bpy.context.screen is not None:
+        for area in bpy.context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+    return 0.5 if helpers.job_queue.active or helpers.pending_saves else 1.0
+
+
 # ======== UI Panels ======== #
 class CAT_PT_Main(bpy.types.Panel):
     bl_label = "Cozy Auto Texture"
@@ -162,12 +625,32 @@ class CAT_PT_Main(bpy.types.Panel):
         row = layout.row()
         row.label(text="*Input text for Stable Diffusion model.")
 
+        row = layout.row()
+        row.prop(input_tool, "seed")
+        row.prop(input_tool, "use_cache")
+
         row = layout.row()
         row.prop(input_tool, "texture_format")
+        row.prop(input_tool, "compression")
 
         row = layout.row()
         row.prop(input_tool, "device")
 
+        row = layout.row()
+        row.prop(input_tool, "preview_every")
+
+        row = layout.row()
+        row.prop(input_tool, "handoff")
+        row.prop(input_tool, "save_to_disk")
+
+        if input_tool.device == 'cpu':
+            row = layout.row()
+            row.prop(input_tool, "cpu_mode")
+
+        row = layout.row()
+        row.prop(input_tool, "memory_mode")
+        row.prop(input_tool, "memory_budget")
+
         layout.separator()
 
         row = layout.row()
@@ -175,10 +658,63 @@ class CAT_PT_Main(bpy.types.Panel):
 
         layout.separator()
 
-        layout.operator("cat.create_textures", icon='DISCLOSURE_TRI_RIGHT', text="Create Textures")
+        row = layout.row()
+        row.prop(input_tool, "variations")
+
+        row = layout.row()
+        row.prop(input_tool, "draft")
+        row.operator("cat.create_textures", icon='DISCLOSURE_TRI_RIGHT', text="Create Textures")
+
+        row = layout.row()
+        row.operator("cat.texture_selected", icon='MATERIAL')
 
         layout.separator()
 
+        # Job queue:
+        if helpers.job_queue.jobs:
+            box = layout.box()
+            box.label(text="Jobs:")
+
+            for job in helpers.job_queue.jobs:
+                row = box.row()
+                if job.status == job_queue.RUNNING:
+                    row.label(text=f"{job.label}: {job.progress:.0%} {job.message}", icon='TIME')
+
+                    preview_image = bpy.data.images.get(preview_image_name)
+                    if job.preview is not None and preview_image is not None and preview_image.preview is not None:
+                        preview_box = box.box()
+                        preview_box.template_icon(icon_value=preview_image.preview.icon_id, scale=8)
+                        preview_box.operator("cat.cancel_job", text="Cancel", icon='CANCEL').job_id = job.id
+                elif job.status == job_queue.FAILED:
+                    row.label(text=f"{job.label}: {job.error}", icon='ERROR')
+                else:
+                    row.label(text=f"{job.label}: {job.status.title()}")
+
+                if not job.done:
+                    row.operator("cat.cancel_job", text="", icon='X').job_id = job.id
+                elif job.status == job_queue.FINISHED and job.command == "text2img" and job.kwargs.get("draft"):
+                    row.operator("cat.refine_job", text="Refine", icon='SHADERFX').job_id = job.id
+                elif job.status == job_queue.FINISHED and job.command == "text2img_sweep" and job.kwargs.get("draft"):
+                    for record in job.result["records"]:
+                        record_row = box.row()
+                        record_row.label(text=f"Seed {record['seed']}")
+                        refine = record_row.operator("cat.refine_job", text="Refine", icon='SHADERFX')
+                        refine.job_id = job.id
+                        refine.seed = record["seed"]
+
+                if job.done and job.trace is not None:
+                    box.label(text=job_trace.summary(job.trace), icon='SORTTIME')
+
+            box.operator("cat.clear_jobs", icon='TRASH')
+
+        # Texture library, results are updated by the search field and finished jobs:
+        box = layout.box()
+        box.prop(input_tool, "library_search", icon='VIEWZOOM')
+        for record in helpers.library_results:
+            row = box.row()
+            row.label(text=f"{record['name']}: {record['prompt']} (seed {record['seed']})")
+            row.operator("cat.load_library_texture", text="", icon='IMPORT').path = record["path"]
+
 
 class CAT_PT_Help(bpy.types.Panel):
     bl_label = "Help"
@@ -217,17 +753,17 @@ class CAT_PT_Help(bpy.types.Panel):
         row = layout.row()
         layout.label(text=f"{CAT_version}, {LAST_UPDATED}")
 
-        # TODO: find better way to displayed installed dependencies:
-        # layout.label(text="Installed Dependencies:")
-        # for dependency in dependencies:
-        #     if dependency.name is None and hasattr(globals()[dependency.module], "__version__"):
-        #         layout.label(text=f"{dependency.module} {globals()[dependency.module].__version__}")
-        #     elif hasattr(globals()[dependency.name], "__version__"):
-        #         layout.label(text=f"{dependency.module} {globals()[dependency.name].__version__}")
-        #     else:
-        #         layout.label(text=f"{dependency.module}")
-        #     if os.path.exists(os.path.relpath(sd_version)):
-        #         layout.label(text=sd_version)
+        environment_state = helpers.environment_state.get(bpy.context.scene.input_tool_pre.venv_path)
+        if environment_state["weights"]:
+            layout.label(text=f"Weights: {environment_state['weights_version']}")
+
+        if helpers.dependency_report:
+            layout.label(text="Installed Dependencies:")
+            for dependency in helpers.dependency_report["dependencies"]:
+                layout.label(
+                        text=f"{dependency['name']} {dependency['installed'] or 'missing'}",
+                        icon='CHECKMARK' if dependency["satisfied"] else 'ERROR'
+                )
 
 
 # ======== Pre-Dependency Operators ======== #
@@ -243,20 +779,14 @@ class CATPRE_OT_install_dependencies(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        environment_path = os.path.exists(
-                os.path.join(
-                        bpy.context.scene.input_tool_pre.venv_path,
-                        "Cozy-Auto-Texture-Files"
-                )
-        )
-        return not environment_path
+        # Cached, see helpers.environment_state:
+        return not helpers.environment_state.get(bpy.context.scene.input_tool_pre.venv_path)["exists"]
 
     def execute(self, context):
         # TODO: make asynchronous so that download progress is viewable from UI.
         # Paths:
         environment_path = os.path.join(bpy.context.scene.input_tool_pre.venv_path, "Cozy-Auto-Texture-Files")
         venv_path = os.path.join(environment_path, "venv")
-        sd_path = os.path.join(environment_path, helpers.sd_version)
 
         helpers.create_path_log(path=environment_path, path_name="environment_path")
 
@@ -272,40 +802,78 @@ class CATPRE_OT_install_dependencies(bpy.types.Operator):
 
         # Importing dependencies
         try:
-            helpers.install_and_import_module(venv_path=venv_path)
+            wheelhouse = bpy.context.scene.input_tool_pre.wheelhouse_path
+            helpers.install_and_import_module(
+                    venv_path=venv_path,
+                    wheelhouse=os.path.abspath(bpy.path.abspath(wheelhouse)) if wheelhouse else None
+            )
 
             print("Python modules installed successfully.")
-        except (subprocess.CalledProcessError, ImportError) as err:
+        except (subprocess.CalledProcessError, ImportError, OSError) as err:
             self.report({"ERROR"}, str(err))
             return {"CANCELLED"}
 
-        # Importing Stable Diffusion
-        user_input = {
-                "sd_path": sd_path,
-                "sd_url": helpers.sd_url,
-                "environment_path": environment_path,
-        }
+        # Importing Stable Diffusion, the weights are downloaded once per machine into the shared model store and
+        # every environment references them through path_log.json:
+        stored_path = model_store.lookup(helpers.sd_version)
 
-        try:
-            helpers.execution_handler(
-                    venv_path=venv_path,
-                    operation_function="import_stable_diffusion",
-                    user_input=user_input
-            )
-            print("Stable Diffusion successfully installed.")
+        if stored_path is not None:
+            print(f"Using Stable Diffusion from the shared model store:\n{stored_path}")
+        else:
+            staging_path = model_store.staging_path(helpers.sd_version)
+            user_input = {
+                    "sd_path": os.path.join(staging_path, helpers.sd_version),
+                    "sd_url": helpers.sd_url,
+                    "environment_path": staging_path,
+                    "connections": helpers.download_connections,
+                    "sha256": helpers.sd_sha256,
+            }
+
+            try:
+                helpers.execution_handler(
+                        venv_path=venv_path,
+                        operation_function="import_stable_diffusion",
+                        user_input=user_input
+                )
+                # Converted before the weights are hashed into the store, so every environment maps the same files:
+                helpers.execution_handler(
+                        venv_path=venv_path,
+                        operation_function="convert_weights",
+                        user_input={
+                                "model_path": os.path.join(staging_path, helpers.sd_version),
+                                "fp16": helpers.sd_convert_fp16,
+                        }
+                )
+                stored_path = model_store.add(
+                        name=helpers.sd_version,
+                        weights_path=os.path.join(staging_path, helpers.sd_version),
+                        url=helpers.sd_url
+                )
+                shutil.rmtree(staging_path, ignore_errors=True)
+                print("Stable Diffusion successfully installed.")
 
-        except Exception as err:
-            self.report({"ERROR"}, str(err))
-            return {"CANCELLED"}
+            except Exception as err:
+                self.report({"ERROR"}, str(err))
+                return {"CANCELLED"}
+
+        helpers.update_path_log(model_paths={helpers.sd_version: stored_path})
 
         print("Dependencies installed successfully")
 
+        helpers.environment_state.invalidate()
+
+        helpers.are_dependencies_installed(
+                venv_path=venv_path,
+                cache_path=os.path.join(environment_path, "dependency_report.json"),
+        )
+
         helpers.set_dependencies_installed(True)
 
         for cls in classes:
             bpy.utils.register_class(cls)
 
         bpy.types.Scene.input_tool = bpy.props.PointerProperty(type=CAT_PGT_Input_Properties)
+        bpy.app.timers.register(process_jobs, persistent=True)
 
         return {'FINISHED'}
 
@@ -319,13 +887,8 @@ class CATPRE_PT_warning_panel(bpy.types.Panel):
 
     @classmethod
     def poll(cls, context):
-        environment_path = os.path.exists(
-            os.path.join(
-                bpy.context.scene.input_tool_pre.venv_path,
-                "Cozy-Auto-Texture-Files"
-            )
-        )
-        return not environment_path
+        # Cached, see helpers.environment_state:
+        return not helpers.environment_state.get(bpy.context.scene.input_tool_pre.venv_path)["exists"]
 
     def draw(self, context):
         layout = self.layout
@@ -355,6 +918,9 @@ class CATPRE_preferences(bpy.types.AddonPreferences):
         row = layout.row()
         row.prop(input_tool_pre, "venv_path")
 
+        row = layout.row()
+        row.prop(input_tool_pre, "wheelhouse_path")
+
         # Hugging Face and Cozy Auto Texture License agreement:
 
         # This line represents the character space readable in Blender's UI system:
@@ -405,6 +971,11 @@ classes = (
 
         # Operator Classes:
         CreateTextures,
+        CAT_OT_Texture_Selected,
+        CAT_OT_Cancel_Job,
+        CAT_OT_Clear_Jobs,
+        CAT_OT_Refine_Job,
+        CAT_OT_Load_Library_Texture,
 
         # Panel Classes:
         CAT_PT_Main,
@@ -438,8 +1009,25 @@ def register():
 
     bpy.types.Scene.input_tool_pre = bpy.props.PointerProperty(type=CAT_PGT_Input_Properties_Pre)
 
+    helpers.invalidate_path_log()
+    helpers.environment_state.invalidate()
+    bpy.app.timers.register(
+            refresh_environment_state,
+            first_interval=helpers.environment_state_interval,
+            persistent=True
+    )
+
     if helpers.read_path_log(check_exists=True):
-        # environment_path = helpers.read_path_log()["environment_path"]
+        environment_path = helpers.read_path_log()["environment_path"]
+
+        # Cached on the Venv's site-packages mtime, only re-checked after packages changed:
+        report = helpers.are_dependencies_installed(
+                venv_path=os.path.join(environment_path, "venv"),
+                cache_path=os.path.join(environment_path, "dependency_report.json"),
+        )
+        for dependency in report["dependencies"]:
+            if not dependency["satisfied"]:
+                print(f"Cozy Auto Texture: {dependency['requirement']} not satisfied, found {dependency['installed']}.")
 
         helpers.set_dependencies_installed(True)
 
@@ -447,6 +1035,7 @@ def register():
             bpy.utils.register_class(cls)
 
         bpy.types.Scene.input_tool = bpy.props.PointerProperty(type=CAT_PGT_Input_Properties)
+        bpy.app.timers.register(process_jobs, persistent=True)
 
         helpers.set_dependencies_installed(True)
         return
@@ -456,6 +1045,12 @@ def register():
 
 
 def unregister():
+    for timer in (process_jobs, refresh_environment_state):
+        if bpy.app.timers.is_registered(timer):
+            bpy.app.timers.unregister(timer)
+
+    helpers.stop_workers()
+
     for cls in pre_dependency_classes:
         bpy.utils.unregister_class(cls)
 
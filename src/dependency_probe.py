@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import glob
+import json
+import platform
+import importlib.metadata
+
+# NOTE: Standard library only. Used by Blender to check the Venv without starting the Venv's Python, and by
+# sd_interface.py to check its own interpreter.
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+    from packaging.version import Version, InvalidVersion
+except ImportError:
+    try:  # Blender ships pip, which vendors packaging
+        from pip._vendor.packaging.requirements import Requirement, InvalidRequirement
+        from pip._vendor.packaging.version import Version, InvalidVersion
+    except ImportError:
+        Requirement = None
+
+# Fallback without packaging: "name[extras] op version, op version, ..." with the comparison operators below. Anything
+# else (e.g. "~=", "===", wildcards, markers) is rejected instead of being checked wrongly:
+requirement_pattern = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*?)\s*$")
+clause_pattern = re.compile(r"^\s*(==|!=|>=|<=|>|<)\s*([0-9][A-Za-z0-9.+_-]*)\s*$")
+version_pattern = re.compile(
+        r"^v?(\d+(?:\.\d+)*)(?:[-_.]?(a|b|rc)[-_.]?(\d*))?(?:[-_.]?post[-_.]?(\d*))?(?:[-_.]?dev[-_.]?(\d*))?"
+        r"(?:\+([a-z0-9.]+))?$",
+        re.IGNORECASE,
+)
+
+# In-memory reports, {(site_packages..., requirements...): (mtime, report)}:
+reports = {}
+
+
+def normalize_name(name: str):
+    # PEP 503 normalization, "Pillow" and "pillow", "typing_extensions" and "typing-extensions" are the same package:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_requirement(requirement: str):
+    """
+    Parses a requirement like "torch==1.12.1+cu116" or "torch>=1.12,<2" into (name, satisfied_by), where
+    'satisfied_by(version)' tells whether an installed version meets every specifier. Pre-releases count as installed
+    versions like any other.
+
+    :raises ValueError: If the requirement can't be checked reliably.
+    """
+    if Requirement is not None:
+        try:
+            parsed = Requirement(requirement)
+        except InvalidRequirement as err:
+            raise ValueError(f"Unsupported requirement: '{requirement}'") from err
+
+        def satisfied_by(version: str):
+            try:
+                return parsed.specifier.contains(Version(version), prereleases=True)
+            except InvalidVersion:
+                return False
+
+        return parsed.name, satisfied_by
+
+    match = requirement_pattern.match(requirement)
+    if match is None:
+        raise ValueError(f"Unsupported requirement: '{requirement}'")
+    name, _, specifiers = match.groups()
+
+    clauses = []
+    for specifier in filter(None, (part.strip() for part in specifiers.split(","))):
+        clause = clause_pattern.match(specifier)
+        if clause is None:
+            raise ValueError(f"Unsupported specifier '{specifier}' in '{requirement}', install 'packaging' to check it")
+        version_key(clause.group(2))  # Raises for versions the fallback can't order
+        clauses.append(clause.groups())
+
+    return name, lambda version: all(version_satisfies(version, operator, wanted) for operator, wanted in clauses)
+
+
+def version_key(version: str):
+    """
+    Sortable PEP 440 key of a version without its local label, "1.0.dev1" < "1.0a1" < "1.0" < "1.0.post1". Fallback for
+    when packaging isn't importable.
+
+    :raises ValueError: For versions outside of the supported subset of PEP 440 (e.g. epochs).
+    """
+    match = version_pattern.match(version.strip())
+    if match is None:
+        raise ValueError(f"Unsupported version: '{version}'")
+    release, pre, pre_number, post, dev, _ = match.groups()
+
+    parts = [int(part) for part in release.split(".")]
+    while parts and parts[-1] == 0:
+        parts.pop()
+
+    if pre:
+        pre_key = ("a", "b", "rc").index(pre.lower()), int(pre_number or 0)
+    elif dev is not None and post is None:
+        pre_key = (-1, 0)  # "1.0.dev1" is before "1.0a1"
+    else:
+        pre_key = (3, 0)
+    post_key = int(post or 0) if post is not None else -1
+    dev_key = int(dev or 0) if dev is not None else float("inf")
+    return tuple(parts), pre_key, post_key, dev_key
+
+
+def version_satisfies(installed: str, operator: str, wanted: str):
+    try:
+        installed_key = version_key(installed)
+    except ValueError:
+        return False
+    wanted_key = version_key(wanted)
+
+    if operator in ("==", "!="):
+        # "1.12.1" is satisfied by "1.12.1+cu116", "1.12.1+cu116" only by itself:
+        equal = installed_key == wanted_key
+        if "+" in wanted:
+            equal = equal and installed.partition("+")[2].lower() == wanted.partition("+")[2].lower()
+        return equal if operator == "==" else not equal
+
+    # "<2" excludes "2.0rc1", which sorts before "2":
+    wanted_final = wanted_key[1] == (3, 0) and wanted_key[3] == float("inf")
+    return {
+            ">=": installed_key >= wanted_key,
+            "<=": installed_key <= wanted_key,
+            ">": installed_key > wanted_key,
+            "<": installed_key < wanted_key and not (wanted_final and installed_key[0] == wanted_key[0]),
+    }[operator]
+
+
+def venv_site_packages(venv_path: str):
+    """
+    Site-packages folder(s) of a Venv, 'Lib/site-packages' on Windows and 'lib/pythonX.Y/site-packages' elsewhere.
+    """
+    if platform.system() == "Windows":
+        return [os.path.join(venv_path, "Lib", "site-packages")]
+    return sorted(glob.glob(os.path.join(venv_path, "lib", "python*", "site-packages")))
+
+
+def installed_distributions(paths: list = None):
+    """
+    {normalized name: version} of every distribution in 'paths', or on sys.path if 'paths' is None.
+    """
+    installed = {}
+    for distribution in importlib.metadata.distributions(**({"path": paths} if paths is not None else {})):
+        name = distribution.metadata["Name"]
+        if name and normalize_name(name) not in installed:
+            installed[normalize_name(name)] = distribution.version
+    return installed
+
+
+def probe(requirements: list, paths: list = None):
+    """
+    Checks every requirement against the distributions in 'paths' (sys.path if None) in a single pass.
+
+    :return: {"ok": bool, "paths": [...], "dependencies": [{"requirement", "name", "installed", "satisfied"}, ...]}
+        A requirement that can't be checked is reported as not satisfied with an "error".
+    """
+    installed = installed_distributions(paths)
+
+    dependencies = []
+    for requirement in requirements:
+        try:
+            name, satisfied_by = parse_requirement(requirement)
+            error = None
+        except ValueError as err:
+            name, satisfied_by, error = re.split(r"[^A-Za-z0-9._-]", requirement.strip(), 1)[0], None, str(err)
+
+        version = installed.get(normalize_name(name))
+        dependency = {
+                "requirement": requirement,
+                "name": name,
+                "installed": version,
+                "satisfied": version is not None and satisfied_by is not None and satisfied_by(version),
+        }
+        if error:
+            dependency["error"] = error
+        dependencies.append(dependency)
+
+    return {
+            "ok": all(dependency["satisfied"] for dependency in dependencies),
+            "paths": paths if paths is not None else list(sys.path),
+            "dependencies": dependencies,
+    }
+
+
+def paths_mtime(paths: list):
+    # Installing or removing a package adds or removes a '.dist-info' folder, which updates the folder's mtime:
+    return max((os.stat(path).st_mtime_ns for path in paths if os.path.isdir(path)), default=0)
+
+
+def cached_probe(requirements: list, paths: list, cache_path: str = None):
+    """
+    Same as 'probe', but the report is cached in memory and in 'cache_path' (JSON) keyed on the site-packages mtime,
+    so it is only rebuilt after packages were installed or removed.
+    """
+    key = tuple(paths) + tuple(requirements)
+    mtime = paths_mtime(paths)
+
+    if key in reports and reports[key][0] == mtime:
+        return reports[key][1]
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as infile:
+                cached = json.load(infile)
+            if cached["mtime"] == mtime and cached["key"] == list(key):
+                reports[key] = (mtime, cached["report"])
+                return cached["report"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    report = probe(requirements, paths)
+    reports[key] = (mtime, report)
+
+    if cache_path:
+        try:
+            with open(cache_path + ".tmp", "w") as outfile:
+                json.dump({"mtime": mtime, "key": list(key), "report": report}, outfile, indent=1)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError:
+            pass  # The cache is an optimisation only.
+
+    return report
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# NOTE: Standard library only, this runs inside the Venv as well as from Blender's own Python.
+
+# ======== Variables ======== #
+connections = 8  # Parallel HTTP range requests
+chunk_size = 16 * 1024 * 1024  # 16MB per range request
+buffer_size = 1024 * 1024  # 1MB reads from the network
+timeout = 60  # Seconds before a stalled connection is abandoned
+retries = 3  # Attempts per chunk
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def probe(url: str):
+    """
+    Returns (size, supports_ranges) for 'url', size is None if the server doesn't report it.
+    """
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if response.status == 206:
+            content_range = response.headers.get("Content-Range", "")  # "bytes 0-0/<size>"
+            size = content_range.rsplit("/", 1)[-1]
+            return (int(size), True) if size.isdigit() else (None, False)
+
+        size = response.headers.get("Content-Length")
+        return (int(size) if size else None), False
+
+
+class Progress(object):
+    """
+    Thread safe byte counter printing a progress bar with throughput and ETA to the console.
+    """
+
+    def __init__(self, total: int, done: int = 0, label: str = "Downloading"):
+        self.total = total
+        self.done = done
+        self.label = label
+        self.started = time.time()
+        self.start_done = done
+        self.last_print = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount: int):
+        with self.lock:
+            self.done += amount
+            if time.time() - self.last_print > 0.5 or self.done == self.total:
+                self.last_print = time.time()
+                self.print()
+
+    def throughput(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return (self.done - self.start_done) / elapsed
+
+    def print(self):
+        speed = self.throughput()
+        if self.total:
+            done = int(50 * self.done / self.total)
+            eta = (self.total - self.done) / speed if speed else float("inf")
+            sys.stdout.write(
+                    "\r%s [%s%s] %.1f/%.1f MB %.1f MB/s ETA %ds" % (
+                            self.label, '=' * done, ' ' * (50 - done), self.done / 1e6, self.total / 1e6, speed / 1e6,
+                            min(eta, 359999),
+                    )
+            )
+        else:
+            sys.stdout.write("\r%s %.1f MB %.1f MB/s" % (self.label, self.done / 1e6, speed / 1e6))
+        sys.stdout.flush()
+
+
+class OrderedHasher(object):
+    """
+    Hashes a file whose chunks complete out of order. Chunks are fed into the hash as soon as every chunk before them
+    is complete, re-reading them from the (still cached) part file, so the digest is ready the moment the last chunk
+    lands instead of requiring a second pass over the whole download.
+    """
+
+    def __init__(self, part_path: str, chunks: list):
+        self.part_path = part_path
+        self.chunks = chunks  # [(start, end), ...] in file order
+        self.completed = set()
+        self.next_chunk = 0
+        self.hash = hashlib.sha256()
+        self.lock = threading.Lock()
+
+    def complete(self, index: int):
+        with self.lock:
+            self.completed.add(index)
+            if self.next_chunk not in self.completed:
+                return
+
+            with open(self.part_path, "rb") as part_file:
+                while self.next_chunk in self.completed:
+                    start, end = self.chunks[self.next_chunk]
+                    part_file.seek(start)
+                    remaining = end - start + 1
+                    while remaining:
+                        data = part_file.read(min(buffer_size, remaining))
+                        self.hash.update(data)
+                        remaining -= len(data)
+                    self.next_chunk += 1
+
+    def hexdigest(self):
+        if self.next_chunk != len(self.chunks):
+            raise RuntimeError("Download incomplete, not every chunk has been hashed.")
+        return self.hash.hexdigest()
+
+
+def _download_range(url: str, part_path: str, start: int, end: int, progress: Progress):
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+
+    with urllib.request.urlopen(request, timeout=timeout) as response, open(part_path, "r+b") as part_file:
+        if response.status != 206:
+            raise ConnectionError(f"Server ignored range request for bytes {start}-{end}.")
+
+        part_file.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            data = response.read(min(buffer_size, remaining))
+            if not data:
+                raise ConnectionError(f"Connection closed with {remaining} bytes of bytes {start}-{end} missing.")
+            part_file.write(data)
+            remaining -= len(data)
+            progress.add(len(data))
+
+
+def _download_stream(url: str, dest_path: str):
+    """
+    Single connection fallback for servers without range support, can't be resumed.
+    """
+    digest = hashlib.sha256()
+
+    with urllib.request.urlopen(url, timeout=timeout) as response, open(dest_path + ".part", "wb") as part_file:
+        size = response.headers.get("Content-Length")
+        progress = Progress(total=int(size) if size else None)
+        while True:
+            data = response.read(buffer_size)
+            if not data:
+                break
+            part_file.write(data)
+            digest.update(data)
+            progress.add(len(data))
+
+    return digest.hexdigest()
+
+
+def download(url: str, dest_path: str, connections: int = connections, sha256: str = None):
+    """
+    Downloads 'url' to 'dest_path' over several parallel HTTP range requests. Progress is kept in '<dest_path>.part' and
+    '<dest_path>.part.json', so running the same download again after a crash or lost connection only fetches the
+    chunks that are missing. The file is hashed while it downloads.
+
+    :param connections: Number of parallel connections.
+    :param sha256: Expected SHA-256 hex digest, the download is deleted and ChecksumError raised on a mismatch.
+    :return: The SHA-256 hex digest of the downloaded file.
+    """
+    part_path = dest_path + ".part"
+    state_path = dest_path + ".part.json"
+    size, supports_ranges = probe(url)
+
+    if not supports_ranges or not size:
+        digest = _download_stream(url, dest_path)
+    else:
+        chunks = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+
+        # Resume from a previous attempt if it was downloading the same file:
+        state = {"url": url, "size": size, "chunk_size": chunk_size, "completed": []}
+        if os.path.exists(state_path) and os.path.exists(part_path):
+            with open(state_path) as infile:
+                previous = json.load(infile)
+            if all(previous.get(key) == state[key] for key in ("url", "size", "chunk_size")):
+                state["completed"] = previous["completed"]
+
+        if not state["completed"] or not os.path.exists(part_path):
+            with open(part_path, "wb") as part_file:
+                part_file.truncate(size)
+
+        hasher = OrderedHasher(part_path, chunks)
+        done = sum(chunks[i][1] - chunks[i][0] + 1 for i in state["completed"])
+        progress = Progress(total=size, done=done)
+        state_lock = threading.Lock()
+
+        if done:
+            print(f"Resuming download at {done / 1e6:.1f} MB")
+        for index in state["completed"]:
+            hasher.complete(index)
+
+        def fetch(index):
+            start, end = chunks[index]
+            for attempt in range(retries):
+                try:
+                    _download_range(url, part_path, start, end, progress)
+                    break
+                except OSError:
+                    if attempt == retries - 1:
+                        raise
+
+            hasher.complete(index)
+            with state_lock:
+                state["completed"].append(index)
+                with open(state_path + ".tmp", "w") as outfile:
+                    json.dump(state, outfile)
+                os.replace(state_path + ".tmp", state_path)
+
+        missing = [i for i in range(len(chunks)) if i not in set(state["completed"])]
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            for future in [executor.submit(fetch, index) for index in missing]:
+                future.result()
+
+        digest = hasher.hexdigest()
+
+    sys.stdout.write("\n")
+
+    if sha256 and digest != sha256.lower():
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise ChecksumError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+
+    os.replace(part_path, dest_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    return digest
@@ -0,0 +1,94 @@
+import os
+import time
+import threading
+
+# NOTE: Standard library only. UI code must never touch the file system on redraw, environment paths may live on
+# network drives. Panels read the cached state from here, the file system is only checked by 'refresh', which Blender
+# runs on a bpy.app.timers interval in a background thread.
+
+environment_folder = "Cozy-Auto-Texture-Files"
+
+
+class EnvironmentState(object):
+    """
+    In-memory registry of what is installed in each environment, keyed by the Environment Path the user picked (the
+    folder that contains "Cozy-Auto-Texture-Files").
+
+    :param sd_version: Name of the Stable Diffusion weights.
+    :param resolve_model_path: Callable 'resolve_model_path(environment_path)' returning where the environment's
+        weights live, inside the environment or in the shared model store.
+    """
+
+    def __init__(self, sd_version: str, resolve_model_path):
+        self.sd_version = sd_version
+        self.resolve_model_path = resolve_model_path
+        self.states = {}
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def probe(self, root: str):
+        """
+        Reads the state of one environment from disk.
+        """
+        environment_path = os.path.join(root, environment_folder)
+        exists = os.path.isdir(environment_path)
+        sd_path = self.resolve_model_path(environment_path) if exists else None
+        sha256_path = sd_path + ".sha256" if sd_path else None
+
+        weights = exists and sd_path is not None and os.path.isdir(sd_path)
+        weights_sha256 = None
+        if weights and os.path.exists(sha256_path):
+            with open(sha256_path) as infile:
+                weights_sha256 = infile.read().strip() or None
+
+        return {
+                "environment_path": environment_path,
+                "exists": exists,
+                "venv": exists and os.path.isdir(os.path.join(environment_path, "venv")),
+                "weights": weights,
+                "weights_path": sd_path if weights else None,
+                "weights_version": self.sd_version if weights else None,
+                "weights_sha256": weights_sha256,
+                "checked": time.time(),
+        }
+
+    def get(self, root: str):
+        """
+        Cached state of the environment in 'root'. Only the first lookup of a new root reads from disk.
+        """
+        state = self.states.get(root)
+        if state is None:
+            state = self.probe(root)
+            with self.lock:
+                self.states[root] = state
+        return state
+
+    def installed(self, root: str):
+        state = self.get(root)
+        return state["exists"] and state["venv"] and state["weights"]
+
+    def invalidate(self, root: str = None):
+        with self.lock:
+            if root is None:
+                self.states.clear()
+            else:
+                self.states.pop(root, None)
+
+    def refresh(self):
+        """
+        Re-reads every known environment. Safe to call from a background thread, lookups keep returning the previous
+        state until the new one is ready.
+        """
+        try:
+            for root in list(self.states):
+                state = self.probe(root)
+                with self.lock:
+                    self.states[root] = state
+        finally:
+            self.refreshing = False
+
+    def refresh_in_background(self):
+        if self.refreshing:
+            return
+        self.refreshing = True
+        threading.Thread(target=self.refresh, name="CozyAutoTextureEnvironmentState", daemon=True).start()
@@ -3,18 +3,33 @@ import bpy
 import os
 import sys
 import json
+import time
 import shutil
 import pathlib
 import platform
 import importlib
 import subprocess
+import urllib.parse
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from . import sd_worker
+from . import dependency_probe
+from . import downloader
+from .job_queue import JobQueue
+from .env_state import EnvironmentState
+from . import model_store
+from . import texture_library
 
 # ======== Variables ======== #
 # SD
 
 sd_version = "stable-diffusion-v1-4"
 sd_url = f"https://cozy-auto-texture-sd-repo.s3.us-east-2.amazonaws.com/{sd_version}.zip"
+sd_sha256 = None  # Expected SHA-256 of the weights zip, None skips verification.
+download_connections = 8  # Parallel connections used to download the weights
+trace_step_timings = False  # Record the duration of every denoising step in job traces
+sd_convert_fp16 = True  # Also store a pre-cast fp16 copy of the weights when converting them to safetensors
 
 # Dependencies
 
@@ -36,6 +51,11 @@ dependence_dict = {
 Dependency = namedtuple("Dependency", ["module", "name", "extra_params"])
 dependencies = [Dependency(module=i, name=None, extra_params=j) for i, j in dependence_dict.items()]
 dependencies_installed = False
+dependency_report = None  # Last result of are_dependencies_installed(), shown in the Help panel
+
+# Machine wide wheel cache shared by every environment and Blender version:
+wheel_cache = os.path.join(pathlib.Path.home(), ".cozy-auto-texture", "wheels")
+wheel_download_workers = 4  # Packages downloaded in parallel
 
 # Current size of final Environment folder including weights and dependencies in bytes:
 # TODO: Make this number dynamic based on the total "Cozy-Auto-Texture-Files" folder size.
@@ -49,6 +69,28 @@ current_drive = os.path.join(pathlib.Path.home().drive, os.sep)
 
 directory = os.path.dirname(os.path.realpath(__file__))
 path_log = os.path.join(directory, "..", "path_log.json")
+path_log_data = None  # Parsed path_log.json, False if it doesn't exist, None if not read yet
+
+# What is installed in each Environment Path, read by the UI instead of the file system:
+environment_state = EnvironmentState(sd_version=sd_version, resolve_model_path=lambda path: get_model_path(path))
+environment_state_interval = 5  # Seconds between background refreshes
+
+# Persistent Stable Diffusion workers, keyed by Venv path:
+workers = {}
+
+# Textures matching the library search of the main panel, updated when the search changes instead of on redraw:
+library_results = []
+library_search_limit = 20
+
+# Custom property holding the prompt of an object, or of its active material, for "Texture Selected Objects". Objects
+# without it are textured from the name of their active material:
+object_prompt_property = "cat_prompt"
+
+# Objects waiting for the textures of a "Texture Selected Objects" job, {job id: [[object name, ...] per record]}:
+pending_materials = {}
+
+# Handed over images whose files the worker is still writing in the background, {image path: job}:
+pending_saves = {}
 
 
 # ======== Helper functions ======== #
@@ -66,36 +108,54 @@ def execution_handler(venv_path: str, operation_function: str, user_input: dict,
     appropriate input variables.
     """
 
-    activate_bat_path = os.path.join(venv_path, 'Scripts', 'activate.bat')
-    python_exe_path = os.path.join(venv_path, 'Scripts', 'python.exe')
-    drive = pathlib.Path(activate_bat_path).drive
-
-    sd_interface_path = os.path.join(directory, "sd_interface.py")
-
-    # Get args from user_input:
-    args_string = " "
-    for arg_name, arg_value in user_input.items():  # user_input: {param_name: param_value}
-        args_string += f"""--{arg_name} "{arg_value}" """
-
-    commands = [
-            f"""{drive}""",  # Triple quotes so we can include double quotes in commands.
-            f"""
-            "{python_exe_path}" "{sd_interface_path}" {operation_function}{args_string} 
-            """,  # NOTE: "operation_function" is the name of the function in sd_interface.py given to the command line.
-    ]
+    if platform.system() not in ["Windows", "Darwin", "Linux"]:
+        raise OSError(
+                "OS not supported. Cozy Auto Texture only support Darwin, Linux, and Windows operating systems."
+        )
 
-    # Send commands to activate.bat
-    with open(activate_bat_path, "rt") as bat_in:
-        with open(activate_bat_path, "wt") as bat_out:
-            for line in bat_in:
-                bat_out.write(line)
+    # Spawning the interpreter and importing sd_interface.py's dependencies is paid on every call, see the worker
+    # ('get_worker') for anything run more than once:
+    started = time.perf_counter()
+    try:
+        sd_interface_path = os.path.join(directory, "sd_interface.py")
+
+        if platform.system() in ["Darwin", "Linux"]:
+            # There is no activate.bat outside of Windows, running the Venv's own Python is equivalent to activating it:
+            args = [get_venv_python(venv_path), sd_interface_path, operation_function]
+            for arg_name, arg_value in user_input.items():
+                args.extend([f"--{arg_name}", str(arg_value)])
+
+            if output:
+                return subprocess.check_output(args)
+            subprocess.run(args, check=True)
+            return
+
+        activate_bat_path = os.path.join(venv_path, 'Scripts', 'activate.bat')
+        python_exe_path = os.path.join(venv_path, 'Scripts', 'python.exe')
+        drive = pathlib.Path(activate_bat_path).drive
+
+        # Get args from user_input:
+        args_string = " "
+        for arg_name, arg_value in user_input.items():  # user_input: {param_name: param_value}
+            args_string += f"""--{arg_name} "{arg_value}" """
+
+        commands = [
+                f"""{drive}""",  # Triple quotes so we can include double quotes in commands.
+                f"""
+                "{python_exe_path}" "{sd_interface_path}" {operation_function}{args_string} 
+                """,  # NOTE: "operation_function" is the name of the function in sd_interface.py given to the command line.
+        ]
 
-            for line in commands:
-                bat_out.write(f"\n{line}")
+        # Send commands to activate.bat
+        with open(activate_bat_path, "rt") as bat_in:
+            with open(activate_bat_path, "wt") as bat_out:
+                for line in bat_in:
+                    bat_out.write(line)
 
-    # Run activate.bat, activate Venv:
-    if platform.system() == "Windows":
+                for line in commands:
+                    bat_out.write(f"\n{line}")
 
+        # Run activate.bat, activate Venv:
         if output:
             output = subprocess.check_output(
                     activate_bat_path,
@@ -105,20 +165,46 @@ def execution_handler(venv_path: str, operation_function: str, user_input: dict,
             subprocess.run(
                     activate_bat_path,
             )
-    elif platform.system() in ["Darwin", "Linux"]:
-        if output:
-            output = subprocess.check_output(
-                    args=["source", os.path.join(venv_path, "bin", "activate")],
-            )
-            return output
-        if not output:
-            subprocess.run(
-                    args=["source", os.path.join(venv_path, "bin", "activate")],
-            )
-    else:
-        raise OSError(
-                "OS not supported. Cozy Auto Texture only support Darwin, Linux, and Windows operating systems."
+
+    finally:
+        print(f"execution_handler '{operation_function}' took {time.perf_counter() - started:.2f}s")
+
+
+def get_venv_python(venv_path: str):
+    """
+    Returns the path of the Python executable inside the Venv, Windows places it in 'Scripts', Darwin and Linux in 'bin'.
+    """
+    if platform.system() == "Windows":
+        return os.path.join(venv_path, "Scripts", "python.exe")
+    return os.path.join(venv_path, "bin", "python")
+
+
+# Persistent worker handling:
+
+def get_worker(venv_path: str):
+    """
+    Returns the persistent sd_interface.py worker for 'venv_path'. The worker process is started on its first request
+    and restarted automatically if it crashes or stops answering its health check, so Stable Diffusion is only loaded
+    once per Blender session instead of once per texture.
+    """
+    if venv_path not in workers:
+        workers[venv_path] = sd_worker.WorkerClient(
+                python_exe=get_venv_python(venv_path),
+                script_path=os.path.join(directory, "sd_interface.py"),
         )
+    return workers[venv_path]
+
+
+def stop_workers():
+    job_queue.cancel_all()
+
+    for worker in workers.values():
+        worker.stop()
+    workers.clear()
+
+
+# Background generation jobs, shown in the main panel:
+job_queue = JobQueue(get_worker=get_worker)
 
 
 # Dependency handling:
@@ -128,46 +214,33 @@ def set_dependencies_installed(are_installed):
     dependencies_installed = are_installed
 
 
-# def are_dependencies_installed():
-#     # If dependency in 'dependencies' is not installed in Venv (if 'make_global') or not installed in Blender.
-#     does_venv_exist = os.path.exists(venv_path)
-#     modules_installed = True
-#
-#     if does_venv_exist:
-#         for dependency in dependencies:
-#             module_name = dependency.module_name
-#             extra_params = dependency.extra_params
-#
-#             if "make_global" not in extra_params:  # If module designated installation is Venv
-#                 user_input = {
-#                         "module_name": module_name
-#                 }
-#
-#                 # TODO: Output of 'execution_handler' needs to be verified that it outputs bool of check_imports()
-#                 #  return
-#                 # *Should work with new 'output = subprocess.check_output()' method
-#                 modules_installed = execution_handler(
-#                         venv_path=venv_path,
-#                         operation_function="check_imports",
-#                         user_input=user_input
-#                 )
-#
-#             else:  # If module designated installation is Blender
-#                 installed_modules = {pkg.key for pkg in pkg_resources.working_set}
-#
-#                 if module_name not in installed_modules:
-#                     modules_installed = False
-#
-#             if not modules_installed:
-#                 set_dependencies_installed(False)
-#                 return False
-#
-#     if not os.path.exists(sd_path):
-#         set_dependencies_installed(False)
-#         return False
-#
-#     set_dependencies_installed(True)
-#     return modules_installed
+def are_dependencies_installed(venv_path: str, cache_path: str = None):
+    """
+    Checks every entry of 'dependence_dict' in one pass with importlib.metadata, Venv dependencies against the Venv's
+    site-packages and "make_global" dependencies against Blender's Python, without starting a subprocess. The report
+    is cached on the site-packages mtime, see dependency_probe.cached_probe.
+
+    :return: The report, {"ok": bool, "dependencies": [{"requirement", "name", "installed", "satisfied"}, ...]}
+    """
+    venv_requirements = [i.module for i in dependencies if "make_global" not in i.extra_params]
+    global_requirements = [i.module for i in dependencies if "make_global" in i.extra_params]
+
+    report = dependency_probe.cached_probe(
+            requirements=venv_requirements,
+            paths=dependency_probe.venv_site_packages(venv_path),
+            cache_path=cache_path,
+    )
+
+    if global_requirements:
+        global_report = dependency_probe.probe(global_requirements)
+        report = {
+                "ok": report["ok"] and global_report["ok"],
+                "dependencies": report["dependencies"] + global_report["dependencies"],
+        }
+
+    global dependency_report
+    dependency_report = report
+    return report
 
 
 def install_pip():
@@ -206,12 +279,83 @@ def import_module(module_name):
         globals()[module_name] = importlib.import_module(module_name)
 
 
-def install_and_import_module(venv_path: str, ):
+def pip_requirements(dependency_list: list):
+    """
+    Requirements and pip options for installing 'dependency_list' with a single pip call. Extra params like
+    ["-f", "<url>"] are merged and de-duplicated so every index/find-links is available to one resolver pass.
+    """
+    requirements = []
+    options = []
+
+    for dependency in dependency_list:
+        requirements.append(dependency.module)
+
+        params = [param for param in dependency.extra_params if param != "make_global"]
+        for flag, value in zip(params[::2], params[1::2]):
+            if not any(options[i] == flag and options[i + 1] == value for i in range(0, len(options), 2)):
+                options.extend([flag, value])
+
+    return requirements, options
+
+
+def download_wheels(python_exe: str, requirements: list, options: list, wheel_dir: str):
+    """
+    Resolves all 'requirements' once with 'pip install --dry-run --report' and downloads every wheel of the resolution
+    that isn't already in 'wheel_dir', in parallel. Needs pip 22.2 or newer.
+
+    :raises: subprocess.CalledProcessError if pip can't produce a report.
+    """
+    os.makedirs(wheel_dir, exist_ok=True)
+    report_path = os.path.join(wheel_dir, f"report_{os.getpid()}.json")
+
+    try:
+        subprocess.run(
+                [python_exe, "-m", "pip", "install", "--dry-run", "--ignore-installed", "--quiet", "--report",
+                 report_path, "--find-links", wheel_dir] + options + requirements,
+                check=True,
+        )
+        with open(report_path) as infile:
+            report = json.load(infile)
+    finally:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+    downloads = []
+    for item in report.get("install", []):
+        url = item["download_info"]["url"]
+        if not url.startswith("http"):
+            continue  # Already a local file in the wheelhouse.
+
+        archive_info = item["download_info"].get("archive_info", {})
+        sha256 = archive_info.get("hashes", {}).get("sha256")
+        if sha256 is None and archive_info.get("hash", "").startswith("sha256="):
+            sha256 = archive_info["hash"][len("sha256="):]
+
+        wheel_path = os.path.join(wheel_dir, urllib.parse.unquote(url.rsplit("/", 1)[-1].split("#")[0]))
+        if not os.path.exists(wheel_path):
+            downloads.append((url, wheel_path, sha256))
+
+    print(f"Downloading {len(downloads)} packages ({len(report.get('install', [])) - len(downloads)} cached).")
+
+    with ThreadPoolExecutor(max_workers=wheel_download_workers) as executor:
+        futures = [
+                executor.submit(downloader.download, url=url, dest_path=wheel_path, connections=4, sha256=sha256)
+                for url, wheel_path, sha256 in downloads
+        ]
+        for future in futures:
+            future.result()
+
+
+def install_and_import_module(venv_path: str, wheelhouse: str = None):
     """
     Installs the package through pip and will attempt to import modules into the Venv, or if make_global = True import
     them globally.
-    :param import_global: Makes installed modules global if True, will not install imports to Venv. If false, modules
-        will only be installed to the Venv to be used with the Stable Diffusion libraries.
+
+    Venv dependencies are installed with a single pip resolver pass. The resolution's wheels are downloaded in parallel
+    into the machine wide 'wheel_cache', so later environments reuse them, then installed from there without touching
+    the package index again. With 'wheelhouse' set, a local directory of wheels, everything is installed offline from
+    that directory.
+    :param wheelhouse: Optional directory of pre-downloaded wheels for installing without network access.
     :raises: subprocess.CalledProcessError and ImportError
 
     Deprecated:
@@ -223,18 +367,45 @@ def install_and_import_module(venv_path: str, ):
        the global_name under which the module can be accessed.
     """
 
-    # TODO: Make this section compatible with Darwin and Linux, "Scripts" should be replaced with "bin"
+    venv_dependencies = [i for i in dependencies if "make_global" not in i.extra_params]
+    global_dependencies = [i for i in dependencies if "make_global" in i.extra_params]
 
-    print(f"Installing dependencies: {''.join([i.module for i in dependencies])}")
+    print(f"Installing dependencies: {', '.join([i.module for i in dependencies])}")
 
-    for dependency in dependencies:
-        module_name = dependency.module
-        extra_params = dependency.extra_params
-        make_global = False
+    # Venv dependencies:
+    python_exe = get_venv_python(venv_path)
+    requirements, options = pip_requirements(venv_dependencies)
+
+    if wheelhouse:
+        print(f"\nInstalling {', '.join(requirements)} to {venv_path} offline from {wheelhouse}.\n")
+        subprocess.run(
+                [python_exe, "-m", "pip", "install", "--no-index", "--find-links", wheelhouse] + requirements,
+                check=True,
+        )
+    else:
+        try:
+            subprocess.run([python_exe, "-m", "pip", "install", "--upgrade", "--quiet", "pip"], check=True)
+            download_wheels(python_exe, requirements=requirements, options=options, wheel_dir=wheel_cache)
+
+            print(f"\nInstalling {', '.join(requirements)} to {venv_path}.\n")
+            subprocess.run(
+                    [python_exe, "-m", "pip", "install", "--no-index", "--find-links", wheel_cache] + requirements,
+                    check=True,
+            )
+        except (subprocess.CalledProcessError, OSError) as err:
+            # Older pip without '--report', or a wheel that couldn't be fetched. Still one resolver pass, with pip's
+            # own cache pointed at the shared wheel cache:
+            print(f"\nParallel download failed ({err}), installing with pip directly.\n")
+            subprocess.run(
+                    [python_exe, "-m", "pip", "install", "--cache-dir", os.path.join(wheel_cache, "pip"),
+                     "--find-links", wheel_cache] + options + requirements,
+                    check=True,
+            )
 
-        if "make_global" in extra_params:
-            extra_params.remove("make_global")
-            make_global = True
+    # Global dependencies:
+    for dependency in global_dependencies:
+        module_name = dependency.module
+        extra_params = [param for param in dependency.extra_params if param != "make_global"]
 
         # Blender disables the loading of user site-packages by default. However, pip will still check them to determine
         # if a dependency is already installed. This can cause problems if the packages is installed in the user
@@ -249,43 +420,16 @@ def install_and_import_module(venv_path: str, ):
         environ_copy = dict(os.environ)
         environ_copy["PYTHONNOUSERSITE"] = "1"
 
-        install_commands_list = [
-                os.path.join(venv_path, "Scripts", "python"),
-                "-m",
-                "pip",
-                "install",
-                module_name
-        ]
-
-        if extra_params:
-            install_commands_list.extend(extra_params)
-
-        if not make_global:
-            print(f"\nInstalling {module_name} to {venv_path}.\n")
-            subprocess.run(
-                    install_commands_list,
-                    check=True,
-            )
-
-        if make_global:  # Doesn't work for some reason: No module named "Pillow"
-            print(f"\nInstalling {module_name} to {sys.executable}.\n")
-            install_commands_list[0] = sys.executable
-            subprocess.run(
-                    install_commands_list,
-                    check=True,
-                    env=environ_copy
-            )
-
-            # After installation succeeded, attempt to import the module globally:
-            import_module(module_name)
+        # Doesn't work for some reason: No module named "Pillow"
+        print(f"\nInstalling {module_name} to {sys.executable}.\n")
+        subprocess.run(
+                [sys.executable, "-m", "pip", "install", module_name] + extra_params,
+                check=True,
+                env=environ_copy
+        )
 
-    # Test global installation worked:
-    # try:
-    #     import PIL
-    #     print(f"{PIL.__version__}")
-    #     print("SUCCESSFULLY IMPORTED PIL GLOBALLY")
-    # except ImportError as err:
-    #     print(f"ERROR IMPORTING PIL:\n{err}")
+        # After installation succeeded, attempt to import the module globally:
+        import_module(module_name)
 
 
 # Other:
@@ -305,15 +449,28 @@ def check_drive_space(path: str = os.getcwd()):
         return False
 
 
-def read_path_log(check_exists: bool=False):
-    if check_exists:
-        if os.path.exists(path_log) and os.path.isfile(path_log):
-            return True
+def read_path_log(check_exists: bool = False):
+    """
+    Returns the contents of path_log.json, or with 'check_exists' whether it exists. The file is only read once, later
+    calls are answered from memory until 'create_path_log' writes a new log or 'invalidate_path_log' is called.
+    """
+    global path_log_data
+
+    if path_log_data is None:
+        if os.path.isfile(path_log):
+            with open(path_log) as infile:
+                path_log_data = json.load(infile)
         else:
-            return False
-    if not check_exists:
-        if os.path.exists(path_log) and os.path.isfile(path_log):
-            return json.load(open(path_log))
+            path_log_data = False
+
+    if check_exists:
+        return bool(path_log_data)
+    return path_log_data or None
+
+
+def invalidate_path_log():
+    global path_log_data
+    path_log_data = None
 
 
 def create_path_log(path: str, path_name=str):
@@ -323,4 +480,69 @@ def create_path_log(path: str, path_name=str):
     with open(path_log, 'w') as outfile:
         outfile.write(json_data + '\n')
 
+    invalidate_path_log()
+    environment_state.invalidate()
+
     return path_log
+
+
+def update_path_log(**entries):
+    """
+    Adds or replaces entries in path_log.json, keeping the rest of the log.
+    """
+    json_data = dict(read_path_log() or {})
+    json_data.update(entries)
+
+    with open(path_log, 'w') as outfile:
+        outfile.write(json.dumps(json_data, indent=1, ensure_ascii=True) + '\n')
+
+    invalidate_path_log()
+    environment_state.invalidate()
+
+
+def get_model_path(environment_path: str):
+    """
+    Where the 'sd_version' weights for 'environment_path' live. In order: the shared model store path recorded in
+    path_log.json, a copy inside the environment (older installs), the shared model store.
+    """
+    model_path = (read_path_log() or {}).get("model_paths", {}).get(sd_version)
+    if model_path and os.path.isdir(model_path):
+        return model_path
+
+    local_path = os.path.join(environment_path, sd_version)
+    if os.path.isdir(local_path):
+        return local_path
+
+    return model_store.lookup(sd_version) or local_path
+
+
+# Texture library:
+
+
+def search_library(save_path: str, text: str):
+    """
+    Searches the texture library of 'save_path' and stores the matches in 'library_results'. The library is only read,
+    a save path nothing was generated into yet has no library.
+    """
+    global library_results
+
+    if not os.path.exists(os.path.join(save_path, texture_library.library_name)):
+        library_results = []
+        return library_results
+
+    with texture_library.TextureLibrary(save_path) as library:
+        library_results = library.search(text, limit=library_search_limit)
+    return library_results
+
+
+def saved_texture(image_path: str):
+    """
+    The library record of 'image_path' once its file is complete, None while it is still being written. The worker only
+    indexes a texture saved in the background after its file was written.
+    """
+    save_path = os.path.dirname(image_path)
+    if not os.path.exists(os.path.join(save_path, texture_library.library_name)):
+        return None
+
+    with texture_library.TextureLibrary(save_path) as library:
+        return library.get(image_path)
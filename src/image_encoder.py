@@ -0,0 +1,95 @@
+import os
+import time
+import struct
+import concurrent.futures
+
+# NOTE: Only imported by sd_interface.py. Encodes generated images off the critical path, on a pool of threads: PIL's
+# zlib, libjpeg and libwebp encoders release the GIL, so threads compress in parallel without copying the images into
+# other processes. numpy is imported by 'write_exr' only.
+
+# PIL save options of each texture format per compression level. "fast" trades file size for encode time, "small" the
+# other way round, "default" is PIL's own default. A level a format leaves out falls back to "default": libjpeg has no
+# cheaper setting than its default Huffman tables and ".tga" is uncompressed by default. ".tga" and ".exr" are
+# uncompressed for pipelines that read textures more often than they write them:
+formats = {
+        ".png": {"fast": {"compress_level": 1}, "default": {}, "small": {"compress_level": 9, "optimize": True}},
+        ".jpg": {"default": {}, "small": {"optimize": True}},
+        ".webp": {
+                "fast": {"quality": 90, "method": 0},
+                "default": {"quality": 90},
+                "small": {"quality": 80, "method": 6},
+        },
+        ".tga": {"default": {}, "small": {"compression": "tga_rle"}},
+        ".exr": {"fast": {}, "default": {}, "small": {}},  # Uncompressed linear half floats, see 'write_exr'
+}
+compression_levels = ("fast", "default", "small")
+
+# Threads encoding in the background, each holds one image at a time:
+encoder_threads = 2
+pool = concurrent.futures.ThreadPoolExecutor(max_workers=encoder_threads)
+
+
+def write_exr(image, path: str):
+    """
+    Writes a PIL image as a single part, scanline, uncompressed OpenEXR file of linear half float RGBA. PIL can't write
+    EXR and the format's uncompressed layout is simple enough that no extra dependency is warranted.
+    """
+    import numpy
+
+    pixels = numpy.asarray(image.convert("RGBA"), dtype=numpy.float32) / 255
+    rgb = pixels[..., :3]
+    pixels[..., :3] = numpy.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)  # sRGB to linear
+    pixels = pixels.astype("<f2")
+    height, width = pixels.shape[:2]
+
+    def attribute(name: str, kind: str, value: bytes):
+        return name.encode() + b"\0" + kind.encode() + b"\0" + struct.pack("<i", len(value)) + value
+
+    channels = b"".join(name.encode() + b"\0" + struct.pack("<iB3xii", 1, 0, 1, 1) for name in "ABGR") + b"\0"
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = b"".join([
+            struct.pack("<iBxxx", 20000630, 2),  # Magic number, version 2 with no flags
+            attribute("channels", "chlist", channels),
+            attribute("compression", "compression", b"\0"),
+            attribute("dataWindow", "box2i", window),
+            attribute("displayWindow", "box2i", window),
+            attribute("lineOrder", "lineOrder", b"\0"),
+            attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0)),
+            attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0)),
+            attribute("screenWindowWidth", "float", struct.pack("<f", 1.0)),
+            b"\0",
+    ])
+
+    # One block per scanline: y, size, then every channel's row in the alphabetical channel order of the header:
+    line_size = width * 2 * 4
+    first_line = len(header) + 8 * height
+    offsets = struct.pack(f"<{height}Q", *(first_line + y * (8 + line_size) for y in range(height)))
+    with open(path, "wb") as outfile:
+        outfile.write(header + offsets)
+        for y in range(height):
+            outfile.write(struct.pack("<ii", y, line_size))
+            for channel in (3, 2, 1, 0):  # A, B, G, R
+                outfile.write(pixels[y, :, channel].tobytes())
+
+
+def encode(image, path: str, compression: str = "default"):
+    """
+    Writes a PIL image in the format of the extension of 'path'.
+
+    :return: {"seconds": encode and write time, "bytes": size of the file}
+    """
+    started = time.perf_counter()
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".exr":
+        write_exr(image, path)
+    else:
+        levels = formats.get(extension, {})
+        image.save(path, **levels.get(compression, levels.get("default", {})))
+    return {"seconds": time.perf_counter() - started, "bytes": os.path.getsize(path)}
+
+
+def submit(image, path: str, compression: str = "default"):
+    """
+    'encode' on the background pool, returns a concurrent.futures.Future of its result.
+    """
+    return pool.submit(encode, image, path, compression)
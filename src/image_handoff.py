@@ -0,0 +1,70 @@
+import os
+import glob
+import mmap
+import time
+import tempfile
+import contextlib
+
+# NOTE: Standard library only. Imported both by Blender (reading) and by the Venv Python (writing), like sd_worker.py.
+#
+# A generated image is handed to Blender as raw pixels instead of an encoded file. The worker writes the float32 RGBA
+# pixels, bottom row first like Blender stores them, into a file in shared memory (/dev/shm on Linux, the temp folder
+# elsewhere) and sends its description with the response:
+#   {"path": str, "width": int, "height": int}
+# Blender maps the file, copies the pixels into an image with a single 'pixels.foreach_set' and deletes the file.
+
+prefix = "cat_handoff_"
+
+# Seconds after which a handoff nobody read (e.g. Blender was closed while the job ran) is deleted:
+max_age = 3600
+
+
+def handoff_dir():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def remove_stale():
+    for path in glob.glob(os.path.join(handoff_dir(), prefix + "*")):
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass  # Read and deleted by Blender in the meantime
+
+
+def write(pixels, width: int, height: int):
+    """
+    :param pixels: Bytes-like object holding width * height float32 RGBA pixels, bottom row first.
+    :return: The description of the handoff for 'read'.
+    """
+    remove_stale()
+    descriptor, path = tempfile.mkstemp(prefix=prefix, suffix=".rgba", dir=handoff_dir())
+    with os.fdopen(descriptor, "wb") as outfile:
+        outfile.write(pixels)
+    return {"path": path, "width": width, "height": height}
+
+
+@contextlib.contextmanager
+def read(handoff: dict):
+    """
+    Maps a handoff written by 'write' and yields its pixels as a memoryview of floats, which 'pixels.foreach_set'
+    copies in bulk. The handoff is deleted afterwards.
+    """
+    try:
+        with open(handoff["path"], "rb") as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                pixels = memoryview(mapped).cast("f")
+                try:
+                    if len(pixels) != handoff["width"] * handoff["height"] * 4:
+                        raise ValueError(f"Handoff '{handoff['path']}' does not hold a {handoff['width']}x"
+                                         f"{handoff['height']} RGBA image.")
+                    yield pixels
+                finally:
+                    pixels.release()  # The map can't be closed while a view of it exists
+    finally:
+        try:
+            os.remove(handoff["path"])
+        except OSError:
+            pass
@@ -0,0 +1,238 @@
+import os
+import time
+import itertools
+import threading
+from collections import deque
+
+from . import sd_worker
+from . import job_trace
+
+# NOTE: Jobs run on a background thread, nothing in here may touch bpy. Blender reads the job list from its UI code and
+# picks up finished jobs from a bpy.app.timers callback on the main thread, see 'pop_finished'.
+
+# Job states:
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+FINISHED = "FINISHED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+
+
+class Job(object):
+    """
+    One request for the Stable Diffusion worker, e.g. a 'text2img' or 'text2img_batch' call.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, label: str, venv_path: str, command: str, kwargs: dict):
+        self.id = next(self.ids)
+        self.label = label
+        self.venv_path = venv_path
+        self.command = command
+        self.kwargs = kwargs
+
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = ""
+        self.trace = None
+        self.preview = None  # Latest latent preview sent by the worker, see sd_interface.latent_preview
+        self.preview_updated = False
+        self.submitted = time.time()
+        self.finished = None
+
+        self.cancel_event = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in (FINISHED, FAILED, CANCELLED)
+
+    def image_paths(self):
+        """
+        Paths of the images written by this job, 'text2img' returns a single path, 'text2img_batch' a list of records and
+        'text2img_sweep' a dict holding them. Images handed over through shared memory are not included, their files
+        may still be being written.
+        """
+        result = self.result
+        if isinstance(result, dict):
+            result = result.get("records")
+        if isinstance(result, str):
+            return [result]
+        if isinstance(result, list):
+            return [record["image_path"] for record in result if record.get("image_path")]
+        return []
+
+
+class JobQueue(object):
+    """
+    FIFO of worker jobs processed one at a time on a daemon thread, so Blender's UI stays responsive while Stable
+    Diffusion runs.
+
+    :param get_worker: Callable 'get_worker(venv_path)' returning a sd_worker.WorkerClient.
+    :param trace_dir: Folder the stage timings of every job are written to as '<submit time>-<job id>.json', None only
+        prints them to the console.
+    """
+
+    def __init__(self, get_worker, trace_dir: str = None):
+        self.get_worker = get_worker
+        self.trace_dir = trace_dir
+
+        self.jobs = []
+        self.pending = deque()
+        self.finished = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def submit(self, label: str, venv_path: str, command: str, **kwargs):
+        job = Job(label=label, venv_path=venv_path, command=command, kwargs=kwargs)
+
+        with self.lock:
+            self.jobs.append(job)
+            self.pending.append(job)
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="CozyAutoTextureJobs", daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+        return job
+
+    def get(self, job_id: int):
+        for job in self.jobs:
+            if job.id == job_id:
+                return job
+        return None
+
+    def cancel(self, job_id: int):
+        job = self.get(job_id)
+        if job is None or job.done:
+            return
+
+        job.cancel_event.set()
+        with self.lock:
+            if job in self.pending:
+                self.pending.remove(job)
+                self._finish(job, CANCELLED)
+
+    def cancel_all(self):
+        for job in list(self.jobs):
+            self.cancel(job.id)
+
+    def clear_finished(self):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if not job.done]
+
+    def pop_finished(self):
+        """
+        Jobs that finished since the last call, in the order they finished. Meant to be polled from the main thread.
+        """
+        finished = []
+        with self.lock:
+            while self.finished:
+                finished.append(self.finished.popleft())
+        return finished
+
+    @property
+    def active(self):
+        return any(not job.done for job in self.jobs)
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished = time.time()
+        if status == FINISHED:
+            job.progress = 1.0
+        self.finished.append(job)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                job = self.pending.popleft() if self.pending else None
+                if job is not None:
+                    job.status = RUNNING
+
+            if job is None:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            trace = job_trace.Trace(label=job.label)
+            trace.add("queued", time.time() - job.submitted)
+            worker_trace = {}
+
+            def on_event(message):
+                job.progress = message.get("progress", job.progress)
+                job.message = message.get("message", job.message)
+                if "trace" in message:
+                    worker_trace.update(message["trace"])
+                if "preview" in message:
+                    job.preview = message["preview"]
+                    job.preview_updated = True
+
+            try:
+                with trace.stage("worker_start"):  # Interpreter startup and imports, only paid by a cold worker
+                    worker = self.get_worker(job.venv_path)
+                    worker.ensure_running()
+                with trace.stage("request"):
+                    job.result = worker.request(
+                            job.command,
+                            on_event=on_event,
+                            cancel=job.cancel_event,
+                            **job.kwargs
+                    )
+                status = FINISHED
+            except sd_worker.JobCancelled:
+                status = CANCELLED
+            except Exception as err:
+                job.error = str(err)
+                status = FAILED
+                print(f"Cozy Auto Texture job '{job.label}' failed:\n{getattr(err, 'remote_traceback', '') or err}")
+
+            job.trace = self._finish_trace(job, trace, worker_trace, status)
+
+            with self.lock:
+                self._finish(job, status)
+
+    def _finish_trace(self, job: Job, trace: job_trace.Trace, worker_trace: dict, status: str):
+        """
+        Replaces the "request" stage with the stages timed inside the worker, the rest of the request is reported as
+        "transport" (socket round trip and JSON encoding). The trace of a job that didn't finish is marked with its
+        status and error, its stages end where the job stopped.
+        """
+        trace = trace.to_dict()
+        if worker_trace:
+            request = trace["stages"].pop()
+            trace["stages"].extend(worker_trace["stages"])
+            transport = max(0.0, request["seconds"] - worker_trace["total"])
+            trace["stages"].append({"name": "transport", "seconds": transport})
+            for key in ("steps", "rss_peak", "memory_budget", "over_budget", "prompt_cache"):
+                if key in worker_trace:
+                    trace[key] = worker_trace[key]
+        trace["command"] = job.command
+        trace["status"] = "ok" if status == FINISHED else status.lower()
+        if job.error:
+            trace["error"] = job.error
+
+        print(job_trace.report(trace))
+        self._write_trace(job, trace)
+        return trace
+
+    def _write_trace(self, job: Job, trace: dict):
+        if self.trace_dir:
+            try:
+                name = time.strftime("%Y%m%d-%H%M%S-", time.localtime(job.submitted)) + f"{job.id}.json"
+                job_trace.write(trace, os.path.join(self.trace_dir, name))
+            except OSError as err:
+                print(f"Could not write the trace of job '{job.label}': {err}")
+
+    def add_stage(self, job: Job, name: str, seconds: float, **extra):
+        """
+        Adds a stage that finished after the job, e.g. the background save of a handed over image, to its trace.
+        """
+        if job.trace is None:
+            return
+        job.trace["stages"].append({"name": name, "seconds": seconds, **extra})
+        job.trace["total"] += seconds
+        self._write_trace(job, job.trace)
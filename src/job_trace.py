@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# NOTE: Standard library only. Used by sd_interface.py to time the stages of a generation inside the worker, and by
+# job_queue.py to add the Blender side (worker startup, request round trip) before the trace is written to disk.
+#
+# A trace is a JSON object:
+#   {"label": str, "started": epoch seconds, "total": seconds,
+#    "stages": [{"name": str, "seconds": float, "rss": bytes, "rss_peak": bytes, "cuda_peak": bytes}, ...],
+#    "steps": [seconds, ...], "rss_peak": bytes, "memory_budget": bytes, "over_budget": bool,
+#    "prompt_cache": {"hits": int, "misses": int, ...}, "status": "ok" | "failed" | "cancelled", "error": str}
+# Memory fields are only present where they could be measured. 'rss_peak' is the high-water mark of the process up to
+# the end of the stage, 'cuda_peak' the peak allocated by torch during the stage. An "encode" stage also holds the
+# 'bytes' written.
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    # VmHWM can be reset between jobs (see reset_peak_rss), ru_maxrss is the peak over the life of the process:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Bytes on macOS, KB elsewhere
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS to the current RSS on Linux, so a long-lived worker reports the peak of each job rather than the
+    largest job it ever ran. Elsewhere the peak keeps covering the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def cuda():
+    # Only looked at if something else already imported torch, tracing must never pay for the import:
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+class Trace(object):
+    """
+    Wall-clock and peak memory timings of the stages of one job.
+    """
+
+    def __init__(self, label: str, step_timings: bool = False):
+        self.label = label
+        self.step_timings = step_timings
+        self.started = time.time()
+        self.stages = []
+        self.steps = []
+        self.last_step = None
+
+    def add(self, name: str, seconds: float, memory: bool = False, **extra):
+        stage = {"name": name, "seconds": seconds, **extra}
+        if memory:
+            stage.update({key: value for key, value in (("rss", current_rss()), ("rss_peak", peak_rss())) if value})
+        self.stages.append(stage)
+        return stage
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Times the body of the 'with' block as one stage, with the memory in use at its end.
+        """
+        cuda_module = cuda()
+        if cuda_module is not None:
+            cuda_module.reset_peak_memory_stats()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.add(name, time.perf_counter() - started, memory=True)
+            cuda_module = cuda_module or cuda()
+            if cuda_module is not None:
+                stage["cuda_peak"] = cuda_module.max_memory_allocated()
+
+    def step(self):
+        """
+        Called after every denoising step, records the duration of each step if 'step_timings' is enabled.
+        """
+        now = time.perf_counter()
+        if self.step_timings and self.last_step is not None:
+            self.steps.append(now - self.last_step)
+        self.last_step = now
+
+    def to_dict(self):
+        trace = {
+                "label": self.label,
+                "started": self.started,
+                "total": sum(stage["seconds"] for stage in self.stages),
+                "stages": self.stages,
+        }
+        if self.steps:
+            trace["steps"] = self.steps
+        return trace
+
+
+def summary(trace: dict):
+    """
+    One line summary of a trace, e.g. "12.31s: load_pipeline 4.10s, denoising 7.52s, ...".
+    """
+    stages = ", ".join(f"{stage['name']} {stage['seconds']:.2f}s" for stage in trace["stages"])
+    summary = f"{trace['total']:.2f}s: {stages}"
+    if trace.get("status", "ok") != "ok":
+        summary = f"{trace['status'].upper()} after " + summary
+    prompt_cache = trace.get("prompt_cache")
+    if prompt_cache and prompt_cache["hits"]:
+        summary += f", prompt cache {prompt_cache['hits']}/{prompt_cache['hits'] + prompt_cache['misses']} hits"
+    if trace.get("rss_peak"):
+        summary += f", peak RSS {trace['rss_peak'] / 1e9:.2f}GB" + (" OVER BUDGET" if trace.get("over_budget") else "")
+    return summary
+
+
+def report(trace: dict):
+    """
+    Multi-line report of a trace for the console, one row per stage with its share of the total and its memory.
+    """
+    lines = [f"Trace '{trace['label']}', {trace['total']:.3f}s"]
+    if trace.get("status", "ok") != "ok":
+        lines[0] += f", {trace['status'].upper()}: {trace.get('error', '')}"
+    if trace.get("rss_peak"):
+        lines[0] += f", peak RSS {trace['rss_peak'] / 1e9:.2f}GB"
+        if trace.get("memory_budget"):
+            lines[0] += f" of a {trace['memory_budget'] / 1e9:.2f}GB budget"
+    for stage in trace["stages"]:
+        memory = "  ".join(
+                f"{key} {stage[key] / 1e6:.0f}MB" for key in ("rss", "rss_peak", "cuda_peak") if stage.get(key)
+        )
+        if stage.get("bytes"):
+            memory = f"{stage['bytes'] / 1e6:.2f}MB written  " + memory
+        share = stage["seconds"] / trace["total"] if trace["total"] else 0
+        lines.append(f"{stage['seconds']:>9.3f}s  {share:>6.1%}  {stage['name']:<16}{memory}".rstrip())
+
+    prompt_cache = trace.get("prompt_cache")
+    if prompt_cache:
+        lines.append(
+                f"Prompt cache: {prompt_cache['hits']} hits, {prompt_cache['misses']} misses, "
+                f"{prompt_cache['entries']}/{prompt_cache['max_entries']} entries"
+        )
+
+    steps = trace.get("steps")
+    if steps:
+        lines.append(f"{len(steps)} steps after the first: mean {sum(steps) / len(steps):.3f}s, max {max(steps):.3f}s")
+    return "\n".join(lines)
+
+
+def write(trace: dict, path: str):
+    if os.path.dirname(path):  # A bare file name is written to the working directory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as outfile:
+        json.dump(trace, outfile, indent=1)
+    os.replace(path + ".tmp", path)
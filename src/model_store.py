@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import hashlib
+import pathlib
+
+# NOTE: Standard library only. One copy of each set of Stable Diffusion weights per machine, shared by every
+# environment and Blender version. Environments point at the store through path_log.json instead of holding a copy.
+#
+# Layout of 'store_root':
+#   index.json                 {name: {"hash": str, "path": str, "url": str}}
+#   <hash>/<name>/...          The weights, keyed by their content hash.
+#   <hash>/<name>.sha256       The content hash, read by env_state.py.
+#   .staging/<name>/...        Weights being downloaded, moved under their hash once complete.
+
+store_root = os.path.join(pathlib.Path.home(), ".cozy-auto-texture", "models")
+hash_buffer_size = 8 * 1024 * 1024
+
+
+def index_path(root: str = store_root):
+    return os.path.join(root, "index.json")
+
+
+def read_index(root: str = store_root):
+    try:
+        with open(index_path(root)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index(index: dict, root: str = store_root):
+    os.makedirs(root, exist_ok=True)
+    with open(index_path(root) + ".tmp", "w") as outfile:
+        json.dump(index, outfile, indent=1)
+    os.replace(index_path(root) + ".tmp", index_path(root))
+
+
+def content_hash(path: str):
+    """
+    SHA-256 over the relative path and contents of every file under 'path', independent of how the weights were
+    packaged or downloaded.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            digest.update(os.path.relpath(file_path, path).replace(os.sep, "/").encode("utf-8") + b"\0")
+            with open(file_path, "rb") as infile:
+                while True:
+                    data = infile.read(hash_buffer_size)
+                    if not data:
+                        break
+                    digest.update(data)
+    return digest.hexdigest()
+
+
+def lookup(name: str, root: str = store_root):
+    """
+    Path of the stored weights called 'name' (e.g. "stable-diffusion-v1-4"), or None if they aren't in the store.
+    """
+    entry = read_index(root).get(name)
+    if entry and os.path.isdir(entry["path"]):
+        return entry["path"]
+    return None
+
+
+def staging_path(name: str, root: str = store_root):
+    """
+    Folder to download 'name' into before it is added to the store. Left in place after an interrupted install so the
+    next attempt can resume.
+    """
+    path = os.path.join(root, ".staging", name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def add(name: str, weights_path: str, url: str = None, root: str = store_root):
+    """
+    Moves fully downloaded weights into the store under their content hash and registers them as 'name'. If weights
+    with the same hash are already stored the new copy is discarded.
+
+    :return: The stored weights path.
+    """
+    weights_hash = content_hash(weights_path)
+    stored_path = os.path.join(root, weights_hash, name)
+
+    if os.path.isdir(stored_path):
+        shutil.rmtree(weights_path)
+    else:
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        shutil.move(weights_path, stored_path)
+
+    with open(stored_path + ".sha256", "w") as outfile:
+        outfile.write(weights_hash + "\n")
+
+    index = read_index(root)
+    index[name] = {"hash": weights_hash, "path": stored_path, "url": url}
+    write_index(index, root)
+
+    return stored_path
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+
+# NOTE: Standard library only, the torch specific parts (loading pipelines and measuring them) are passed in by
+# sd_interface.py so this cache can be reused for any object that has a size.
+
+
+class PipelineCache(object):
+    """
+    LRU cache for loaded Stable Diffusion pipelines. Each entry is charged against the memory budget of the device it
+    lives on ('cpu' entries against RAM, everything else against VRAM), when a new entry would go over its budget the
+    least recently used entries on the same budget are evicted first. With an 'estimator' they are evicted before the
+    new entry is loaded, so the load itself stays within the budget instead of peaking at the old entries plus the new.
+
+    :param loader: Callable 'loader(key)' that builds the value for a key.
+    :param sizer: Callable 'sizer(value)' that returns the number of bytes a value holds.
+    :param budgets: {"ram": bytes, "vram": bytes}, a budget of 0 disables the limit.
+    :param estimator: Callable 'estimator(key)' that returns the bytes the value for a key will hold, before loading it.
+    :param on_evict: Callable 'on_evict(key)' run for every entry that is evicted or cleared, to drop anything kept
+        alongside the entry.
+    """
+
+    def __init__(self, loader, sizer, budgets: dict, estimator=None, on_evict=None):
+        self.loader = loader
+        self.sizer = sizer
+        self.budgets = dict(budgets)
+        self.estimator = estimator
+        self.on_evict = on_evict
+
+        self.entries = OrderedDict()  # {key: (value, size_in_bytes)}, oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def budget_name(key):
+        # Keys are (model_path, device, precision, ...)
+        return "ram" if key[1] == "cpu" else "vram"
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        self.misses += 1
+        if self.estimator is not None:
+            self.evict(self.budget_name(key), incoming=self.estimator(key))
+
+        value = self.loader(key)
+        size = self.sizer(value)
+
+        self.entries[key] = (value, size)
+        self.evict(self.budget_name(key), keep=key)  # In case the estimate was low
+        return value
+
+    def used(self, budget_name: str):
+        return sum(size for key, (_, size) in self.entries.items() if self.budget_name(key) == budget_name)
+
+    def evict(self, budget_name: str, keep=None, incoming: int = 0):
+        """
+        Drops least recently used entries on 'budget_name' until it fits its budget again, with room for 'incoming'
+        more bytes. 'keep' is never evicted, a single pipeline larger than the whole budget is still allowed so that
+        generation doesn't become impossible.
+        """
+        budget = self.budgets.get(budget_name, 0)
+        if not budget:
+            return
+
+        for key in list(self.entries):
+            if self.used(budget_name) + incoming <= budget:
+                break
+            if key == keep or self.budget_name(key) != budget_name:
+                continue
+            self.remove(key)
+            self.evictions += 1
+
+    def remove(self, key):
+        del self.entries[key]
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def set_budgets(self, **budgets):
+        self.budgets.update(budgets)
+        for budget_name in budgets:
+            self.evict(budget_name)
+
+    def clear(self):
+        for key in list(self.entries):
+            self.remove(key)
+
+    def stats(self):
+        return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": [
+                        {"key": list(key), "bytes": size} for key, (_, size) in self.entries.items()
+                ],
+                "used": {budget_name: self.used(budget_name) for budget_name in self.budgets},
+                "budgets": dict(self.budgets),
+        }
+
+
+class LRUCache(object):
+    """
+    LRU cache limited by number of entries, for small values where tracking bytes isn't worth it (e.g. prompt
+    embeddings).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """
+        Returns the value for 'key', calling 'loader()' to create it on a miss.
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        self.entries[key] = loader()
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return self.entries[key]
+
+    def discard(self, predicate):
+        """
+        Drops every entry whose key satisfies 'predicate(key)', e.g. the values derived from an evicted pipeline.
+        """
+        for key in [key for key in self.entries if predicate(key)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+        }
@@ -0,0 +1,123 @@
+import os
+import json
+import shutil
+import hashlib
+
+# NOTE: Standard library only.
+
+# Model fingerprints already computed by this process, {model_path: fingerprint}:
+fingerprints = {}
+
+
+def model_fingerprint(model_path: str):
+    """
+    Fingerprint of the weights in 'model_path', a hash of every file's relative path, size and modification time.
+    Re-hashing several GB of weights per request would cost more than most generations, while any re-download or
+    conversion of the weights changes the sizes/mtimes and with them the fingerprint.
+    """
+    if model_path in fingerprints:
+        return fingerprints[model_path]
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(model_path):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, model_path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+
+    fingerprints[model_path] = digest.hexdigest()
+    return fingerprints[model_path]
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of generated images. Each image is stored under the hash of every parameter that went into
+    generating it, so a repeated request can be answered without running Stable Diffusion. The least recently used
+    images are evicted once the cache grows over 'max_bytes'.
+
+    Layout of 'cache_dir':
+        <key><extension>  The cached image.
+        <key>.json        The generation parameters and the output paths this image was written to.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: float):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _image_path(self, key: str, extension: str):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def _meta_path(self, key: str):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _read_meta(self, key: str):
+        try:
+            with open(self._meta_path(key)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {"outputs": []}
+
+    def _write_meta(self, key: str, meta: dict):
+        with open(self._meta_path(key) + ".tmp", "w") as outfile:
+            json.dump(meta, outfile, indent=1)
+        os.replace(self._meta_path(key) + ".tmp", self._meta_path(key))
+
+    def get(self, key: str, extension: str):
+        """
+        Returns the cached image path for 'key' or None on a miss. A hit marks the entry as recently used.
+        """
+        image_path = self._image_path(key, extension)
+        if not os.path.exists(image_path):
+            return None
+
+        os.utime(image_path)
+        return image_path
+
+    def outputs(self, key: str):
+        """
+        Output paths this cached image was previously written to that still exist.
+        """
+        return [path for path in self._read_meta(key)["outputs"] if os.path.exists(path)]
+
+    def add_output(self, key: str, output_path: str):
+        meta = self._read_meta(key)
+        meta["outputs"] = [path for path in meta["outputs"] if os.path.exists(path)] + [output_path]
+        self._write_meta(key, meta)
+
+    def put(self, key: str, image_path: str, params: dict):
+        """
+        Stores a copy of the image at 'image_path' under 'key'. A copy rather than a link, so that editing or
+        overwriting the output texture can't change what the cache returns.
+        """
+        cached_path = self._image_path(key, os.path.splitext(image_path)[1])
+
+        shutil.copyfile(image_path, cached_path + ".tmp")
+        os.replace(cached_path + ".tmp", cached_path)
+
+        self._write_meta(key, {"params": params, "outputs": [image_path]})
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith(".json") or file.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, file))
+            entries.append((stat.st_mtime, stat.st_size, file))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            key = os.path.splitext(file)[0]
+            os.remove(os.path.join(self.cache_dir, file))
+            if os.path.exists(self._meta_path(key)):
+                os.remove(self._meta_path(key))
+            total -= size
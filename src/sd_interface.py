@@ -1,62 +1,740 @@
 import os
+import gc
 import sys
+import glob
+import json
+import time
+import base64
 import fire
-import zipfile
-import requests
-import pkg_resources
-from torch import autocast
-from diffusers import StableDiffusionPipeline
+import filecmp
+import contextlib
+import random
+import shutil
+import subprocess
 
+# NOTE: torch and diffusers take seconds to import, they are imported inside the functions that need
+# them so that control commands like 'check_imports' and 'import_stable_diffusion' start quickly. Check the import cost
+# of any command with '--profile-startup', e.g. 'python sd_interface.py check_imports numpy --profile-startup'.
 
-def uniquify(path):
+import sd_worker
+import downloader
+import zip_extract
+import job_trace
+import worker_pool
+import image_handoff
+import image_encoder
+import texture_library
+import dependency_probe
+from pipeline_cache import PipelineCache, LRUCache
+from result_cache import ResultCache, model_fingerprint
+
+# Torch dtypes selectable with the 'precision' argument:
+precisions = {
+        "fp32": "float32",
+        "fp16": "float16",
+}
+
+# diffusers scheduler classes selectable with the 'scheduler' argument, "default" keeps the one shipped with the model:
+schedulers = {
+        "default": None,
+        "pndm": "PNDMScheduler",
+        "ddim": "DDIMScheduler",
+        "lms": "LMSDiscreteScheduler",
+        "euler": "EulerDiscreteScheduler",
+        "euler_a": "EulerAncestralDiscreteScheduler",
+        "dpm": "DPMSolverMultistepScheduler",
+}
+
+# Memory budgets for resident pipelines in bytes, 0 disables the limit. Override with the CAT_RAM_BUDGET and
+# CAT_VRAM_BUDGET environment variables or the 'configure_cache' command:
+pipeline_budgets = {
+        "ram": int(float(os.environ.get("CAT_RAM_BUDGET", 8e+9))),  # 8GB
+        "vram": int(float(os.environ.get("CAT_VRAM_BUDGET", 6e+9))),  # 6GB
+}
+
+# Approximate working memory of generating one 512x512 fp16 image, used by auto_batch_size:
+image_memory = 1.5e+9  # 1.5GB
+max_batch_size = 8
+
+# Default size limit of the generated image cache in bytes:
+result_cache_size = 2e+9  # 2GB
+
+# Memory modes selectable with the 'memory_mode' argument, see 'enable_lean_memory':
+memory_modes = ("normal", "lean")
+
+# Overrides for 'draft=True', a quick preview for iterating on a prompt. A draft is refined by running the same prompt
+# and seed again without 'draft'. Drafts keep the full resolution: the initial noise is drawn per latent pixel, a
+# smaller draft would start from different noise than its refinement and end up with a different composition:
+draft_settings = {
+        "scheduler": "dpm",  # DPM-Solver++ converges in far fewer steps than the default PNDM scheduler
+        "steps": 15,
+}
+
+# Approximate RGB contribution of each of the 4 Stable Diffusion v1 latent channels, previews map latents to colours
+# with it instead of running the VAE decoder:
+latent_rgb_factors = [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+]
+
+# CPU execution paths selectable with the 'cpu_mode' argument, only used when rendering on the CPU:
+#   "default"         torch.autocast("cpu") like every other device.
+#   "optimized"       One thread per physical core, channels-last convolutions, bfloat16 autocast if the CPU has
+#                     native bfloat16 instructions and plain fp32 otherwise.
+#   "optimized_int8"  "optimized" with dynamic int8 quantization of the text encoder's and UNet's linear layers, always
+#                     fp32 outside of them.
+cpu_modes = ("default", "optimized", "optimized_int8")
+
+# Text encoder outputs kept for reuse, a seed sweep or a batch repeating a prompt only encodes it once:
+prompt_cache_size = 64  # About 0.25MB per fp32 entry
+
+# Precisions with a pre-cast copy of the weights written by 'convert_weights', loaded as a diffusers variant:
+weight_variants = {
+        "fp16": "fp16",
+}
+
+
+def uniquify(path, start: int = 0):
     """
-    Creates unique paths and increments file names to avoid overwriting images. Checks if paths exist, if it does,
-    increments file name with a given number to ensure it doesn't get overwritten.
+    Creates unique paths and increments file names to avoid overwriting images. The path is claimed by creating it with
+    O_EXCL, so generations saving to the same folder at the same time can never be given the same name.
     :param path:
-    :return:
+    :param start: First counter to try, "name (start)". Pass TextureLibrary.next_counter to skip the names already
+        taken instead of probing them one at a time.
+    :return: The claimed path, an empty file to overwrite with the texture inside 'with claimed(path):'.
     """
     filename, extension = os.path.splitext(path)
-    counter = 1
+    counter = start
+
+    while True:
+        candidate = path if counter == 0 else filename + " (" + str(counter) + ")" + extension
+        try:
+            os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return candidate
+        except FileExistsError:
+            counter += 1
+
+
+@contextlib.contextmanager
+def claimed(path: str):
+    """
+    Deletes a path claimed by 'uniquify' if the 'with' block writing it fails, so no empty file is left in the output
+    folder to show up in later library scans.
+    """
+    try:
+        yield path
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+
+
+def library_path(library: texture_library.TextureLibrary, output_path: str):
+    """
+    Claims a unique path for a new texture in the library's save directory.
+    """
+    return uniquify(output_path, start=library.next_counter(output_path))
+
+
+def has_safetensors(model_path: str, variant: str = None):
+    """
+    True if every component of the pipeline in 'model_path' has its weights in safetensors files ('convert_weights'),
+    or in the pre-cast 'variant' files if given.
+    """
+    pattern = f"*.{variant}.safetensors" if variant else "*.safetensors"
+    weight_folders = {
+            os.path.dirname(path)
+            for extension in ("*.bin", "*.safetensors")
+            for path in glob.glob(os.path.join(model_path, "*", extension))
+    }
+    return bool(weight_folders) and all(glob.glob(os.path.join(folder, pattern)) for folder in weight_folders)
+
+
+def from_pretrained_options(model_path: str, precision: str):
+    """
+    Keyword arguments for 'from_pretrained'. Converted weights are memory mapped from their safetensors files instead of
+    being unpickled into new allocations, with the pre-cast variant for the precision if one was written.
+    """
+    import torch
+
+    options = {"torch_dtype": getattr(torch, precisions[precision])}
+    if has_safetensors(model_path):
+        options["use_safetensors"] = True
+        variant = weight_variants.get(precision)
+        if variant and has_safetensors(model_path, variant=variant):
+            options["variant"] = variant
+    return options
+
+
+def estimate_pipeline_size(key: tuple):
+    """
+    Bytes a pipeline for a pipeline cache key is expected to hold once loaded, from the weight files 'build_pipeline'
+    reads: the pre-cast variant for the precision if there is one, otherwise the plain weights, which are stored as
+    fp32 and halved by loading them as fp16.
+    """
+    model_path, device, precision = key[:3]
+
+    variant = weight_variants.get(precision)
+    if variant and has_safetensors(model_path, variant=variant):
+        paths = glob.glob(os.path.join(model_path, "*", f"*.{variant}.safetensors"))
+        scale = 1
+    else:
+        extension = "safetensors" if has_safetensors(model_path) else "bin"
+        paths = [
+                path for path in glob.glob(os.path.join(model_path, "*", f"*.{extension}"))
+                if os.path.basename(path).count(".") == 1  # Not a variant, e.g. "model.fp16.safetensors"
+        ]
+        scale = 0.5 if precision == "fp16" else 1
+    return int(sum(os.path.getsize(path) for path in paths) * scale)
+
+
+def build_pipeline(key: tuple):
+    """
+    Loads a Stable Diffusion pipeline from disk for a pipeline cache key (model_path, device, precision, memory_mode,
+    cpu_mode). The scheduler isn't part of the key, see 'set_scheduler'.
+    """
+    import diffusers
+
+    model_path, device, precision, memory_mode, cpu_mode = key
+
+    if precision not in precisions:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {list(precisions)}")
+    if memory_mode not in memory_modes:
+        raise ValueError(f"Unknown memory mode '{memory_mode}', expected one of {list(memory_modes)}")
+    if cpu_mode not in cpu_modes:
+        raise ValueError(f"Unknown CPU mode '{cpu_mode}', expected one of {list(cpu_modes)}")
+
+    options = from_pretrained_options(model_path, precision)
+    if memory_mode == "lean":
+        options["low_cpu_mem_usage"] = True  # Weights are loaded straight into the model instead of a second copy
+
+    pipe = diffusers.StableDiffusionPipeline.from_pretrained(  # Specify model path
+            model_path,
+            **options,
+    )
+
+    if memory_mode == "lean":
+        enable_lean_memory(pipe, device)
+    else:
+        pipe = pipe.to(device)  # Specify render device
+
+    if cpu_mode != "default":
+        optimize_for_cpu(pipe, quantize=cpu_mode == "optimized_int8")
+
+    return pipe
+
+
+# The scheduler each cached pipeline was loaded with, {pipeline cache key: scheduler}:
+default_schedulers = {}
+
+
+def set_scheduler(pipe, key: tuple, scheduler: str):
+    """
+    Swaps the scheduler of a loaded pipeline in place. Schedulers hold no weights, so switching between them (e.g. from
+    a draft to its refinement) keeps using the loaded UNet, VAE and text encoder instead of loading another pipeline.
+    """
+    import diffusers
+
+    if scheduler not in schedulers:
+        raise ValueError(f"Unknown scheduler '{scheduler}', expected one of {list(schedulers)}")
+
+    default = default_schedulers.setdefault(key, pipe.scheduler)
+    if not schedulers[scheduler]:
+        pipe.scheduler = default
+        return
+
+    scheduler_class = getattr(diffusers, schedulers[scheduler])
+    if type(pipe.scheduler) is not scheduler_class:
+        pipe.scheduler = scheduler_class.from_config(default.config)
+
+
+def enable_lean_memory(pipe, device: str):
+    """
+    Lowers the peak memory of a pipeline by splitting up the work: attention is computed a slice at a time, the VAE
+    decodes one image at a time and in tiles (only for images over 512x512, the VAE's tile size), and on CUDA each
+    submodule is moved to the GPU only while it runs. On the CPU there is nowhere to offload to, the pipeline simply
+    stays in RAM. Sliced attention runs through a different attention processor, pixels differ slightly (a few levels
+    out of 255) from the same seed in normal mode.
+    """
+    pipe.enable_attention_slicing()
+
+    # Added in later diffusers versions:
+    for method in ("enable_vae_slicing", "enable_vae_tiling"):
+        if hasattr(pipe, method):
+            getattr(pipe, method)()
+
+    if device.startswith("cuda"):
+        pipe.enable_sequential_cpu_offload()  # Requires accelerate
+    else:
+        pipe.to(device)
+
+
+def physical_cores():
+    """
+    Number of physical CPU cores this process may run on, fewer than the machine has in a worker pinned to a core set.
+    Hyperthreads share a core's vector units, running a matmul thread on each of them only adds contention.
+    """
+    return len(worker_pool.cpu_cores()) or 1
+
+
+def cpu_supports_bf16():
+    """
+    True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), without them bfloat16 is emulated and slower
+    than fp32.
+    """
+    import torch
+
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return torch.backends.mkldnn.is_available() and ("avx512_bf16" in flags or "amx_bf16" in flags)
+
+
+def optimize_for_cpu(pipe, quantize: bool = False):
+    """
+    Converts the convolutional components to channels-last, the layout oneDNN's CPU convolutions run fastest in, and
+    optionally replaces the linear layers of the text encoder and UNet with dynamically quantized int8 versions.
+    """
+    import torch
 
-    while os.path.exists(path):
-        path = filename + " (" + str(counter) + ")" + extension
-        counter += 1
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
 
-    return path
+    if quantize:
+        for name in ("text_encoder", "unet"):
+            torch.quantization.quantize_dynamic(getattr(pipe, name), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@contextlib.contextmanager
+def execution_context(device: str, cpu_mode: str = "default", cpu_threads: int = 0):
+    """
+    Context manager a generation runs in, torch.autocast on the render device unless an optimized CPU path is used.
+    The torch thread count the optimized CPU paths set is restored on exit, so it doesn't leak into later requests of
+    a persistent worker.
+
+    :param cpu_threads: Torch threads for the optimized CPU paths, 0 uses one per physical core.
+    """
+    import torch
+
+    if device != "cpu" or cpu_mode == "default":
+        with torch.autocast(device):
+            yield
+        return
+
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(int(cpu_threads) or physical_cores())
+    try:
+        if cpu_mode == "optimized" and cpu_supports_bf16():
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                yield
+        else:
+            yield
+    finally:
+        torch.set_num_threads(previous_threads)
+
+
+def pipeline_size(pipe):
+    """
+    Bytes held by the parameters and buffers of every torch module in the pipeline.
+    """
+    import torch
+
+    size = 0
+    for component in vars(pipe).values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def make_latents(pipe, seeds: list, device: str, height: int, width: int):
+    """
+    Builds the initial noise for a batch with one generator per seed, so every image in a batch is identical to the image
+    the same seed produces on its own regardless of batch size or position.
+    """
+    import torch
+
+    shape = (1, pipe.unet.config.in_channels, height // 8, width // 8)
+    latents = [torch.randn(shape, generator=torch.Generator("cpu").manual_seed(seed)) for seed in seeds]
+    return torch.cat(latents).to(device=device, dtype=pipe.unet.dtype)
+
+
+def latent_preview(latents):
+    """
+    Preview of the first image in a batch of latents at 1/8 of the output resolution, one small matrix product instead
+    of a VAE decode.
+
+    :return: {"width": int, "height": int, "rgba": base64 of 8-bit RGBA pixels, top row first}
+    """
+    import torch
+
+    factors = torch.tensor(latent_rgb_factors, dtype=torch.float32)
+    rgb = ((latents[0].detach().float().cpu().permute(1, 2, 0) @ factors + 1) / 2).clamp(0, 1)
+    rgba = torch.cat([rgb, torch.ones_like(rgb[..., :1])], dim=-1)
+    pixels = (rgba * 255).round().to(torch.uint8).numpy().tobytes()
+    return {"width": rgba.shape[1], "height": rgba.shape[0], "rgba": base64.b64encode(pixels).decode("ascii")}
+
+
+def generate(
+        pipe,
+        prompts: list,
+        seeds: list,
+        device: str,
+        height: int = 512,
+        width: int = 512,
+        steps: int = 50,
+        on_step=None,
+        trace: job_trace.Trace = None,
+        cpu_mode: str = "default",
+        cpu_threads: int = 0,
+        on_preview=None,
+        preview_every: int = 0,
+        pipeline_key: tuple = None,
+):
+    """
+    Runs one denoising pass for a whole batch of prompts and returns one PIL image per prompt. After every denoising
+    step 'on_step(step)' is called and the worker job is checked for cancellation. 'cpu_mode' must match the one the
+    pipeline was loaded with.
+
+    :param on_preview: Called as 'on_preview(step, preview)' with a 'latent_preview' every 'preview_every' steps.
+    :param pipeline_key: Key of 'pipe' in 'pipelines', prompt embeddings are cached under it. None encodes every prompt
+        without caching.
+
+    :param trace: Receives the "text_encoding", "denoising" and "vae_decode" stages. The prompts are encoded before
+        the pipeline call, which runs the other two. They are split by the step callbacks.
+    """
+    import torch
+
+    latents = make_latents(pipe, seeds=seeds, device=device, height=height, width=width)
+
+    def callback(step, timestep, step_latents):
+        if trace is not None:
+            trace.step()
+        sd_worker.current_job.check_cancelled()
+        if on_step is not None:
+            on_step(step)
+        if on_preview is not None and preview_every and (step + 1) % preview_every == 0:
+            on_preview(step, latent_preview(step_latents))
+
+    started = time.perf_counter()
+    with execution_context(device, cpu_mode=cpu_mode, cpu_threads=cpu_threads):
+        # Encoded like the pipeline would, "" is the unconditional prompt of classifier-free guidance:
+        prompt_embeds = torch.cat([embed_prompt(pipe, prompt, device, pipeline_key) for prompt in prompts])
+        negative_embeds = embed_prompt(pipe, "", device, pipeline_key).expand(len(prompts), -1, -1)
+        encoded = time.perf_counter()
+
+        output = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                height=height,
+                width=width,
+                num_inference_steps=steps,
+                latents=latents,
+                callback=callback,
+                callback_steps=1,
+        )
+    finished = time.perf_counter()
+
+    if trace is not None:
+        last_step = trace.last_step or encoded
+        trace.add("text_encoding", encoded - started)
+        trace.add("denoising", last_step - encoded, steps=steps, batch_size=len(prompts))
+        trace.add("vae_decode", finished - last_step, memory=True)  # Includes the safety checker and PIL conversion
+
+    return output.images
+
+
+def encode_prompt(pipe, prompt: str, device: str):
+    """
+    Text encoder output for one prompt, the same tokenization and forward pass the pipeline runs for a prompt string.
+    """
+    import torch
+
+    tokens = pipe.tokenizer(
+            prompt,
+            padding="max_length",
+            max_length=pipe.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+    )
+    with torch.no_grad():
+        return pipe.text_encoder(tokens.input_ids.to(device))[0]
+
+
+def embed_prompt(pipe, prompt: str, device: str, pipeline_key: tuple = None):
+    """
+    'encode_prompt' through the 'prompt_embeddings' cache, keyed by the pipeline and the prompt.
+    """
+    if pipeline_key is None:
+        return encode_prompt(pipe, prompt, device)
+    return prompt_embeddings.get((pipeline_key, prompt), lambda: encode_prompt(pipe, prompt, device))
+
+
+def handoff_pixels(image):
+    """
+    Hands the pixels of a PIL image to Blender through shared memory, see image_handoff.py.
+    """
+    import numpy
+
+    pixels = numpy.asarray(image.convert("RGBA"))[::-1].astype(numpy.float32) / 255  # Bottom row first
+    return image_handoff.write(pixels, width=image.width, height=image.height)
+
+
+def defer(task, description: str):
+    """
+    Runs 'task' on the background encoder pool (see image_encoder.py) after the current command returned.
+    """
+    def log_error(future):
+        if future.exception() is not None:
+            print(f"Deferred {description} failed: {future.exception()}")
+
+    image_encoder.pool.submit(task).add_done_callback(log_error)
+
+
+def is_out_of_memory(err: Exception):
+    message = str(err).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def available_memory(device: str):
+    """
+    Bytes currently free on 'device', None if it can't be determined.
+    """
+    if device.startswith("cuda"):
+        import torch
+        free, total = torch.cuda.mem_get_info()
+        return free
+
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def auto_batch_size(device: str, precision: str, height: int, width: int):
+    """
+    Largest batch that should fit in free memory. Estimated from the activation footprint of one 512x512 image with
+    classifier free guidance, scaled by resolution and precision, and clamped to 'max_batch_size'.
+    """
+    free = available_memory(device)
+    if free is None:
+        return 1
+
+    per_image = image_memory * (height * width) / (512 * 512) * (2 if precision == "fp32" else 1)
+    return max(1, min(max_batch_size, int(free * 0.8 // per_image)))
+
+
+def open_result_cache(cache_dir: str, use_cache: bool, cache_size: float):
+    if not cache_dir or not use_cache:
+        return None
+    return ResultCache(cache_dir=cache_dir, max_bytes=cache_size)
+
+
+def result_params(
+        prompt: str,
+        seed: int,
+        model_path: str,
+        precision: str,
+        scheduler: str,
+        steps: int,
+        height: int,
+        width: int,
+        texture_format: str,
+        device: str,
+        cpu_mode: str,
+        memory_mode: str,
+        compression: str = "default",
+):
+    """
+    Everything that changes the saved image of a generation, hashed into its generated image cache key. Settings are
+    only included when they differ from their default, so entries cached before a setting existed stay valid.
+    """
+    params = {
+            "prompt": prompt,
+            "seed": seed,
+            "model": model_fingerprint(model_path),
+            "precision": precision,
+            "scheduler": scheduler,
+            "steps": steps,
+            "height": height,
+            "width": width,
+            "format": texture_format,
+    }
+    if device == "cpu" and cpu_mode != "default":
+        params["cpu_mode"] = cpu_mode  # bfloat16 and int8 change the output
+    if memory_mode != "normal":
+        params["memory_mode"] = memory_mode  # Sliced attention changes the output slightly
+    if compression != "default":
+        params["compression"] = compression  # Quality of lossy formats, file size of lossless ones
+    return params
+
+
+def reuse_cached(cache: ResultCache, key: str, output_path: str, library: texture_library.TextureLibrary):
+    """
+    Returns an output texture for a cached result, or None on a cache miss. If this result was already written next to
+    'output_path' and that file still holds the cached image byte for byte, it is returned as is. Otherwise, e.g. when
+    the earlier output was painted over, the cached image is copied to a new unique output path.
+    """
+    extension = os.path.splitext(output_path)[1]
+    cached_path = cache.get(key, extension)
+    if cached_path is None:
+        return None
+
+    name = os.path.basename(os.path.splitext(output_path)[0])
+    for path in cache.outputs(key):
+        stem, path_extension = os.path.splitext(os.path.basename(path))
+        if os.path.dirname(path) != os.path.dirname(output_path) or path_extension != extension:
+            continue
+        # "Wall.png" or "Wall (3).png" for "Wall", but never "Wall Tiles.png":
+        if name not in (stem, texture_library.split_counter(path)[0]):
+            continue
+        if filecmp.cmp(path, cached_path, shallow=False):
+            return path
+
+    image_path = library_path(library, output_path)
+    with claimed(image_path):
+        shutil.copyfile(cached_path, image_path)
+    cache.add_output(key, image_path)
+    return image_path
+
+
+def finish_trace(
+        trace: job_trace.Trace,
+        trace_path: str = None,
+        memory_budget: float = 0,
+        error: BaseException = None,
+):
+    """
+    Hands a finished trace to Blender as a progress event in worker mode, or prints it when run as a one-shot command.
+    The peak RSS since the trace started is checked against 'memory_budget' (bytes, 0 skips the check).
+
+    :param error: The exception the job failed with, the trace is then marked "failed" or "cancelled" and only covers
+        the stages that ran.
+    """
+    trace = trace.to_dict()
+    trace["status"] = "ok"
+    if error is not None:
+        trace["status"] = "cancelled" if isinstance(error, sd_worker.JobCancelled) else "failed"
+        trace["error"] = str(error) or type(error).__name__
+    trace["rss_peak"] = job_trace.peak_rss()
+    trace["prompt_cache"] = prompt_embeddings.stats()
+    if memory_budget:
+        trace["memory_budget"] = memory_budget
+        trace["over_budget"] = bool(trace["rss_peak"] and trace["rss_peak"] > memory_budget)
+        if trace["over_budget"]:
+            print(f"Peak RSS of {trace['rss_peak'] / 1e9:.2f}GB is over the {memory_budget / 1e9:.2f}GB memory budget.")
+    if trace_path:
+        job_trace.write(trace, trace_path)
+
+    if sd_worker.current_job.connection is None:
+        print(job_trace.report(trace))
+    elif error is None:
+        sd_worker.current_job.report(progress=1.0, message="Done", trace=trace)
+    else:
+        sd_worker.current_job.report(message=f"{trace['status'].capitalize()}: {trace['error']}", trace=trace)
+
+
+def forget_pipeline(key: tuple):
+    """
+    Drops what is kept for a pipeline outside the pipeline cache once it is evicted: its default scheduler and its
+    prompt embeddings, tensors on the pipeline's device.
+    """
+    default_schedulers.pop(key, None)
+    prompt_embeddings.discard(lambda embedding_key: embedding_key[0] == key)
+
+
+# Pipelines kept resident between requests in worker mode ('serve'). In a one-shot command the cache only lives for a
+# single generation:
+pipelines = PipelineCache(
+        loader=build_pipeline,
+        sizer=pipeline_size,
+        budgets=pipeline_budgets,
+        estimator=estimate_pipeline_size,
+        on_evict=forget_pipeline,
+)
+prompt_embeddings = LRUCache(max_entries=prompt_cache_size)
+
+
+def pipeline_key(model_path: str, device: str, precision: str, memory_mode: str, cpu_mode: str):
+    return model_path, device, precision, memory_mode, cpu_mode if device == "cpu" else "default"
+
+
+def load_pipeline(
+        model_path: str,
+        device: str,
+        precision: str = "fp32",
+        scheduler: str = "default",
+        memory_mode: str = "normal",
+        cpu_mode: str = "default",
+):
+    """
+    Returns the Stable Diffusion pipeline for the given settings, only loading it from disk on a cache miss. In lean
+    memory mode every other resident pipeline is freed before loading, so at most one pipeline is ever in memory.
+    """
+    key = pipeline_key(model_path, device, precision, memory_mode, cpu_mode)
+    if memory_mode == "lean" and key not in pipelines.entries:
+        pipelines.clear()
+        gc.collect()
+
+    pipe = pipelines.get(key)
+    set_scheduler(pipe, key, scheduler)
+    return pipe
 
 
 # ======== Command Line ======== #
 class SDInterfaceCommands(object):
-    def import_stable_diffusion(self, sd_path: str, sd_url: str, environment_path: str):
+    def import_stable_diffusion(
+            self,
+            sd_path: str,
+            sd_url: str,
+            environment_path: str,
+            connections: int = downloader.connections,
+            sha256: str = None,
+    ):
         """
         Imports Stable Diffusion from the 'sd_url' as a zip file, then unzips SD.
+
+        If the server supports range requests and no 'sha256' is given, the zip is never stored: its entries are
+        streamed and extracted in parallel straight from the central directory, each entry verified by its CRC-32. An
+        interrupted install skips the entries that were already extracted.
+
+        Otherwise the zip is downloaded over 'connections' parallel range requests (resuming where it left off),
+        verified against 'sha256' if given, extracted in parallel and removed. The digest is saved next to the weights
+        as '<sd_path>.sha256'.
         """
 
+        size, supports_ranges = downloader.probe(sd_url)
+
+        if supports_ranges and not sha256:
+            unzipped_path = os.path.join(
+                    environment_path,
+                    zip_extract.extract_remote(url=sd_url, dest_dir=environment_path, size=size, workers=connections)
+            )
+
+            print(f"Stable Diffusion streamed, unzipped, and installed at:\n{unzipped_path}")
+            return unzipped_path
+
         # Download zip file
         zip_path = sd_path + ".zip"
 
-        with open(zip_path, 'wb+') as file:
-            r = requests.get(sd_url, stream=True)
-            total_length = r.headers.get('content-length')
-
-            if total_length is None:  # no content length header
-                file.write(r.content)
-            else:
-                dl = 0
-                total_length = int(total_length)
-                for data in r.iter_content(chunk_size=4096):
-                    dl += len(data)
-                    file.write(data)
-                    done = int(50 * dl / total_length)
-                    sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50 - done)))
-                    sys.stdout.flush()
-
-        # TODO: Add unzipping progress bar
-        # Unzip file
-        unzipped_path = os.path.join(environment_path, zipfile.ZipFile(zip_path).namelist()[0])
+        digest = downloader.download(url=sd_url, dest_path=zip_path, connections=connections, sha256=sha256)
+
+        with open(sd_path + ".sha256", "w") as outfile:
+            outfile.write(digest + "\n")
 
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(environment_path)
+        # Unzip file
+        unzipped_path = os.path.join(
+                environment_path,
+                zip_extract.extract_local(zip_path=zip_path, dest_dir=environment_path, workers=connections)
+        )
 
         os.remove(zip_path)
 
@@ -64,6 +742,150 @@ class SDInterfaceCommands(object):
 
         return unzipped_path
 
+    def convert_weights(self, model_path: str, fp16: bool = True, keep_pickled: bool = False):
+        """
+        Rewrites the weights in 'model_path' as safetensors, which later loads memory map instead of unpickling into
+        new allocations. Run once after 'import_stable_diffusion', converted weights are skipped.
+
+        :param fp16: Also write a pre-cast fp16 copy, loaded as the "fp16" variant by 'precision="fp16"'.
+        :param keep_pickled: Keep the original '.bin' files next to the safetensors files.
+        :return: The converted weights path.
+        """
+        import torch
+        import diffusers
+
+        if has_safetensors(model_path) and (not fp16 or has_safetensors(model_path, variant=weight_variants["fp16"])):
+            print(f"Weights already converted:\n{model_path}")
+            return model_path
+
+        # Written next to the weights and swapped in once complete, an interrupted conversion leaves them untouched:
+        converted_path = model_path + ".converting"
+        shutil.rmtree(converted_path, ignore_errors=True)
+
+        pipe = diffusers.StableDiffusionPipeline.from_pretrained(model_path, torch_dtype=torch.float32)
+        pipe.save_pretrained(converted_path, safe_serialization=True)
+
+        if fp16:
+            for component in vars(pipe).values():
+                if isinstance(component, torch.nn.Module):
+                    component.to(dtype=torch.float16)
+            pipe.save_pretrained(converted_path, safe_serialization=True, variant=weight_variants["fp16"])
+        del pipe
+
+        # Carry over files save_pretrained doesn't write, and the pickled weights if they are kept:
+        for root, dirs, files in os.walk(model_path):
+            for file in files:
+                if file.endswith(".bin") and not keep_pickled:
+                    continue
+                target = os.path.join(converted_path, os.path.relpath(os.path.join(root, file), model_path))
+                if not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(os.path.join(root, file), target)
+
+        os.replace(model_path, model_path + ".pickled")
+        os.replace(converted_path, model_path)
+        shutil.rmtree(model_path + ".pickled")
+
+        print(f"Weights converted to safetensors at:\n{model_path}")
+        return model_path
+
+    def benchmark_load(self, model_path: str, repeats: int = 3):
+        """
+        Times loading the pipeline on the CPU from each weight format present in 'model_path': pickled '.bin' files,
+        memory mapped safetensors, and the pre-cast fp16 safetensors variant. The first load of each format also pays
+        for reading the files from disk, the best of 'repeats' loads is the warm page cache time.
+
+        :return: {format: {"best": seconds, "mean": seconds, "loads": [seconds, ...]}}
+        """
+        import torch
+        import diffusers
+
+        formats = {}
+        if glob.glob(os.path.join(model_path, "*", "*.bin")):
+            formats["pickle"] = {"torch_dtype": torch.float32, "use_safetensors": False}
+        if has_safetensors(model_path):
+            formats["safetensors"] = {"torch_dtype": torch.float32, "use_safetensors": True}
+        if has_safetensors(model_path, variant=weight_variants["fp16"]):
+            formats["safetensors_fp16"] = {
+                    "torch_dtype": torch.float16,
+                    "use_safetensors": True,
+                    "variant": weight_variants["fp16"],
+            }
+
+        results = {}
+        for name, options in formats.items():
+            loads = []
+            for _ in range(max(1, int(repeats))):
+                started = time.perf_counter()
+                pipe = diffusers.StableDiffusionPipeline.from_pretrained(model_path, **options).to("cpu")
+                loads.append(time.perf_counter() - started)
+                del pipe
+
+            results[name] = {"best": min(loads), "mean": sum(loads) / len(loads), "loads": loads}
+            print(f"{name:>16}: best {min(loads):.2f}s, mean {sum(loads) / len(loads):.2f}s over {len(loads)} loads")
+
+        return results
+
+    def compare_cpu_modes(
+            self,
+            model_path: str,
+            prompt: str = "seamless mossy cobblestone texture",
+            seed: int = 0,
+            steps: int = 20,
+            modes: list = cpu_modes,
+            cpu_threads: int = 0,
+            save_path: str = None,
+    ):
+        """
+        Quality/speed report of the CPU execution paths: renders the same prompt and seed with each mode in 'modes' and
+        compares it to the first one (the "default" path). Pipeline loading is not timed.
+
+        :param save_path: Also save each mode's image to '<save_path>/cpu_mode_<mode>.png' for a visual comparison.
+        :return: {mode: {"seconds", "speedup", "psnr", "max_difference"}}, PSNR in dB against the first mode.
+        """
+        import numpy
+
+        results = {}
+        reference = None
+        for mode in modes:
+            pipe = load_pipeline(model_path=model_path, device="cpu", cpu_mode=mode)
+
+            started = time.perf_counter()
+            image = generate(
+                    pipe,
+                    prompts=[prompt],
+                    seeds=[int(seed)],
+                    device="cpu",
+                    steps=steps,
+                    cpu_mode=mode,
+                    cpu_threads=cpu_threads,
+            )[0]
+            seconds = time.perf_counter() - started
+
+            pixels = numpy.asarray(image, dtype=numpy.float64)
+            if reference is None:
+                reference = (pixels, seconds)
+            mse = float(numpy.mean((pixels - reference[0]) ** 2))
+            results[mode] = {
+                    "seconds": seconds,
+                    "speedup": reference[1] / seconds,
+                    "psnr": float("inf") if mse == 0 else 10 * numpy.log10(255 ** 2 / mse),
+                    "max_difference": float(numpy.max(numpy.abs(pixels - reference[0]))),
+            }
+
+            if save_path:
+                image.save(os.path.join(save_path, f"cpu_mode_{mode}.png"))
+            pipelines.clear()  # Only one CPU pipeline in RAM at a time
+
+        print(f"{'mode':<16}{'seconds':>9}{'speedup':>9}{'PSNR':>9}{'max diff':>10}")
+        for mode, result in results.items():
+            print(
+                    f"{mode:<16}{result['seconds']:>8.1f}s{result['speedup']:>8.2f}x{result['psnr']:>7.1f}dB"
+                    f"{result['max_difference']:>10.0f}"
+            )
+
+        return results
+
     def text2img(
             self,
             texture_name: str,
@@ -71,33 +893,525 @@ class SDInterfaceCommands(object):
             save_path: str,
             texture_format: str,
             model_path: str,
-            device: str
+            device: str,
+            precision: str = "fp32",
+            scheduler: str = "default",
+            seed: int = None,
+            steps: int = 50,
+            cache_dir: str = None,
+            use_cache: bool = True,
+            cache_size: float = result_cache_size,
+            step_timings: bool = False,
+            trace_path: str = None,
+            memory_mode: str = "normal",
+            memory_budget: float = 0,
+            cpu_mode: str = "default",
+            cpu_threads: int = 0,
+            height: int = 512,
+            width: int = 512,
+            draft: bool = False,
+            preview_every: int = 0,
+            handoff: bool = False,
+            save: bool = True,
+            compression: str = "default",
     ):
         """
         Main function to control Blender/Stable Diffusion text to image bridge.
-        :return:
+
+        :param cache_dir: Folder of the generated image cache, a request with the same parameters, seed and model
+            weights as a cached one returns the cached image without running Stable Diffusion. None or 'use_cache'
+            False bypasses the cache.
+        :param step_timings: Record the duration of every denoising step in the trace.
+        :param trace_path: Write the stage timings (see job_trace.py) to this JSON file. In worker mode the trace is
+            also sent to Blender with the last progress event.
+        :param memory_mode: "normal", or "lean" to trade some speed for a lower peak memory, see 'enable_lean_memory'.
+            Lean images differ slightly from normal ones of the same seed and are cached separately.
+        :param memory_budget: Bytes the peak RSS of this generation should stay under, reported in the trace.
+        :param cpu_mode: CPU execution path when 'device' is "cpu", see 'cpu_modes'. Compare their speed and output
+            with the 'compare_cpu_modes' command.
+        :param cpu_threads: Torch threads for the optimized CPU paths, 0 uses one per physical core.
+        :param draft: Render a quick preview with 'draft_settings' instead of 'scheduler' and 'steps', saved as
+            "<texture_name> draft". Refine it by running the same prompt and seed without 'draft', the loaded pipeline
+            is reused.
+        :param preview_every: Send a low resolution preview of the image being denoised to Blender every
+            'preview_every' steps, 0 disables previews.
+        :param handoff: Hand the raw pixels to Blender through shared memory (see image_handoff.py) instead of making
+            it decode the saved file. The image is then saved after the response was sent, and only if 'save' is True.
+        :param compression: "fast", "default" or "small", see 'image_encoder.formats'. The "encode" stage of the trace
+            holds the time and bytes written.
+        :return: The path of the saved image, or {"name": str, "image_path": str or None, "handoff": dict} with
+            'handoff'. A cached texture is always returned as a path.
         """
 
-        pipe = StableDiffusionPipeline.from_pretrained(model_path)  # Specify model path
-        pipe = pipe.to(device)  # Specify render device
+        if draft:
+            scheduler, steps = draft_settings["scheduler"], draft_settings["steps"]
+            texture_name += " draft"
+
+        job_trace.reset_peak_rss()
+        trace = job_trace.Trace(label=texture_name, step_timings=step_timings)
+        error = None
+        try:
+            if seed is None or int(seed) < 0:
+                seed = random.randrange(2 ** 32)
+
+            output_path = os.path.join(save_path, texture_name) + texture_format
+            params = result_params(
+                    prompt=texture_prompt,
+                    seed=int(seed),
+                    model_path=model_path,
+                    precision=precision,
+                    scheduler=scheduler,
+                    steps=steps,
+                    height=height,
+                    width=width,
+                    texture_format=texture_format,
+                    device=device,
+                    cpu_mode=cpu_mode,
+                    memory_mode=memory_mode,
+                    compression=compression,
+            )
+            with texture_library.TextureLibrary(save_path) as library:
+
+                def add_to_library(image_path, target=library, encoded=None):
+                    timings = {stage["name"]: stage["seconds"] for stage in trace.stages}
+                    if encoded is not None:
+                        timings["encode"] = encoded["seconds"]
+                        timings["encode_bytes"] = encoded["bytes"]
+                    target.add(
+                            image_path,
+                            prompt=texture_prompt,
+                            seed=int(seed),
+                            model=os.path.basename(model_path),
+                            params=params,
+                            timings=timings,
+                    )
+
+                cache = open_result_cache(cache_dir=cache_dir, use_cache=use_cache, cache_size=cache_size)
+                if cache is not None:
+                    with trace.stage("cache_lookup"):
+                        key = cache.key(**params)
+                        cached_path = reuse_cached(cache, key=key, output_path=output_path, library=library)
+                    if cached_path is not None:
+                        add_to_library(cached_path)
+                        return cached_path
+
+                with trace.stage("load_pipeline"):
+                    pipe = load_pipeline(
+                            model_path=model_path,
+                            device=device,
+                            precision=precision,
+                            scheduler=scheduler,
+                            memory_mode=memory_mode,
+                            cpu_mode=cpu_mode,
+                    )
+
+                # PNDM, the default scheduler, runs 'steps' + 1 timesteps, its last step index is 'steps':
+                def on_step(step):
+                    step = min(step + 1, steps)
+                    sd_worker.current_job.report(progress=step / steps, message=f"Step {step}/{steps}")
+
+                def on_preview(step, preview):
+                    step = min(step + 1, steps)
+                    sd_worker.current_job.report(progress=step / steps, message=f"Step {step}/{steps}", preview=preview)
+
+                image = generate(
+                        pipe,
+                        prompts=[texture_prompt],
+                        seeds=[int(seed)],
+                        device=device,
+                        height=height,
+                        width=width,
+                        steps=steps,
+                        on_step=on_step,
+                        trace=trace,
+                        cpu_mode=cpu_mode,
+                        cpu_threads=cpu_threads,
+                        on_preview=on_preview,
+                        preview_every=preview_every,
+                        pipeline_key=pipeline_key(model_path, device, precision, memory_mode, cpu_mode),
+                )[0]
+
+                if handoff:
+                    with trace.stage("handoff"):
+                        result = {"name": texture_name, "image_path": None, "handoff": handoff_pixels(image)}
+                    if not save:
+                        return result
 
-        with autocast(device):
-            image = pipe(texture_prompt)["sample"][0]
+                    image_path = result["image_path"] = library_path(library, output_path)
 
-        image_path = uniquify(os.path.join(save_path, texture_name) + texture_format)
-        image.save(image_path)
+                    def save_deferred():
+                        with claimed(image_path):
+                            encoded = image_encoder.encode(image, image_path, compression=compression)
+                        print(f"Encoded '{image_path}' in {encoded['seconds']:.2f}s, {encoded['bytes'] / 1e6:.2f}MB")
+                        if cache is not None:
+                            cache.put(key, image_path=image_path, params=params)
+                        # Indexed last, Blender takes the library record as the sign that the file is complete. SQLite
+                        # connections are per thread:
+                        with texture_library.TextureLibrary(save_path) as deferred_library:
+                            add_to_library(image_path, target=deferred_library, encoded=encoded)
 
-        return image_path
+                    defer(save_deferred, f"save of '{image_path}'")
+                    return result
+
+                image_path = library_path(library, output_path)
+                with claimed(image_path):
+                    encoded = image_encoder.encode(image, image_path, compression=compression)
+                trace.add("encode", encoded["seconds"], bytes=encoded["bytes"])
+
+                if cache is not None:
+                    with trace.stage("save"):
+                        cache.put(key, image_path=image_path, params=params)
+
+                add_to_library(image_path)
+                return image_path
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            finish_trace(trace, trace_path, memory_budget=memory_budget, error=error)
+
+    def text2img_batch(
+            self,
+            records,
+            save_path: str,
+            texture_format: str,
+            model_path: str,
+            device: str,
+            precision: str = "fp32",
+            scheduler: str = "default",
+            batch_size: int = 0,
+            height: int = 512,
+            width: int = 512,
+            steps: int = 50,
+            cache_dir: str = None,
+            use_cache: bool = True,
+            cache_size: float = result_cache_size,
+            memory_mode: str = "normal",
+            cpu_mode: str = "default",
+            cpu_threads: int = 0,
+            compression: str = "default",
+    ):
+        """
+        Generates many textures with one pipeline, running each denoising step once per batch of prompts instead of
+        once per prompt. Records found in the generated image cache (see 'text2img') are not generated again.
+
+        :param records: List of {"name": str, "prompt": str, "seed": int} dicts, or the path of a JSON file holding
+            that list. A missing or negative seed picks a random one.
+        :param batch_size: Prompts per batch, 0 picks the largest batch that fits in free memory. Batches that run out
+            of memory are halved and retried.
+        :param memory_mode: See 'text2img'.
+        :param cpu_mode: See 'text2img'.
+        :param cpu_threads: See 'text2img'.
+        :param compression: See 'text2img'. A batch is encoded in the background while the next one is generated.
+        :return: The records, each with the "seed" used, the saved "image_path" and, unless it came from the cache, its
+            "encode" {"seconds", "bytes"}.
+        """
+
+        if isinstance(records, str):
+            with open(records) as infile:
+                records = json.load(infile)
+
+        records = [dict(record) for record in records]
+        for record in records:
+            if record.get("seed") is None or int(record["seed"]) < 0:
+                record["seed"] = random.randrange(2 ** 32)
+            record["seed"] = int(record["seed"])
+
+        with texture_library.TextureLibrary(save_path) as library:
+
+            def add_to_library(record, timings):
+                library.add(
+                        record["image_path"],
+                        prompt=record["prompt"],
+                        seed=record["seed"],
+                        model=os.path.basename(model_path),
+                        params=record["params"],
+                        timings=timings,
+                )
+
+            for record in records:
+                record["params"] = result_params(
+                        prompt=record["prompt"],
+                        seed=record["seed"],
+                        model_path=model_path,
+                        precision=precision,
+                        scheduler=scheduler,
+                        steps=steps,
+                        height=height,
+                        width=width,
+                        texture_format=texture_format,
+                        device=device,
+                        cpu_mode=cpu_mode,
+                        memory_mode=memory_mode,
+                        compression=compression,
+                )
+
+            cache = open_result_cache(cache_dir=cache_dir, use_cache=use_cache, cache_size=cache_size)
+            if cache is not None:
+                for record in records:
+                    record["key"] = cache.key(**record["params"])
+
+                    output_path = os.path.join(save_path, record["name"]) + texture_format
+                    record["image_path"] = reuse_cached(
+                            cache, key=record["key"], output_path=output_path, library=library
+                    )
+                    if record["image_path"]:
+                        add_to_library(record, timings={})
+
+            all_records = records
+            records = [record for record in records if not record.get("image_path")]
+
+            if records:
+                pipe = load_pipeline(
+                        model_path=model_path,
+                        device=device,
+                        precision=precision,
+                        scheduler=scheduler,
+                        memory_mode=memory_mode,
+                        cpu_mode=cpu_mode,
+                )
+
+            if not batch_size:
+                batch_size = auto_batch_size(device=device, precision=precision, height=height, width=width)
+
+            encoding = []  # (record, future of image_encoder.encode, generate time)
+            done = 0
+            while done < len(records):
+                batch = records[done:done + batch_size]
+
+                def on_step(step):
+                    progress = (done + len(batch) * min(1.0, (step + 1) / steps)) / len(records)  # See 'text2img'
+                    sd_worker.current_job.report(progress=progress, message=f"{done}/{len(records)} textures")
+
+                try:
+                    started = time.perf_counter()
+                    images = generate(
+                            pipe,
+                            prompts=[record["prompt"] for record in batch],
+                            seeds=[record["seed"] for record in batch],
+                            device=device,
+                            height=height,
+                            width=width,
+                            steps=steps,
+                            on_step=on_step,
+                            cpu_mode=cpu_mode,
+                            cpu_threads=cpu_threads,
+                            pipeline_key=pipeline_key(model_path, device, precision, memory_mode, cpu_mode),
+                    )
+                except RuntimeError as err:
+                    if not is_out_of_memory(err) or batch_size == 1:
+                        raise
+                    batch_size //= 2
+                    print(f"Out of memory, retrying with a batch size of {batch_size}.")
+                    if device.startswith("cuda"):
+                        import torch
+                        torch.cuda.empty_cache()
+                    continue
+
+                # Every image of a batch is generated together, each is charged an equal share:
+                timings = {"generate": (time.perf_counter() - started) / len(batch)}
+                for record, image in zip(batch, images):
+                    output_path = os.path.join(save_path, record["name"]) + texture_format
+                    record["image_path"] = library_path(library, output_path)
+                    encoding.append((record, image_encoder.submit(image, record["image_path"], compression), timings))
+
+                done += len(batch)
+
+            for record, future, timings in encoding:
+                with claimed(record["image_path"]):
+                    record["encode"] = future.result()
+                if cache is not None:
+                    cache.put(record["key"], image_path=record["image_path"], params=record["params"])
+                add_to_library(record, timings={**timings, "encode": record["encode"]["seconds"]})
+
+            for record in all_records:
+                record.pop("params", None)
+                record.pop("key", None)
+
+            return all_records
+
+    def text2img_sweep(
+            self,
+            texture_name: str,
+            texture_prompt: str,
+            save_path: str,
+            texture_format: str,
+            model_path: str,
+            device: str,
+            seeds=8,
+            draft: bool = False,
+            trace_path: str = None,
+            **options,
+    ):
+        """
+        Variations of one prompt to pick a texture from: the prompt is encoded once and every seed is denoised as part
+        of a batch, see 'text2img_batch'. Each texture is saved as "<texture_name> <seed>".
+
+        :param seeds: List of seeds, or the number of random seeds to try.
+        :param draft: Render every variation with 'draft_settings', a chosen one is refined by running 'text2img' with
+            the same arguments and its seed.
+        :param trace_path: See 'text2img', the trace includes the prompt embedding cache stats under "prompt_cache".
+        :param options: Any other argument of 'text2img_batch'.
+        :return: {"records": the records returned by 'text2img_batch', "prompt_cache": prompt embedding cache stats}
+        """
+
+        if isinstance(seeds, int):
+            seeds = [random.randrange(2 ** 32) for _ in range(seeds)]
+        if draft:
+            options.update(draft_settings)
+            texture_name += " draft"
+
+        records = [{"name": f"{texture_name} {seed}", "prompt": texture_prompt, "seed": seed} for seed in seeds]
+
+        job_trace.reset_peak_rss()
+        trace = job_trace.Trace(label=texture_name)
+        error = None
+        try:
+            with trace.stage("batch"):
+                records = self.text2img_batch(
+                        records,
+                        save_path=save_path,
+                        texture_format=texture_format,
+                        model_path=model_path,
+                        device=device,
+                        **options,
+                )
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            finish_trace(trace, trace_path, error=error)
+        return {"records": records, "prompt_cache": prompt_embeddings.stats()}
 
     def check_imports(self, module_name: str):
-        installed_modules = {pkg.key for pkg in pkg_resources.working_set}
-        installed = False
+        return dependency_probe.normalize_name(module_name) in dependency_probe.installed_distributions()
 
-        if module_name in installed_modules:
-            installed = True
+    def check_dependencies(self, requirements: list):
+        """
+        Checks a list of requirements (e.g. ["numpy", "torch==1.12.1+cu116"]) against this interpreter in one pass.
+        """
+        return dependency_probe.probe(list(requirements))
 
-        return installed
+    def unload(self):
+        """
+        Frees every resident pipeline, called by the worker after its idle timeout.
+        """
+        pipelines.clear()
+        prompt_embeddings.clear()
+
+        torch = sys.modules.get("torch")  # Nothing to free if torch was never imported
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def cache_stats(self):
+        """
+        Pipeline cache hit/miss/eviction counters and memory use, used to size the RAM/VRAM budgets, and the counters of
+        the prompt embedding cache under "prompt_cache".
+        """
+        return {**pipelines.stats(), "prompt_cache": prompt_embeddings.stats()}
+
+    def configure_cache(self, ram_budget: float = None, vram_budget: float = None):
+        """
+        Sets the pipeline cache budgets in bytes, evicting pipelines that no longer fit.
+        """
+        budgets = {"ram": ram_budget, "vram": vram_budget}
+        pipelines.set_budgets(**{name: int(value) for name, value in budgets.items() if value is not None})
+        return pipelines.stats()
+
+    def serve(self, port: int = 0, port_file: str = None, idle_timeout: float = sd_worker.idle_timeout):
+        """
+        Runs sd_interface.py as a long-lived worker, loaded pipelines are kept between requests. See sd_worker.py for
+        the request/response protocol.
+        """
+        worker_pool.pin_cpus()
+        sd_worker.serve(commands=self, port=port, port_file=port_file, idle_timeout=idle_timeout)
+
+    def render_manifest(self, manifest: str, output: str = None, workers=2, retries: int = 2, **defaults):
+        """
+        Renders every texture of a job manifest on a pool of 'serve' workers, each pinned to its own CPU core set or
+        GPU with its own loaded pipeline. See worker_pool.py for the manifest formats.
+
+        :param manifest: Path of the job manifest.
+        :param output: Path of the result manifest, "<manifest>.results.json" by default.
+        :param workers: Number of workers, or a list of worker specs like ["cuda:0", "cuda:1"] or ["cpu:0-7",
+            "cpu:8-15"]. A number splits the physical cores evenly between CPU workers when 'device' is "cpu", or gives
+            each worker one GPU. Every worker holds a pipeline in memory, size the pool to the RAM/VRAM available.
+        :param retries: Times a failed texture is tried again, on whichever worker is free first.
+        :param defaults: 'text2img' arguments for every texture, these override the manifest's own "defaults".
+        :return: The path of the result manifest.
+        """
+        manifest_defaults, items = worker_pool.load_manifest(manifest)
+        defaults = {**manifest_defaults, **defaults}
+        specs = worker_pool.worker_specs(workers, device=defaults.get("device", "cpu"))
+        output = output or os.path.splitext(manifest)[0] + ".results.json"
+
+        print(f"Rendering {len(items)} textures on {len(specs)} workers: {', '.join(spec['name'] for spec in specs)}")
+        pool = worker_pool.WorkerPool(
+                python_exe=sys.executable,
+                script_path=os.path.realpath(__file__),
+                specs=specs,
+                retries=retries,
+        )
+
+        started = time.time()
+        try:
+            pool.run(defaults, items)
+        finally:
+            # Also written when interrupted, with the textures done so far:
+            results = [result for result in pool.results if result is not None]
+            seconds = time.time() - started
+            completed = sum(1 for result in results if result["status"] == "ok")
+            worker_pool.write_results(output, {
+                    "manifest": os.path.abspath(manifest),
+                    "started": started,
+                    "seconds": seconds,
+                    "textures_per_minute": completed * 60 / seconds if seconds else 0.0,
+                    "workers": pool.worker_stats,
+                    "items": results,
+            })
+
+        print(f"{completed}/{len(items)} textures in {seconds:.1f}s, results in '{output}'")
+        return output
+
+
+# ======== Startup Profiling ======== #
+def profile_startup(args: list, top: int = 15):
+    """
+    Runs sd_interface.py with 'args' in a new interpreter under '-X importtime' and reports the import cost of each
+    top-level module, most expensive first.
+
+    :return: The exit code of the profiled command.
+    """
+    process = subprocess.run(
+            [sys.executable, "-X", "importtime", os.path.realpath(__file__)] + args,
+            stderr=subprocess.PIPE,
+            text=True,
+    )
+
+    # '-X importtime' lines look like "import time:  <self us> | <cumulative us> | <2 spaces per level><module>":
+    costs = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            sys.stderr.write(line + "\n")
+            continue
+
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # Header line
+        name = fields[2][1:]
+        if not name.startswith(" "):
+            costs.append((int(fields[1]), name))
+
+    total = sum(cumulative for cumulative, _ in costs)
+    print(f"\nImport time: {total / 1e6:.3f}s across {len(costs)} top-level modules")
+    for cumulative, name in sorted(costs, reverse=True)[:top]:
+        print(f"{cumulative / 1e6:>9.3f}s  {cumulative / max(total, 1):>6.1%}  {name}")
+
+    return process.returncode
 
 
 if __name__ == '__main__':
+    if "--profile-startup" in sys.argv:
+        sys.exit(profile_startup([arg for arg in sys.argv[1:] if arg != "--profile-startup"]))
+
     fire.Fire(SDInterfaceCommands)
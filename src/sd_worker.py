@@ -0,0 +1,408 @@
+import gc
+import os
+import sys
+import json
+import time
+import select
+import socket
+import secrets
+import threading
+import tempfile
+import traceback
+import subprocess
+
+# NOTE: This module is imported both by Blender (through helpers.py) and by the Venv Python (through sd_interface.py),
+# it must only ever depend on the Python standard library.
+
+# ======== Variables ======== #
+host = "127.0.0.1"
+token_env_var = "CAT_WORKER_TOKEN"
+
+# Seconds without a request before the worker unloads its Stable Diffusion pipeline(s):
+idle_timeout = 600
+# Seconds to wait for a freshly spawned worker to report its port:
+startup_timeout = 120
+# Seconds to wait for a health check response:
+ping_timeout = 10
+# Seconds a running worker gets to answer the health check before a request, a worker that doesn't (e.g. hung in a
+# native call) is restarted. Skipped when the worker answered within the last 'health_check_interval' seconds:
+health_check_timeout = 5
+health_check_interval = 2
+# Seconds a cancelled command gets to stop at its next cancellation check before the worker process is killed:
+cancel_grace = 5
+
+
+class WorkerError(Exception):
+    """
+    Raised on the client side when the worker reports that a command failed.
+    """
+
+    def __init__(self, message: str, remote_traceback: str = ""):
+        super().__init__(message)
+        self.remote_traceback = remote_traceback
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside the worker when a client cancels the running request, and on the client side in place of WorkerError
+    when a request ended because it was cancelled.
+    """
+
+
+# ======== Protocol ======== #
+# Every message is a single UTF-8 JSON object terminated by a newline. A client opens one connection per request and
+# sends one request message, the worker answers with any number of event messages followed by one response message.
+# While a request runs the client may send a cancel message on the same connection:
+#   request:  {"token": str, "command": str, "kwargs": dict}
+#   event:    {"event": "progress", "progress": float, "message": str, ...}, "progress" is left out if unchanged
+#   cancel:   {"cancel": True}
+#   response: {"ok": True, "result": ...} or {"ok": False, "error": str, "traceback": str, "cancelled": bool}
+
+class Connection(object):
+    """
+    Newline delimited JSON messages over a socket. Reads are buffered by hand rather than through socket.makefile() so
+    that 'poll' can be used to check for incoming messages without blocking.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+
+    def send(self, message: dict):
+        self.sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+    def poll(self, timeout: float = 0):
+        """
+        True if a message (or the end of the connection) is waiting to be received.
+        """
+        return b"\n" in self.buffer or bool(select.select([self.sock], [], [], timeout)[0])
+
+    def receive(self):
+        while b"\n" not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Worker connection closed before a message was received.")
+            self.buffer += data
+
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return json.loads(line.decode("utf-8"))
+
+
+class JobContext(object):
+    """
+    Lets long running commands report progress and notice cancellation. Commands reach the context of the request they
+    are running in through the module level 'current_job', outside the worker it is a no-op context.
+    """
+
+    def __init__(self, connection: Connection = None):
+        self.connection = connection
+        self.cancelled = False
+
+    def report(self, progress: float = None, message: str = "", **extra):
+        if self.connection is None:
+            return
+        if progress is not None:
+            extra["progress"] = progress
+        try:
+            self.connection.send({"event": "progress", "message": message, **extra})
+        except OSError:
+            self.cancelled = True  # Nobody is listening for the result anymore.
+
+    def check_cancelled(self):
+        """
+        Raises JobCancelled if the client asked to cancel or went away, call this between units of work.
+        """
+        if self.connection is not None and not self.cancelled and self.connection.poll():
+            try:
+                self.cancelled = bool(self.connection.receive().get("cancel"))
+            except (OSError, ValueError):
+                self.cancelled = True
+
+        if self.cancelled:
+            raise JobCancelled("Job cancelled.")
+
+
+current_job = JobContext()
+
+
+# ======== Worker (Venv side) ======== #
+
+def free_memory():
+    """
+    Releases the intermediate tensors of an aborted command right away instead of whenever the garbage collector runs,
+    loaded pipelines are kept.
+    """
+    gc.collect()
+    torch = sys.modules.get("torch")  # Nothing to free if torch was never imported
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def serve(commands, port: int = 0, port_file: str = None, idle_timeout: float = idle_timeout):
+    """
+    Runs the long-lived worker loop. Requests are dispatched to the public methods of 'commands' (an instance of
+    SDInterfaceCommands) so that anything loaded by those methods stays resident between requests.
+
+    :param commands: Object whose public methods can be called by clients.
+    :param port: Port to listen on, 0 picks a free port.
+    :param port_file: If given, the chosen port is written to this file once the worker is ready to accept requests.
+    :param idle_timeout: Seconds without a request before 'commands.unload()' is called to free RAM/VRAM.
+    """
+    global current_job
+
+    token = os.environ.get(token_env_var, "")
+    started = time.time()
+    last_request = time.time()
+    unloaded = True
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind((host, port))
+    server.listen()
+    server.settimeout(1.0)
+
+    port = server.getsockname()[1]
+    if port_file:
+        # Write then rename so the client never reads a half written file:
+        with open(port_file + ".tmp", "w") as outfile:
+            outfile.write(str(port))
+        os.replace(port_file + ".tmp", port_file)
+
+    print(f"Cozy Auto Texture worker {os.getpid()} listening on {host}:{port}")
+    sys.stdout.flush()
+
+    running = True
+    while running:
+        try:
+            sock, _ = server.accept()
+        except socket.timeout:
+            if not unloaded and idle_timeout and time.time() - last_request > idle_timeout:
+                print(f"Worker idle for {idle_timeout}s, unloading Stable Diffusion.")
+                commands.unload()
+                unloaded = True
+            continue
+
+        with sock:
+            sock.settimeout(None)
+            connection = Connection(sock)
+            try:
+                request = connection.receive()
+            except (OSError, ValueError):
+                continue
+
+            if not secrets.compare_digest(str(request.get("token", "")), token):
+                connection.send({"ok": False, "error": "Invalid worker token.", "traceback": ""})
+                continue
+
+            command = request.get("command", "")
+            kwargs = request.get("kwargs") or {}
+            current_job = JobContext(connection)
+
+            try:
+                if command == "ping":
+                    result = {
+                            "pid": os.getpid(),
+                            "uptime": time.time() - started,
+                            "loaded": not unloaded,
+                    }
+                elif command == "unload":
+                    result = commands.unload()
+                    unloaded = True
+                elif command == "shutdown":
+                    result = None
+                    running = False
+                elif command.startswith("_") or command in ("serve",) or not hasattr(commands, command):
+                    raise ValueError(f"Unknown worker command: '{command}'")
+                else:
+                    result = getattr(commands, command)(**kwargs)
+                    unloaded = False
+
+                response = {"ok": True, "result": result}
+            except Exception as err:
+                response = {
+                        "ok": False,
+                        "error": f"{type(err).__name__}: {err}",
+                        "traceback": traceback.format_exc(),
+                        "cancelled": isinstance(err, JobCancelled),
+                }
+                if isinstance(err, JobCancelled):
+                    free_memory()
+            finally:
+                current_job = JobContext()
+                last_request = time.time()
+
+            try:
+                connection.send(response)
+            except OSError:
+                pass  # Client went away, nothing to report to.
+
+    server.close()
+    commands.unload()
+
+
+# ======== Client (Blender side) ======== #
+class WorkerClient(object):
+    """
+    Starts and talks to a persistent sd_interface.py worker. The worker is (re)started lazily on the first request and
+    whenever it is found dead, so a crash in torch/diffusers only costs one model load instead of breaking the add-on.
+    """
+
+    def __init__(
+            self,
+            python_exe: str,
+            script_path: str,
+            idle_timeout: float = idle_timeout,
+            max_restarts: int = 1,
+            environment: dict = None,
+    ):
+        """
+        :param environment: Extra environment variables for the worker process, e.g. to pin it to some CPU cores.
+        """
+        self.python_exe = python_exe
+        self.script_path = script_path
+        self.idle_timeout = idle_timeout
+        self.max_restarts = max_restarts
+        self.environment = environment or {}
+
+        self.process = None
+        self.port = None
+        self.token = None
+        self.last_answer = 0.0
+
+    def start(self):
+        self.stop()
+
+        self.token = secrets.token_hex(16)
+        port_file = os.path.join(tempfile.gettempdir(), f"cat_worker_{os.getpid()}_{self.token[:8]}.port")
+
+        environ_copy = dict(os.environ, **self.environment)
+        environ_copy[token_env_var] = self.token
+
+        self.process = subprocess.Popen(
+                [
+                        self.python_exe,
+                        self.script_path,
+                        "serve",
+                        "--port_file", port_file,
+                        "--idle_timeout", str(self.idle_timeout),
+                ],
+                env=environ_copy,
+        )
+
+        deadline = time.time() + startup_timeout
+        try:
+            while not os.path.exists(port_file):
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Worker exited during startup with code {self.process.returncode}.")
+                if time.time() > deadline:
+                    self.stop()
+                    raise TimeoutError(f"Worker did not start within {startup_timeout}s.")
+                time.sleep(0.05)
+
+            with open(port_file) as infile:
+                self.port = int(infile.read())
+            self.last_answer = time.time()  # Writing the port file is its first sign of life
+        finally:
+            if os.path.exists(port_file):
+                os.remove(port_file)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                if self.port is None:
+                    raise OSError("Worker has no port yet.")
+                self._send("shutdown", {}, timeout=ping_timeout)
+                self.process.wait(timeout=ping_timeout)
+            except (OSError, WorkerError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+        self.process = None
+        self.port = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ping(self, timeout: float = ping_timeout):
+        """
+        Health check, returns the worker status dict or None if the worker is not responding.
+        """
+        if not self.is_alive():
+            return None
+        try:
+            return self._send("ping", {}, timeout=timeout)
+        except (OSError, WorkerError):
+            return None
+
+    def ensure_running(self):
+        """
+        Starts the worker if it isn't running and restarts it if it is running but fails the health check. The worker
+        handles one connection at a time, so only call this while no other request to it is in flight.
+        """
+        if self.is_alive() and time.time() - self.last_answer > health_check_interval:
+            if self.ping(timeout=health_check_timeout) is None:
+                print(f"Cozy Auto Texture worker did not answer within {health_check_timeout}s, restarting it.")
+                self.process.kill()
+                self.process.wait()
+        if not self.is_alive():
+            self.start()
+
+    def request(self, command: str, on_event=None, cancel: threading.Event = None, **kwargs):
+        """
+        Sends 'command' to the worker and returns its result. If the worker crashed, either before or during the
+        request, it is restarted and the request is retried up to 'max_restarts' times.
+
+        :param on_event: Called with every event message (e.g. progress) the worker sends while the command runs.
+        :param cancel: When set, the worker is asked to abort the command.
+        :raises: WorkerError if the command itself failed inside the worker, JobCancelled if it was cancelled.
+        """
+        restarts = 0
+        while True:
+            self.ensure_running()
+            try:
+                return self._send(command, kwargs, on_event=on_event, cancel=cancel)
+            except OSError:
+                # A dropped connection means the worker is on its way down, give it a moment to exit. Raises
+                # subprocess.TimeoutExpired if it is still alive, in which case the error wasn't a crash:
+                self.process.wait(timeout=ping_timeout)
+                if restarts >= self.max_restarts or (cancel is not None and cancel.is_set()):
+                    raise
+                restarts += 1
+                print(f"Cozy Auto Texture worker exited with code {self.process.returncode}, restarting.")
+
+    def _send(self, command: str, kwargs: dict, timeout: float = None, on_event=None, cancel=None):
+        with socket.create_connection((host, self.port), timeout=timeout) as sock:
+            connection = Connection(sock)
+            connection.send({"token": self.token, "command": command, "kwargs": kwargs})
+
+            deadline = time.time() + timeout if timeout else None
+            cancel_sent = None
+            while True:
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError(f"Worker did not answer '{command}' within {timeout}s.")
+
+                if cancel is not None and cancel.is_set() and cancel_sent is None:
+                    connection.send({"cancel": True})
+                    cancel_sent = time.time()
+
+                if cancel_sent is not None and time.time() - cancel_sent > cancel_grace:
+                    # Stuck in a single long operation, killing the worker is the only way to free the CPU/GPU now. The
+                    # next request starts a fresh worker:
+                    self.process.kill()
+                    self.process.wait()
+                    raise JobCancelled(f"'{command}' did not stop within {cancel_grace}s, worker stopped.")
+
+                if not connection.poll(timeout=0.1):
+                    continue
+
+                message = connection.receive()
+                if "event" not in message:
+                    break
+                if on_event is not None:
+                    on_event(message)
+
+        self.last_answer = time.time()
+        if message.get("cancelled"):
+            raise JobCancelled(message["error"])
+        if not message["ok"]:
+            raise WorkerError(message["error"], message.get("traceback", ""))
+        return message["result"]
@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import time
+import sqlite3
+
+# NOTE: Standard library only. Written by sd_interface.py as textures are saved, read by Blender to search the textures
+# in a save directory without listing the folder.
+#
+# One SQLite database per save directory, paths are stored relative to it so the folder can be moved or shared:
+#   textures(path, name, stem, counter, prompt, seed, model, params, timings, created)
+# 'stem' and 'counter' split "Wall (3).png" into "Wall" and 3, 'params' and 'timings' are JSON. 'timings' holds the
+# seconds of each stage, plus the "encode_bytes" written when the texture was saved in the background.
+
+library_name = "cozy_auto_texture_library.sqlite"
+counter_pattern = re.compile(r"^(.*) \((\d+)\)$")
+
+schema = """
+CREATE TABLE IF NOT EXISTS textures (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    counter INTEGER NOT NULL,
+    prompt TEXT,
+    seed INTEGER,
+    model TEXT,
+    params TEXT,
+    timings TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS textures_stem ON textures (stem, counter);
+CREATE INDEX IF NOT EXISTS textures_created ON textures (created);
+"""
+
+
+def split_counter(path: str):
+    """
+    ("Wall", 3) for ".../Wall (3).png", ("Wall", 0) for ".../Wall.png".
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    match = counter_pattern.match(name)
+    if match is None:
+        return name, 0
+    return match.group(1), int(match.group(2))
+
+
+class TextureLibrary(object):
+    """
+    Index of the textures generated into 'save_path'. Several processes may write to the same library at once, SQLite
+    serializes the writes.
+    """
+
+    def __init__(self, save_path: str):
+        self.save_path = save_path
+        self.db_path = os.path.join(save_path, library_name)
+
+        os.makedirs(save_path, exist_ok=True)
+        self.connection = sqlite3.connect(self.db_path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_counter(self, path: str):
+        """
+        First counter after every indexed texture named like 'path', where 'uniquify' should start looking for a free
+        name. 0 if no texture of that name was indexed.
+        """
+        stem = split_counter(path)[0]
+        row = self.connection.execute("SELECT MAX(counter) FROM textures WHERE stem = ?", (stem,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def add(
+            self,
+            path: str,
+            prompt: str,
+            seed: int,
+            model: str,
+            params: dict = None,
+            timings: dict = None,
+    ):
+        stem, counter = split_counter(path)
+        with self.connection:
+            self.connection.execute(
+                    "INSERT OR REPLACE INTO textures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                            os.path.relpath(path, self.save_path),
+                            os.path.basename(path),
+                            stem,
+                            counter,
+                            prompt,
+                            seed,
+                            model,
+                            json.dumps(params or {}),
+                            json.dumps(timings or {}),
+                            time.time(),
+                    ),
+            )
+
+    def _record(self, row: sqlite3.Row):
+        record = dict(row)
+        record["path"] = os.path.join(self.save_path, record["path"])
+        record["params"] = json.loads(record["params"] or "{}")
+        record["timings"] = json.loads(record["timings"] or "{}")
+        return record
+
+    def get(self, path: str):
+        row = self.connection.execute(
+                "SELECT * FROM textures WHERE path = ?", (os.path.relpath(path, self.save_path),)
+        ).fetchone()
+        return self._record(row) if row is not None else None
+
+    def search(self, text: str = "", limit: int = 50):
+        """
+        Most recent textures whose name or prompt contains 'text' (case insensitive), every texture if 'text' is empty.
+        """
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = self.connection.execute(
+                "SELECT * FROM textures WHERE name LIKE ? ESCAPE '\\' OR prompt LIKE ? ESCAPE '\\' "
+                "ORDER BY created DESC LIMIT ?",
+                (pattern, pattern, limit),
+        )
+        return [self._record(row) for row in rows]
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+from collections import deque
+
+import sd_worker
+
+# NOTE: Standard library only. Runs in the Venv Python as the 'render_manifest' command of sd_interface.py and starts
+# one 'serve' worker per CPU core set or GPU, every worker keeps its own pipeline loaded (see sd_worker.py).
+#
+# Job manifest, a JSON file:
+#   {"defaults": {text2img arguments shared by every item}, "items": [{"name": str, "prompt": str, "seed": int}, ...]}
+# or only the list of items. Any other key of an item overrides the defaults for that item.
+#
+# Result manifest, written once the job is done (or interrupted):
+#   {"manifest": path, "started": epoch seconds, "seconds": float, "textures_per_minute": float,
+#    "workers": [{"name": str, "device": str, "cpus": [int, ...], "completed": int, "failed": int, "busy": seconds}],
+#    "items": [{...item, "status": "ok" | "failed", "image_path": str, "attempts": int, "worker": str,
+#               "seconds": float, "stages": {stage name: seconds}, "error": str}]}
+
+cpus_env_var = "CAT_WORKER_CPUS"
+
+# Consecutive attempts the worker itself failed (crashed, did not start, ...) after which it is retired, the other
+# workers pick up its items:
+max_worker_failures = 3
+
+
+def allowed_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_cores():
+    """
+    Logical CPUs this process may run on, grouped by physical core, e.g. [[0, 8], [1, 9], ...] with hyperthreading.
+    Every CPU is a core of its own where the topology is unknown.
+    """
+    allowed = set(allowed_cpus())
+    cores = {}
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            processor = physical_id = None
+            for line in cpuinfo:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "processor":
+                    processor = int(value)
+                elif key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id" and processor in allowed:
+                    cores.setdefault((physical_id, value.strip()), []).append(processor)
+    except (OSError, ValueError):
+        pass
+
+    if not cores:
+        return [[cpu] for cpu in sorted(allowed)]
+    return sorted(sorted(cpus) for cpus in cores.values())
+
+
+def parse_cpus(text: str):
+    """
+    [0, 1, 2, 3, 8] for "0-3,8".
+    """
+    cpus = []
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpus(cpus: list):
+    """
+    "0-3,8" for [0, 1, 2, 3, 8].
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def pin_cpus():
+    """
+    Restricts this process to the core set a pool gave it in 'CAT_WORKER_CPUS', called by a worker at startup. Not
+    supported on Windows and macOS, where workers share every core.
+    """
+    cpus = os.environ.get(cpus_env_var)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, parse_cpus(cpus))
+
+
+def worker_specs(workers, device: str):
+    """
+    Worker descriptions {"name", "device", "cpus", "gpu", "threads"} for 'workers', either a number of workers or a list
+    of specs like ["cuda:0", "cuda:1"] or ["cpu:0-7", "cpu:8-15"]. A number splits the physical cores of this machine
+    evenly between CPU workers when 'device' is "cpu", or gives each worker one GPU.
+    """
+    if isinstance(workers, (int, str)) and str(workers).isdigit():
+        count = int(workers)
+        if device != "cpu":
+            workers = [f"{device}:{index}" for index in range(count)]
+        else:
+            cores = cpu_cores()
+            if not 0 < count <= len(cores):
+                raise ValueError(f"Cannot split {len(cores)} CPU cores between {count} workers.")
+            chunks = [cores[index * len(cores) // count:(index + 1) * len(cores) // count] for index in range(count)]
+            workers = ["cpu:" + format_cpus([cpu for core in chunk for cpu in core]) for chunk in chunks]
+    elif isinstance(workers, str):
+        workers = workers.split()
+
+    specs = []
+    for name in workers:
+        kind, _, target = name.partition(":")
+        spec = {"name": name, "device": kind, "cpus": None, "gpu": None, "threads": 0}
+        if kind == "cpu" and target:
+            spec["cpus"] = parse_cpus(target)
+            allowed = set(spec["cpus"])
+            spec["threads"] = sum(1 for core in cpu_cores() if allowed.intersection(core)) or len(spec["cpus"])
+        elif kind != "cpu":
+            spec["gpu"] = target or None
+        specs.append(spec)
+    return specs
+
+
+def worker_environment(spec: dict):
+    """
+    Environment variables that pin a worker: its core set and a matching thread count for the OpenMP/MKL thread
+    pools, or the one GPU it may see (addressed as "cuda" inside the worker).
+    """
+    environment = {}
+    if spec["cpus"]:
+        environment[cpus_env_var] = format_cpus(spec["cpus"])
+        environment["OMP_NUM_THREADS"] = environment["MKL_NUM_THREADS"] = str(spec["threads"])
+    if spec["gpu"] is not None:
+        environment["CUDA_VISIBLE_DEVICES"] = spec["gpu"]
+    return environment
+
+
+def load_manifest(path: str):
+    """
+    Returns (defaults, items) of a job manifest, every item with a name, a prompt and a fixed seed so that retries and
+    the result manifest use the same seed.
+    """
+    with open(path) as infile:
+        manifest = json.load(infile)
+    if isinstance(manifest, list):
+        manifest = {"items": manifest}
+
+    items = []
+    for index, item in enumerate(manifest.get("items", [])):
+        item = dict(item)
+        if not item.get("prompt"):
+            raise ValueError(f"Item {index} of '{path}' has no prompt.")
+        item.setdefault("name", item["prompt"])
+        if item.get("seed") is None or int(item["seed"]) < 0:
+            item["seed"] = random.randrange(2 ** 32)
+        item["seed"] = int(item["seed"])
+        items.append(item)
+    return manifest.get("defaults", {}), items
+
+
+class WorkerPool(object):
+    """
+    Renders the items of a job manifest with one 'text2img' request per item on a pool of workers. Idle workers take
+    the next item from a shared queue, so fast workers simply render more items. A failed item goes back into the
+    queue until it has been tried 'retries' + 1 times.
+
+    :param python_exe: Python of the Venv the workers run in.
+    :param script_path: Path of sd_interface.py.
+    :param specs: Worker descriptions from 'worker_specs'.
+    """
+
+    def __init__(self, python_exe: str, script_path: str, specs: list, retries: int = 2):
+        self.specs = specs
+        self.retries = retries
+        self.clients = [
+                sd_worker.WorkerClient(
+                        python_exe=python_exe,
+                        script_path=script_path,
+                        environment=worker_environment(spec),
+                )
+                for spec in specs
+        ]
+
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.in_flight = 0
+        self.results = []
+        self.worker_stats = [
+                {"name": spec["name"], "device": spec["device"], "cpus": spec["cpus"], "completed": 0, "failed": 0,
+                 "busy": 0.0}
+                for spec in specs
+        ]
+
+    def run(self, defaults: dict, items: list):
+        """
+        Renders every item and returns the result records in the order of 'items'.
+        """
+        self.queue.extend({"item": item, "attempts": 0, "index": index} for index, item in enumerate(items))
+        self.results = [None] * len(items)
+
+        threads = [
+                threading.Thread(target=self._work, args=(index, defaults), daemon=True)
+                for index in range(len(self.clients))
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)  # A bare join() can't be interrupted with Ctrl+C
+        finally:
+            for client in self.clients:
+                client.stop()
+
+        # Left over when every worker was retired:
+        for entry in self.queue:
+            self._record(entry, status="failed", error="No worker left to render this item.")
+        return [result for result in self.results if result is not None]
+
+    def _next(self):
+        with self.condition:
+            # An empty queue isn't the end while other workers may still put a failed item back:
+            while not self.queue and self.in_flight:
+                self.condition.wait()
+            if not self.queue:
+                return None
+            self.in_flight += 1
+            return self.queue.popleft()
+
+    def _work(self, index: int, defaults: dict):
+        spec, client, stats = self.specs[index], self.clients[index], self.worker_stats[index]
+        failures = 0
+
+        while True:
+            entry = self._next()
+            if entry is None:
+                break
+
+            entry["attempts"] += 1
+            item = entry["item"]
+            stages = {}
+
+            def on_event(message):
+                if "trace" in message:
+                    stages.update({stage["name"]: stage["seconds"] for stage in message["trace"]["stages"]})
+
+            kwargs = {**defaults, **{key: value for key, value in item.items() if key not in ("name", "prompt")}}
+            kwargs["device"] = "cpu" if spec["device"] == "cpu" else "cuda"  # The worker only sees its own GPU
+            if spec["threads"]:
+                kwargs.setdefault("cpu_threads", spec["threads"])
+
+            started = time.perf_counter()
+            worker_fault = False
+            try:
+                image_path = client.request(
+                        "text2img",
+                        on_event=on_event,
+                        texture_name=item["name"],
+                        texture_prompt=item["prompt"],
+                        **kwargs
+                )
+                error = None
+            except Exception as err:
+                image_path, error = None, str(err) or type(err).__name__
+                # WorkerError is the command failing (e.g. a bad argument), anything else the worker itself:
+                worker_fault = not isinstance(err, sd_worker.WorkerError)
+            seconds = time.perf_counter() - started
+            stats["busy"] += seconds
+
+            with self.condition:
+                self.in_flight -= 1
+                failures = failures + 1 if worker_fault else 0
+                if error is None:
+                    stats["completed"] += 1
+                    self._record(entry, status="ok", worker=spec["name"], seconds=seconds, image_path=image_path,
+                                 stages=stages)
+                else:
+                    stats["failed"] += 1
+                    if entry["attempts"] <= self.retries:
+                        print(f"'{item['name']}' failed on worker {spec['name']}, retrying: {error}")
+                        self.queue.append(entry)
+                    else:
+                        self._record(entry, status="failed", worker=spec["name"], seconds=seconds, error=error)
+
+                self.condition.notify_all()
+
+            if failures >= max_worker_failures:
+                print(f"Worker {spec['name']} failed {failures} times in a row, retiring it.")
+                client.stop()
+                break
+
+    def _record(self, entry: dict, status: str, **fields):
+        result = {**entry["item"], "status": status, "attempts": entry["attempts"], **fields}
+        self.results[entry["index"]] = result
+
+        done = sum(1 for record in self.results if record is not None)
+        outcome = result.get("image_path") if status == "ok" else f"FAILED: {result.get('error')}"
+        print(f"[{done}/{len(self.results)}] {result['name']}: {outcome}")
+        sys.stdout.flush()
+
+
+def write_results(path: str, results: dict):
+    with open(path + ".tmp", "w") as outfile:
+        json.dump(results, outfile, indent=1)
+    os.replace(path + ".tmp", path)
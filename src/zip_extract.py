@@ -0,0 +1,175 @@
+import io
+import os
+import zipfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import downloader
+
+# NOTE: Standard library only. Extracts zip archives in parallel straight from the central directory, either from a
+# local file or from a URL through HTTP range requests so the archive never has to be stored on disk.
+
+# ======== Variables ======== #
+workers = 8  # Entries extracted in parallel
+write_buffer_size = 8 * 1024 * 1024  # 8MB writes to the extracted files
+tail_size = 1024 * 1024  # Bytes fetched from the end of a remote archive, covers the central directory of most zips
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read only, seekable file over HTTP range requests. Sequential reads are served from a single range request running
+    up to the tail, it is only reopened when zipfile seeks somewhere else, so reading one zip entry costs one request. The
+    end of the archive, where zipfile looks for the central directory, is served from memory.
+    """
+
+    def __init__(self, url: str, size: int, tail: bytes):
+        self.url = url
+        self.size = size
+        self.tail = tail
+        self.position = 0
+        self.response = None
+        self.response_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+
+        tail_start = self.size - len(self.tail)
+        if self.position >= tail_start:
+            data = self.tail[self.position - tail_start:self.position - tail_start + len(buffer)]
+        else:
+            if self.response is None or self.response_position != self.position:
+                self._open()
+            data = self.response.read(min(len(buffer), tail_start - self.position))
+            if not data:
+                raise ConnectionError(f"Connection closed at byte {self.position} of {self.url}.")
+            self.response_position += len(data)
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def _open(self):
+        self._close_response()
+        end = self.size - len(self.tail) - 1  # Everything after this is served from the tail
+        request = urllib.request.Request(self.url, headers={"Range": f"bytes={self.position}-{end}"})
+        self.response = urllib.request.urlopen(request, timeout=downloader.timeout)
+        if self.response.status != 206:
+            self._close_response()
+            raise ConnectionError(f"Server ignored range request for {self.url}.")
+        self.response_position = self.position
+
+    def _close_response(self):
+        if self.response is not None:
+            self.response.close()
+        self.response = None
+
+    def close(self):
+        self._close_response()
+        super().close()
+
+
+def _target_path(dest_dir: str, name: str):
+    # Same protection as ZipFile.extractall() against absolute paths and '..' in entry names:
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(dest_dir, *parts) if parts else None
+
+
+def _extract_entries(open_zip, dest_dir: str, workers: int):
+    """
+    Extracts every entry of the archive returned by 'open_zip()' into 'dest_dir'. Each thread gets its own ZipFile from
+    'open_zip' so entries decompress in parallel, the largest entries are started first. Entries are written to a
+    '.part' file and renamed when complete, entries already extracted by an interrupted run are skipped.
+
+    :return: The name of the first entry in the archive.
+    """
+    with open_zip() as zip_ref:
+        infos = zip_ref.infolist()
+
+    progress = downloader.Progress(total=sum(info.file_size for info in infos), label="Unzipping")
+    local = threading.local()
+    open_archives = []
+    lock = threading.Lock()
+
+    def extract(info):
+        target = _target_path(dest_dir, info.filename)
+        if target is None:
+            return
+
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+            return
+
+        if os.path.exists(target) and os.path.getsize(target) == info.file_size:
+            progress.add(info.file_size)
+            return
+
+        if not hasattr(local, "zip_ref"):
+            local.zip_ref = open_zip()
+            with lock:
+                open_archives.append(local.zip_ref)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # ZipExtFile checks the CRC-32 of the entry once it is read to the end:
+        with local.zip_ref.open(info) as source, open(target + ".part", "wb") as destination:
+            while True:
+                data = source.read(write_buffer_size)
+                if not data:
+                    break
+                destination.write(data)
+                progress.add(len(data))
+        os.replace(target + ".part", target)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            ordered = sorted(infos, key=lambda info: info.file_size, reverse=True)
+            for future in [executor.submit(extract, info) for info in ordered]:
+                future.result()
+    finally:
+        for zip_ref in open_archives:
+            zip_ref.close()
+
+    print()
+    return infos[0].filename if infos else ""
+
+
+def extract_local(zip_path: str, dest_dir: str, workers: int = workers):
+    """
+    Extracts a zip on disk in parallel, returns the name of its first entry.
+    """
+    return _extract_entries(lambda: zipfile.ZipFile(zip_path), dest_dir=dest_dir, workers=workers)
+
+
+def extract_remote(url: str, dest_dir: str, size: int, workers: int = workers):
+    """
+    Extracts a zip directly from 'url' while it downloads, each worker streams the entries it extracts over its own range
+    request. Requires a server with range support (see downloader.probe), returns the name of the first entry.
+    """
+    tail_start = max(0, size - tail_size)
+    request = urllib.request.Request(url, headers={"Range": f"bytes={tail_start}-{size - 1}"})
+    with urllib.request.urlopen(request, timeout=downloader.timeout) as response:
+        tail = response.read()
+
+    def open_zip():
+        return zipfile.ZipFile(io.BufferedReader(RemoteFile(url, size, tail), buffer_size=downloader.buffer_size))
+
+    return _extract_entries(open_zip, dest_dir=dest_dir, workers=workers)
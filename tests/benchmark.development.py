@@ -0,0 +1,465 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import shutil
+import zipfile
+import platform
+import tempfile
+import argparse
+import functools
+import subprocess
+import threading
+import http.server
+
+# NOTE: Benchmarks for the Venv side of Cozy Auto Texture, runs on a CPU-only Linux box without Blender or network
+# access. Run it with the Venv's Python so torch, diffusers and fire are importable, benchmarks whose dependencies are
+# missing are skipped:
+#
+#   <venv>/bin/python tests/benchmark.development.py                     Compare against benchmark_baseline.json
+#   <venv>/bin/python tests/benchmark.development.py --update-baseline   Store the results as the new baseline
+#   <venv>/bin/python tests/benchmark.development.py --only zip          Only run benchmarks containing "zip"
+#
+# The exit code is 1 if a benchmark's best run is more than '--tolerance' slower than its baseline. Baselines are only
+# comparable on the same machine, the machine they were recorded on is stored with them, so none is committed: record
+# one with --update-baseline on the base revision, then run without it on your change. Without a baseline the results
+# are only printed, nothing is compared and the exit code is 0.
+
+src_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "src")
+sys.path.insert(0, src_path)
+
+import downloader  # noqa: E402
+import zip_extract  # noqa: E402
+
+# ======== Variables ======== #
+baseline_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "benchmark_baseline.json")
+repeats = 3  # Runs per benchmark, the best run is compared
+tolerance = 0.25  # Allowed slowdown over the baseline, 0.25 = 25%
+weights_size = 64 * 1024 * 1024  # Bytes of synthetic weights in the benchmark archive
+uniquify_files = 5000  # Existing files with the same name in the uniquify benchmark
+seed = 0
+
+
+class Skipped(Exception):
+    pass
+
+
+def requires(module_name: str):
+    try:
+        __import__(module_name)
+    except ImportError:
+        raise Skipped(f"'{module_name}' is not installed")
+
+
+# ======== Fixtures ======== #
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files with support for single "bytes=start-end" range requests, like the S3 bucket the weights are hosted on.
+    """
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, last = range_header[len("bytes="):].split("-")
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        with open(path, "rb") as infile:
+            infile.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = infile.read(min(downloader.buffer_size, remaining))
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(object):
+    """
+    HTTP server on localhost serving 'directory' from a background thread.
+    """
+
+    def __init__(self, directory: str):
+        handler = functools.partial(RangeRequestHandler, directory=directory)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, name: str):
+        return f"http://127.0.0.1:{self.server.server_port}/{name}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_weights_zip(zip_path: str, name: str = "stable-diffusion-v1-4"):
+    """
+    Writes a zip laid out like the weights archive. The large files are random (incompressible, like real weights) and
+    stored, the configs are small and deflated.
+    """
+    generator = random.Random(seed)
+    components = {"unet": 0.6, "text_encoder": 0.15, "vae": 0.1, "safety_checker": 0.15}
+
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        for component, share in components.items():
+            zip_ref.writestr(
+                    f"{name}/{component}/config.json",
+                    json.dumps({"component": component, "values": list(range(1000))}),
+                    compress_type=zipfile.ZIP_DEFLATED,
+            )
+            zip_ref.writestr(
+                    f"{name}/{component}/diffusion_pytorch_model.bin",
+                    generator.randbytes(int(weights_size * share)),
+                    compress_type=zipfile.ZIP_STORED,
+            )
+        zip_ref.writestr(f"{name}/model_index.json", json.dumps({"_class_name": "StableDiffusionPipeline"}))
+
+
+def make_tiny_pipeline(model_path: str):
+    """
+    Saves a randomly initialised Stable Diffusion pipeline with the same architecture as v1-4 but a few thousand times
+    fewer parameters, so text2img can run end to end on a CPU in seconds.
+    """
+    import torch
+    import diffusers
+    import transformers
+
+    torch.manual_seed(seed)
+
+    unet = diffusers.UNet2DConditionModel(
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            sample_size=32,
+            in_channels=4,
+            out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            cross_attention_dim=32,
+    )
+    vae = diffusers.AutoencoderKL(
+            block_out_channels=(32, 64),
+            in_channels=3,
+            out_channels=3,
+            down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+            up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+            latent_channels=4,
+    )
+    text_encoder = transformers.CLIPTextModel(transformers.CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=1,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            vocab_size=1000,
+    ))
+
+    # Character level vocabulary, enough for the tokenizer to encode any ASCII prompt:
+    tokenizer_path = os.path.join(model_path, "tokenizer-source")
+    os.makedirs(tokenizer_path, exist_ok=True)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for character in map(chr, range(33, 127)):
+        vocab.setdefault(character, len(vocab))
+        vocab.setdefault(character + "</w>", len(vocab))
+    with open(os.path.join(tokenizer_path, "vocab.json"), "w") as outfile:
+        json.dump(vocab, outfile)
+    with open(os.path.join(tokenizer_path, "merges.txt"), "w") as outfile:
+        outfile.write("#version: 0.2\n")
+    tokenizer = transformers.CLIPTokenizer(
+            os.path.join(tokenizer_path, "vocab.json"),
+            os.path.join(tokenizer_path, "merges.txt"),
+            model_max_length=77,
+    )
+
+    pipe = diffusers.StableDiffusionPipeline(
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=unet,
+            scheduler=diffusers.PNDMScheduler(skip_prk_steps=True),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+    )
+    pipe.save_pretrained(model_path)
+    shutil.rmtree(tokenizer_path)
+
+
+# ======== Benchmarks ======== #
+benchmarks = {}
+
+
+def benchmark(function):
+    """
+    Registers 'function(work_dir)' as a benchmark. It returns the seconds of each run, or raises Skipped.
+    """
+    benchmarks[function.__name__] = function
+    return function
+
+
+def timed(run, setup=None):
+    """
+    Times 'repeats' calls of 'run(setup())', setup isn't timed.
+    """
+    runs = []
+    for _ in range(repeats):
+        argument = setup() if setup is not None else None
+        started = time.perf_counter()
+        run(argument)
+        runs.append(time.perf_counter() - started)
+    return runs
+
+
+@benchmark
+def download(work_dir: str):
+    zip_path = os.path.join(work_dir, "weights.zip")
+    make_weights_zip(zip_path)
+
+    with LocalServer(work_dir) as server:
+        return timed(
+                lambda dest_dir: downloader.download(server.url("weights.zip"), os.path.join(dest_dir, "weights.zip")),
+                setup=lambda: tempfile.mkdtemp(dir=work_dir),
+        )
+
+
+@benchmark
+def zip_extract_local(work_dir: str):
+    zip_path = os.path.join(work_dir, "weights.zip")
+    make_weights_zip(zip_path)
+    return timed(
+            lambda dest_dir: zip_extract.extract_local(zip_path, dest_dir),
+            setup=lambda: tempfile.mkdtemp(dir=work_dir),
+    )
+
+
+def import_stable_diffusion(work_dir: str, verify: bool):
+    requires("fire")
+    import sd_interface
+
+    zip_path = os.path.join(work_dir, "weights.zip")
+    make_weights_zip(zip_path)
+    sha256 = None
+    if verify:
+        with open(zip_path, "rb") as infile:
+            sha256 = hashlib.sha256(infile.read()).hexdigest()
+
+    def run(environment_path):
+        sd_interface.SDInterfaceCommands().import_stable_diffusion(
+                sd_path=os.path.join(environment_path, "stable-diffusion-v1-4"),
+                sd_url=server.url("weights.zip"),
+                environment_path=environment_path,
+                sha256=sha256,
+        )
+
+    with LocalServer(work_dir) as server:
+        return timed(run, setup=lambda: tempfile.mkdtemp(dir=work_dir))
+
+
+@benchmark
+def import_stable_diffusion_stream(work_dir: str):
+    """Streamed extraction over range requests, the default install path."""
+    return import_stable_diffusion(work_dir, verify=False)
+
+
+@benchmark
+def import_stable_diffusion_verified(work_dir: str):
+    """Download, SHA-256 verification, then local extraction."""
+    return import_stable_diffusion(work_dir, verify=True)
+
+
+@benchmark
+def uniquify(work_dir: str):
+    requires("fire")
+    import sd_interface
+
+    for counter in range(uniquify_files):
+        name = "texture.png" if counter == 0 else f"texture ({counter}).png"
+        open(os.path.join(work_dir, name), "w").close()
+
+    return timed(lambda _: sd_interface.uniquify(os.path.join(work_dir, "texture.png")))
+
+
+@benchmark
+def uniquify_library(work_dir: str):
+    """The same folder with every texture indexed, the path taken by text2img."""
+    requires("fire")
+    import sd_interface
+    import texture_library
+
+    with texture_library.TextureLibrary(work_dir) as library:
+        for counter in range(uniquify_files):
+            path = os.path.join(work_dir, "texture.png" if counter == 0 else f"texture ({counter}).png")
+            open(path, "w").close()
+            library.add(path, prompt="benchmark", seed=counter, model="benchmark")
+
+        return timed(lambda _: sd_interface.library_path(library, os.path.join(work_dir, "texture.png")))
+
+
+@benchmark
+def spawn_interpreter(work_dir: str):
+    """Reference cost of starting the interpreter, the floor for 'spawn_sd_interface'."""
+    return timed(lambda _: subprocess.run([sys.executable, "-c", "pass"], check=True))
+
+
+@benchmark
+def spawn_sd_interface(work_dir: str):
+    """What execution_handler pays per call on Darwin/Linux: a new interpreter running one sd_interface.py command."""
+    requires("fire")
+    args = [sys.executable, os.path.join(src_path, "sd_interface.py"), "check_imports", "numpy"]
+    return timed(lambda _: subprocess.run(args, check=True, stdout=subprocess.DEVNULL))
+
+
+@benchmark
+def worker_request(work_dir: str):
+    """The same command sent to a running worker, the path used for texture jobs."""
+    requires("fire")
+    import sd_worker
+
+    client = sd_worker.WorkerClient(python_exe=sys.executable, script_path=os.path.join(src_path, "sd_interface.py"))
+    client.start()
+    try:
+        return timed(lambda _: client.request("check_imports", module_name="numpy"))
+    finally:
+        client.stop()
+
+
+@benchmark
+def text2img_tiny(work_dir: str):
+    """text2img end to end on the CPU with a tiny random pipeline, includes the pipeline load of every run."""
+    for module_name in ("fire", "torch", "diffusers", "transformers"):
+        requires(module_name)
+    import sd_interface
+
+    model_path = os.path.join(work_dir, "tiny-stable-diffusion")
+    make_tiny_pipeline(model_path)
+
+    def run(save_path):
+        sd_interface.pipelines.clear()
+        sd_interface.SDInterfaceCommands().text2img(
+                texture_name="benchmark",
+                texture_prompt="a mossy stone wall",
+                save_path=save_path,
+                texture_format=".png",
+                model_path=model_path,
+                device="cpu",
+                seed=seed,
+                steps=4,
+                use_cache=False,
+        )
+
+    return timed(run, setup=lambda: tempfile.mkdtemp(dir=work_dir))
+
+
+# ======== Reporting ======== #
+def machine():
+    return {
+            "system": platform.system(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Prints one row per benchmark and returns the names of the benchmarks slower than their baseline by more than
+    'tolerance'.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<34}{'best':>10}{'mean':>10}{'baseline':>10}{'change':>9}")
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<34}{'skipped: ' + result['skipped']:>39}")
+            continue
+
+        line = f"{name:<34}{result['best']:>9.3f}s{result['mean']:>9.3f}s"
+        previous = baseline.get("results", {}).get(name)
+        if previous and "best" in previous:
+            change = result["best"] / previous["best"] - 1
+            line += f"{previous['best']:>9.3f}s{change:>+9.1%}"
+            if change > tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cozy Auto Texture benchmarks")
+    parser.add_argument("--only", help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--baseline", default=baseline_path)
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=tolerance)
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = {}
+    for name, function in benchmarks.items():
+        if args.only and args.only not in name:
+            continue
+
+        print(f"Running {name}...")
+        work_dir = tempfile.mkdtemp(prefix=f"cat-benchmark-{name}-")
+        try:
+            runs = function(work_dir)
+            results[name] = {"best": min(runs), "mean": sum(runs) / len(runs), "runs": runs}
+        except Skipped as err:
+            results[name] = {"skipped": str(err)}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"machine": machine(), "recorded": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=1)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline.get("machine") != report["machine"]:
+            print(f"Warning: baseline recorded on a different machine: {baseline.get('machine')}")
+    elif not args.update_baseline:
+        print(f"No baseline at {args.baseline}, comparison skipped. Record one on this machine with --update-baseline.")
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.update_baseline:
+        # Keep the baseline of benchmarks that weren't run or were skipped this time:
+        merged = dict(baseline.get("results", {}))
+        merged.update({name: result for name, result in results.items() if "skipped" not in result})
+        with open(args.baseline, "w") as outfile:
+            json.dump({**report, "results": merged}, outfile, indent=1)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,362 @@
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import signal
+import argparse
+import traceback
+import importlib.util
+
+# NOTE: Regression checks for the Venv side of Cozy Auto Texture, runs on a CPU-only Linux box without Blender or
+# network access. Run it with the Venv's Python so torch, diffusers and fire are importable, checks whose dependencies
+# are missing are skipped:
+#
+#   <venv>/bin/python tests/regressions.development.py               Run every check
+#   <venv>/bin/python tests/regressions.development.py --only lean   Only run checks containing "lean"
+#
+# The exit code is 1 if any check failed.
+
+tests_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(tests_path), "src"))
+
+# The tiny random pipeline of the benchmarks, loaded by path since the file name isn't a module name:
+benchmark_spec = importlib.util.spec_from_file_location(
+        "benchmark", os.path.join(tests_path, "benchmark.development.py")
+)
+benchmark = importlib.util.module_from_spec(benchmark_spec)
+benchmark_spec.loader.exec_module(benchmark)
+
+Skipped = benchmark.Skipped
+requires = benchmark.requires
+
+# ======== Checks ======== #
+checks = {}
+
+
+def check(function):
+    """
+    Registers 'function(work_dir)' as a check, it fails by raising AssertionError (or anything else) or raises Skipped.
+    """
+    checks[function.__name__] = function
+    return function
+
+
+def tiny_text2img(work_dir: str, model_path: str, **kwargs):
+    """
+    Runs text2img with the tiny pipeline and returns (image path, trace).
+    """
+    import sd_interface
+
+    trace_path = tempfile.mktemp(suffix=".json", dir=work_dir)
+    options = {
+            "texture_name": "check",
+            "texture_prompt": "a mossy stone wall",
+            "save_path": os.path.join(work_dir, "textures"),
+            "texture_format": ".png",
+            "model_path": model_path,
+            "device": "cpu",
+            "seed": benchmark.seed,
+            "steps": 4,
+            "trace_path": trace_path,
+            **kwargs,
+    }
+    image_path = sd_interface.SDInterfaceCommands().text2img(**options)
+    with open(trace_path) as infile:
+        return image_path, json.load(infile)
+
+
+@check
+def lean_memory_mode_is_cached_separately(work_dir: str):
+    """A lean request must not be answered with the cached image of a normal one, their pixels differ slightly."""
+    for module_name in ("fire", "torch", "diffusers", "transformers", "numpy", "PIL"):
+        requires(module_name)
+    import numpy
+    from PIL import Image
+
+    model_path = os.path.join(work_dir, "tiny-stable-diffusion")
+    benchmark.make_tiny_pipeline(model_path)
+    cache_dir = os.path.join(work_dir, "cache")
+
+    normal_path, _ = tiny_text2img(work_dir, model_path, cache_dir=cache_dir, memory_mode="normal")
+    lean_path, lean_trace = tiny_text2img(work_dir, model_path, cache_dir=cache_dir, memory_mode="lean")
+    stages = [stage["name"] for stage in lean_trace["stages"]]
+    assert "denoising" in stages, f"Lean request was answered from the cache: {stages}"
+
+    _, cached_trace = tiny_text2img(work_dir, model_path, cache_dir=cache_dir, memory_mode="lean")
+    stages = [stage["name"] for stage in cached_trace["stages"]]
+    assert "denoising" not in stages, f"Repeated lean request wasn't answered from the cache: {stages}"
+
+    difference = numpy.abs(
+            numpy.asarray(Image.open(normal_path), dtype=numpy.int16) - numpy.asarray(Image.open(lean_path))
+    ).max()
+    print(f"Largest pixel difference between normal and lean mode: {difference}/255")
+
+
+@check
+def edited_output_is_not_reused(work_dir: str):
+    """A cache hit returns the earlier output only while it is unchanged, an edited one gets a fresh copy instead."""
+    for module_name in ("fire", "torch", "diffusers", "transformers", "numpy", "PIL"):
+        requires(module_name)
+
+    model_path = os.path.join(work_dir, "tiny-stable-diffusion")
+    benchmark.make_tiny_pipeline(model_path)
+    cache_dir = os.path.join(work_dir, "cache")
+
+    first_path, _ = tiny_text2img(work_dir, model_path, cache_dir=cache_dir)
+    with open(first_path, "rb") as infile:
+        generated = infile.read()
+    repeated_path, _ = tiny_text2img(work_dir, model_path, cache_dir=cache_dir)
+    assert repeated_path == first_path, f"Unchanged output wasn't reused: {repeated_path}"
+
+    with open(first_path, "wb") as outfile:
+        outfile.write(b"painted over")
+    edited_path, trace = tiny_text2img(work_dir, model_path, cache_dir=cache_dir)
+    assert edited_path != first_path, "Edited output was returned for a cache hit"
+    assert "denoising" not in [stage["name"] for stage in trace["stages"]], "Cache hit wasn't used"
+    with open(edited_path, "rb") as infile:
+        assert infile.read() == generated, "Copy of the cached image differs from the generated one"
+
+
+@check
+def failed_save_leaves_no_empty_file(work_dir: str):
+    """The output path claimed for a texture is deleted again when writing the texture fails."""
+    for module_name in ("fire", "torch", "diffusers", "transformers", "numpy", "PIL"):
+        requires(module_name)
+
+    model_path = os.path.join(work_dir, "tiny-stable-diffusion")
+    benchmark.make_tiny_pipeline(model_path)
+    try:
+        tiny_text2img(work_dir, model_path, texture_format=".unknown", use_cache=False)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("Saving a texture in an unknown format did not fail")
+
+    left = [file for file in os.listdir(os.path.join(work_dir, "textures")) if file.endswith(".unknown")]
+    assert not left, f"Claimed output left behind: {left}"
+
+
+@check
+def cached_output_name_matches_exactly(work_dir: str):
+    """A cache hit for "brick" must not hand back the earlier output "brick wall.png" of the same image."""
+    requires("fire")
+    import sd_interface
+    import texture_library
+    from result_cache import ResultCache
+
+    save_path = os.path.join(work_dir, "textures")
+    os.makedirs(save_path)
+    cache = ResultCache(os.path.join(work_dir, "cache"), max_bytes=1e9)
+    with open(os.path.join(save_path, "brick wall.png"), "wb") as outfile:
+        outfile.write(b"pixels")
+    cache.put("key", image_path=os.path.join(save_path, "brick wall.png"), params={})
+    cache.add_output("key", os.path.join(save_path, "brick wall.jpg"))
+
+    with texture_library.TextureLibrary(save_path) as library:
+        output_path = os.path.join(save_path, "brick.png")
+        path = sd_interface.reuse_cached(cache, key="key", output_path=output_path, library=library)
+        assert path == output_path, f"Cache hit for 'brick' returned {path}"
+
+        repeated_path = sd_interface.reuse_cached(
+                cache, key="key", output_path=output_path, library=library
+        )
+        assert repeated_path == output_path, f"Own output wasn't reused: {repeated_path}"
+
+
+@check
+def cpu_threads_are_restored(work_dir: str):
+    """The torch thread count of an optimized CPU generation must not stick to the worker after it finished."""
+    for module_name in ("fire", "torch"):
+        requires(module_name)
+    import torch
+    import sd_interface
+
+    threads = torch.get_num_threads()
+    for cpu_mode in ("optimized", "optimized_int8"):
+        with sd_interface.execution_context("cpu", cpu_mode=cpu_mode, cpu_threads=threads + 1):
+            assert torch.get_num_threads() == threads + 1, f"cpu_threads wasn't applied in {cpu_mode} mode"
+        assert torch.get_num_threads() == threads, f"Thread count leaked out of {cpu_mode} mode"
+
+
+@check
+def pipeline_cache_evicts_before_loading(work_dir: str):
+    """A miss makes room for the estimated size of the new pipeline before loading it, not after."""
+    from pipeline_cache import PipelineCache
+
+    resident_while_loading, evicted = [], []
+
+    def loader(key):
+        resident_while_loading.append(list(cache.entries))
+        return key
+
+    cache = PipelineCache(
+            loader=loader,
+            sizer=lambda value: 60,
+            budgets={"ram": 100, "vram": 0},
+            estimator=lambda key: 60,
+            on_evict=evicted.append,
+    )
+    first, second = ("a", "cpu"), ("b", "cpu")
+    cache.get(first)
+    cache.get(second)
+    assert resident_while_loading[1] == [], f"Loaded next to {resident_while_loading[1]}, over the RAM budget"
+    assert evicted == [first] and list(cache.entries) == [second], (evicted, list(cache.entries))
+
+
+@check
+def pipeline_size_estimate(work_dir: str):
+    """The size estimated from the weight files is close to the size of the loaded pipeline."""
+    for module_name in ("fire", "torch", "diffusers", "transformers"):
+        requires(module_name)
+    import sd_interface
+
+    model_path = os.path.join(work_dir, "tiny-stable-diffusion")
+    benchmark.make_tiny_pipeline(model_path)
+    key = sd_interface.pipeline_key(model_path, "cpu", "fp32", "normal", "default")
+    estimate = sd_interface.estimate_pipeline_size(key)
+    size = sd_interface.pipeline_size(sd_interface.build_pipeline(key))
+    print(f"Estimated {estimate} bytes, loaded {size} bytes")
+    assert 0.8 * size <= estimate <= 1.25 * size, f"Estimate of {estimate} bytes for a pipeline of {size} bytes"
+
+
+@check
+def trace_written_to_relative_path(work_dir: str):
+    """A bare file name as 'trace_path' is written to the working directory instead of failing in makedirs('')."""
+    import job_trace
+
+    trace = job_trace.Trace(label="check")
+    trace.add("denoising", 1.0)
+    job_trace.write(trace.to_dict(), "trace.json")
+    job_trace.write(trace.to_dict(), os.path.join("traces", "trace.json"))
+
+    for path in ("trace.json", os.path.join(work_dir, "traces", "trace.json")):
+        with open(path) as infile:
+            assert json.load(infile)["stages"][0]["name"] == "denoising"
+
+
+@check
+def failed_trace_is_not_done(work_dir: str):
+    """The trace of a generation that raised is marked as failed with its error instead of looking complete."""
+    requires("fire")
+    import job_trace
+
+    try:
+        tiny_text2img(work_dir, os.path.join(work_dir, "missing-model"), use_cache=False)
+    except Exception as err:
+        error = err
+    else:
+        raise AssertionError("text2img with a missing model did not fail")
+
+    with open(glob.glob(os.path.join(work_dir, "*.json"))[0]) as infile:
+        trace = json.load(infile)
+    assert trace["status"] == "failed" and trace["error"], f"Trace of a failed job: {trace}"
+    assert "FAILED" in job_trace.summary(trace), job_trace.summary(trace)
+    print(f"Failed with: {error}")
+
+
+@check
+def dependency_specifiers(work_dir: str):
+    """Version ranges, pre-releases, local labels and extras are checked like pip would, with and without packaging."""
+    import dependency_probe
+
+    cases = [
+            ("torch>=1.12,<2", "1.13.1", True),
+            ("torch>=1.12,<2", "2.0.0", False),
+            ("torch<2", "2.0.0rc1", False),
+            ("diffusers==2.0", "2.0.0rc1", False),
+            ("diffusers==2.0", "2.0.0", True),
+            ("torch==1.12.1", "1.12.1+cu116", True),
+            ("torch==1.12.1+cu116", "1.12.1", False),
+            ("numpy>=1.0", "1.0.post1", True),
+            ("diffusers[torch]>=0.3", "0.4.0", True),
+    ]
+
+    requirement_class = dependency_probe.Requirement
+    try:
+        for packaging in (True, False):
+            if not packaging:
+                dependency_probe.Requirement = None
+            elif dependency_probe.Requirement is None:
+                continue
+            for requirement, version, expected in cases:
+                _, satisfied_by = dependency_probe.parse_requirement(requirement)
+                assert satisfied_by(version) == expected, f"{requirement} with {version}, packaging: {packaging}"
+
+        # Without packaging, specifiers the fallback can't check fail closed instead of raising:
+        report = dependency_probe.probe(["diffusers~=0.4"], paths=[work_dir])
+        assert not report["ok"] and "error" in report["dependencies"][0]
+    finally:
+        dependency_probe.Requirement = requirement_class
+
+
+@check
+def hung_worker_is_restarted(work_dir: str):
+    """A worker that is alive but doesn't answer (here: stopped with SIGSTOP) is replaced before the next request."""
+    if not hasattr(signal, "SIGSTOP"):
+        raise Skipped("SIGSTOP is not available on this platform")
+    import sd_worker
+
+    script_path = os.path.join(work_dir, "echo_worker.py")
+    with open(script_path, "w") as outfile:
+        outfile.write(
+                "import sys\n"
+                f"sys.path.insert(0, {os.path.join(os.path.dirname(tests_path), 'src')!r})\n"
+                "import sd_worker\n"
+                "class Commands(object):\n"
+                "    def echo(self, text):\n"
+                "        return text\n"
+                "    def unload(self):\n"
+                "        pass\n"
+                "sd_worker.serve(Commands(), port_file=sys.argv[sys.argv.index('--port_file') + 1])\n"
+        )
+
+    client = sd_worker.WorkerClient(python_exe=sys.executable, script_path=script_path)
+    try:
+        assert client.request("echo", text="first") == "first"
+        hung_process = client.process
+        os.kill(hung_process.pid, signal.SIGSTOP)
+        client.last_answer = 0.0  # As if the last answer was longer ago than the health check interval
+
+        assert client.request("echo", text="second") == "second"
+        assert client.process is not hung_process and hung_process.poll() is not None, "Hung worker was not replaced"
+    finally:
+        client.stop()
+
+
+# ======== Running ======== #
+def main():
+    parser = argparse.ArgumentParser(description="Cozy Auto Texture regression checks")
+    parser.add_argument("--only", help="Only run checks whose name contains this text.")
+    args = parser.parse_args()
+
+    failed = []
+    for name, function in checks.items():
+        if args.only and args.only not in name:
+            continue
+
+        work_dir = tempfile.mkdtemp(prefix=f"cat-check-{name}-")
+        cwd = os.getcwd()
+        try:
+            os.chdir(work_dir)  # Relative paths written by a check end up in its work directory
+            function(work_dir)
+            print(f"PASSED   {name}")
+        except Skipped as err:
+            print(f"SKIPPED  {name}: {err}")
+        except Exception:
+            failed.append(name)
+            print(f"FAILED   {name}")
+            traceback.print_exc()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failed:
+        print(f"\n{len(failed)} check(s) failed: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())